@@ -10,10 +10,15 @@ from __future__ import print_function, division
 import argparse
 import magmo
 import sgps
+import spectra_store
 import os
 import sys
 import time
 import csv
+import glob
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from astropy.io import fits
 from astropy.io import votable
@@ -23,10 +28,16 @@ from astropy.table import Table, Column
 from astropy.io.votable.tree import Param,Info
 from astropy.io.votable import from_table, writeto
 from astropy import units as u
+import matplotlib
+# Use a non-interactive backend when run as a script, so the previews can be rendered in worker
+# processes. This must be selected before pyplot is imported.
+if __name__ == '__main__':
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import math
 import numpy as np
 import numpy.core.records as rec
+from collections import OrderedDict
 
 from string import Template
 
@@ -40,6 +51,87 @@ class IslandRange(object):
         self.isle_id = isle_id
 
 
+class IslandIndex(object):
+    """
+    An index of the bounding boxes of the islands in a field. The boxes are
+    kept sorted by right ascension so that a set of points can be checked
+    against all of the islands with a sweep over the sorted positions.
+    """
+
+    def __init__(self, island_ranges):
+        ranges = sorted(island_ranges, key=lambda ir: ir.min_ra)
+        self.islands = dict((ir.isle_id, ir) for ir in ranges)
+        self.isle_ids = np.array([ir.isle_id for ir in ranges], dtype=int)
+        self.min_ra = np.array([ir.min_ra for ir in ranges], dtype=float)
+        self.max_ra = np.array([ir.max_ra for ir in ranges], dtype=float)
+        self.min_dec = np.array([ir.min_dec for ir in ranges], dtype=float)
+        self.max_dec = np.array([ir.max_dec for ir in ranges], dtype=float)
+
+    def __len__(self):
+        return len(self.isle_ids)
+
+    def get(self, isle_id):
+        """
+        Retrieve the IslandRange for an island id, or None if the island is not in the index.
+        """
+        return self.islands.get(isle_id)
+
+    def find_islands(self, ra, dec):
+        """
+        Identify the island, if any, containing each of a set of points.
+
+        :param ra: An array of right ascensions in decimal degrees
+        :param dec: An array of declinations in decimal degrees, matching the shape of ra
+        :return: An integer array, the shape of ra, of the id of an island
+                 containing each point, or -1 where the point is in no island.
+        """
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        flat_ra = ra.ravel()
+        flat_dec = dec.ravel()
+        found = np.full(flat_ra.shape, -1, dtype=int)
+        if len(self) == 0:
+            return found.reshape(ra.shape)
+
+        # Sweep the sorted points, checking only those within each island's RA range
+        order = np.argsort(flat_ra, kind='mergesort')
+        sorted_ra = flat_ra[order]
+        starts = np.searchsorted(sorted_ra, self.min_ra, side='left')
+        ends = np.searchsorted(sorted_ra, self.max_ra, side='right')
+        for i in range(len(self)):
+            candidates = order[starts[i]:ends[i]]
+            cand_dec = flat_dec[candidates]
+            inside = candidates[(self.min_dec[i] <= cand_dec) & (cand_dec <= self.max_dec[i])]
+            found[inside[found[inside] < 0]] = self.isle_ids[i]
+        return found.reshape(ra.shape)
+
+    def contains(self, ra, dec):
+        """
+        Identify which of a set of points fall within any of the islands.
+
+        :param ra: An array of right ascensions in decimal degrees
+        :param dec: An array of declinations in decimal degrees, matching the shape of ra
+        :return: A boolean array, the shape of ra, which is True for points in an island.
+        """
+        return self.find_islands(ra, dec) >= 0
+
+
+class FieldResult(object):
+    """
+    The outcome of producing the spectra for a single field.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.islands = IslandIndex([])
+        self.sources = []
+        self.index_rows = []
+        self.cont_sd = []
+        self.opacity = []
+        self.neg_mean = 0
+        self.no_mean = 0
+
+
 def parseargs():
     """
     Parse the command line arguments
@@ -51,6 +143,26 @@ def parseargs():
     parser.add_argument("day", help="The day number to be analysed.")
     parser.add_argument("--extract_only", help="Use the previous source finding results to extract spectra", default=False,
                         action='store_true')
+    parser.add_argument("--workers", help="The number of fields to process in parallel", type=int, default=1)
+    parser.add_argument("--max_open_cubes", help="The number of SGPS cubes to keep open while sampling emission. "
+                                                 "Cubes are decompressed once to the SGPS_CACHE folder and memory "
+                                                 "mapped, but any cube which cannot be cached is held in memory in "
+                                                 "full. Defaults to 1 when using more than one worker, otherwise 4",
+                        type=int)
+    parser.add_argument("--cores", help="The number of cpu cores to use for source finding", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--force_sources", help="Search all fields for sources, even those with current results",
+                        default=False, action='store_true')
+    parser.add_argument("--aegean_options", help="Extra options for Aegean, e.g. --aegean_options='--seedclip=6'. "
+                                                 "Fields are searched again when these change.", default='')
+    parser.add_argument("--bane_options", help="Extra options for BANE, e.g. --bane_options='--grid 10 10'. "
+                                               "Background maps are only rebuilt when these change.", default='')
+    parser.add_argument("--no_votables", help="Only write spectra to the spectrum store, not to per source VOTables",
+                        default=False, action='store_true')
+    parser.add_argument("--no_previews", help="Don't plot the spectrum previews, for analysis only runs",
+                        default=False, action='store_true')
+    parser.add_argument("--previews_only", help="Only plot the previews of the spectra in the day's spectrum store",
+                        default=False, action='store_true')
 
     args = parser.parse_args()
     return args
@@ -79,7 +191,65 @@ def get_high_signal_fields(day_dir_name):
     return field_list
 
 
-def find_sources(day_dir_name, field_name):
+def get_continuum_filename(day_dir_name, field_name):
+    return day_dir_name + "/1757/magmo-" + field_name + "_1757_restor.fits"
+
+
+def get_background_maps(cont_file, cores, log_file, bane_options=''):
+    """
+    Produce the background and noise maps for a continuum image using BANE,
+    or reuse the maps from a previous run. The maps are named using a hash of
+    the image's content and the BANE options, so any change to either will
+    produce new maps. Maps for earlier versions of the image are removed.
+
+    :param cont_file: The name of the continuum image file.
+    :param cores: The number of cores BANE may use.
+    :param log_file: The file that BANE's output will be written to.
+    :param bane_options: The extra command line options passed to BANE.
+    :return: The names of the background and noise map files.
+    """
+    with open(cont_file, 'rb') as image:
+        image_hash = hashlib.sha1(image.read()).hexdigest()
+    key = hashlib.sha1((image_hash + ' ' + bane_options).encode('utf-8')).hexdigest()[:12]
+    image_base = cont_file[:-len('.fits')]
+    map_base = image_base + '_bane-' + key
+    bkg_file = map_base + '_bkg.fits'
+    rms_file = map_base + '_rms.fits'
+
+    for old_file in glob.glob(image_base + '_bane-*.fits'):
+        if old_file not in (bkg_file, rms_file):
+            print ("Removing stale background map " + old_file)
+            os.remove(old_file)
+
+    if os.path.exists(bkg_file) and os.path.exists(rms_file):
+        print ("Reusing background maps " + map_base)
+    else:
+        # Write to temporary names so an interrupted run does not leave maps that look complete
+        temp_base = map_base + '-tmp'
+        magmo.run_os_cmd('bane ' + bane_options + ' --cores=' + str(cores) + ' --out=' + temp_base + ' '
+                         + cont_file, log_file=log_file)
+        os.rename(temp_base + '_bkg.fits', bkg_file)
+        os.rename(temp_base + '_rms.fits', rms_file)
+    return bkg_file, rms_file
+
+
+def get_source_finding_key(aegean_options, bane_options):
+    """
+    Identify the settings used to find sources, so that changing any of them
+    will cause the fields to be searched again.
+    :param aegean_options: The extra command line options passed to Aegean.
+    :param bane_options: The extra command line options passed to BANE.
+    :return: A hash of the Aegean and BANE options.
+    """
+    options = 'aegean: ' + aegean_options + '\nbane: ' + bane_options
+    return hashlib.sha1(options.encode('utf-8')).hexdigest()
+
+
+def get_source_key_filename(day_dir_name, field_name):
+    return day_dir_name + "/" + field_name + '_src_find.key'
+
+
+def find_sources(day_dir_name, field_name, cores=1, aegean_options='', bane_options=''):
     """
     Search a continuum file for sources using the Aegean source finder. A
     VOTable file containing the list of discovered sources will be written out
@@ -88,22 +258,119 @@ def find_sources(day_dir_name, field_name):
 
     :param day_dir_name: The name of the day's directory.
     :param field_name:  The name fo the field to be searched for sources.
+    :param cores: The number of cores BANE and Aegean may use.
+    :param aegean_options: The extra command line options passed to Aegean.
+    :param bane_options: The extra command line options passed to BANE.
     :return: A list of error messages, if any
     """
     error_list = []
-    cont_file = day_dir_name + "/1757/magmo-" + field_name + "_1757_restor.fits"
+    cont_file = get_continuum_filename(day_dir_name, field_name)
     table_file = day_dir_name + "/" + field_name + '_src.vot'
+    log_file = day_dir_name + "/" + field_name + '_src_find.log'
+    open(log_file, 'w').close()
     try:
         print ("##--## Searching continuum image " + cont_file + " ##--##")
-        magmo.run_os_cmd('bane ' + cont_file)
-        aegean_cmd = 'aegean ' + cont_file + ' --autoload --telescope=ATCA ' \
-                     '--cores=1 --island --table=' + table_file
-        magmo.run_os_cmd(aegean_cmd)
+        bkg_file, rms_file = get_background_maps(cont_file, cores, log_file, bane_options)
+        aegean_cmd = 'aegean ' + cont_file + ' --background=' + bkg_file + ' --noise=' + rms_file \
+                     + ' --telescope=ATCA --cores=' + str(cores) + ' --island --table=' + table_file
+        if aegean_options:
+            aegean_cmd += ' ' + aegean_options
+        key_file = get_source_key_filename(day_dir_name, field_name)
+        if os.path.exists(key_file):
+            os.remove(key_file)
+        magmo.run_os_cmd(aegean_cmd, log_file=log_file)
+        with open(key_file, 'w') as key_out:
+            key_out.write(get_source_finding_key(aegean_options, bane_options) + '\n')
     except magmo.CommandFailedError as e:
+        print ("Source finding for %s failed, see %s" % (field_name, log_file))
         error_list.append(str(e))
     return error_list
 
 
+def is_source_list_current(day_dir_name, field_name, aegean_options='', bane_options=''):
+    """
+    Check if the source finding results for a field are newer than its
+    continuum image and were produced with the current Aegean and BANE options.
+
+    :param day_dir_name: The name of the day's directory.
+    :param field_name:  The name fo the field to be checked.
+    :param aegean_options: The extra command line options passed to Aegean.
+    :param bane_options: The extra command line options passed to BANE.
+    :return: True if the component and island tables are up to date, False otherwise
+    """
+    cont_file = get_continuum_filename(day_dir_name, field_name)
+    if not os.path.exists(cont_file):
+        return False
+    cont_time = os.path.getmtime(cont_file)
+    for suffix in ('_src_comp.vot', '_src_isle.vot'):
+        table_file = day_dir_name + "/" + field_name + suffix
+        if not os.path.exists(table_file) or os.path.getmtime(table_file) < cont_time:
+            return False
+    key_file = get_source_key_filename(day_dir_name, field_name)
+    if not os.path.exists(key_file):
+        return False
+    with open(key_file, 'r') as key_in:
+        return key_in.read().strip() == get_source_finding_key(aegean_options, bane_options)
+
+
+def plan_source_finding(num_fields, num_cpus):
+    """
+    Decide how to share the cpus between the fields to be searched. Aegean
+    scales better across fields than across cores within a field, so as many
+    fields as possible are searched at once, and any spare cores are given to
+    each search.
+
+    :param num_fields: The number of fields to be searched.
+    :param num_cpus: The number of cpus available.
+    :return: The number of concurrent searches and the number of cores for each search.
+    """
+    num_cpus = max(1, num_cpus)
+    if num_fields >= num_cpus:
+        return num_cpus, 1
+    return max(1, num_fields), max(1, num_cpus // max(1, num_fields))
+
+
+def find_all_sources(day_dir_name, field_list, num_cpus, force=False, aegean_options='', bane_options=''):
+    """
+    Search each of the fields for sources, running several searches at once.
+    Fields whose source lists are newer than their continuum image and were
+    produced with the current options are not searched again.
+
+    :param day_dir_name: The name of the day's directory.
+    :param field_list: The list of fields to be searched.
+    :param num_cpus: The number of cpus to use.
+    :param force: Search all of the fields, even those which are up to date.
+    :param aegean_options: The extra command line options passed to Aegean.
+    :param bane_options: The extra command line options passed to BANE. The background maps are reused between
+        searches unless these change.
+    :return: A list of error messages, if any
+    """
+    fields = [field for field in field_list
+              if force or not is_source_list_current(day_dir_name, field, aegean_options, bane_options)]
+    if len(fields) < len(field_list):
+        print ("Skipping source finding for %d fields which are up to date" % (len(field_list) - len(fields)))
+    if len(fields) == 0:
+        return []
+
+    jobs, cores = plan_source_finding(len(fields), num_cpus)
+    print ("Searching %d fields for sources, %d at a time using %d cores each" % (len(fields), jobs, cores))
+    if jobs > 1:
+        pool = ThreadPool(processes=jobs)
+        try:
+            results = pool.map(lambda field: find_sources(day_dir_name, field, cores, aegean_options, bane_options),
+                               fields, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [find_sources(day_dir_name, field, cores, aegean_options, bane_options) for field in fields]
+
+    error_list = []
+    for errors in results:
+        error_list.extend(errors)
+    return error_list
+
+
 def read_sources(filename):
     print ("Extracting sources from " + filename)
     sources = []
@@ -210,7 +477,7 @@ def find_edges(fluxes, num_edge_chan):
     return l_edge + num_edge_chan, r_edge - num_edge_chan
 
 
-def extract_spectra(daydirname, field, continuum_ranges):
+def extract_spectra(daydirname, field, continuum_ranges, radius=2):
     num_edge_chan = 10
     fits_filename = "{0}/1420/magmo-{1}_1420_sl_restor.fits".format(daydirname,
                                                                     field)
@@ -222,11 +489,11 @@ def extract_spectra(daydirname, field, continuum_ranges):
     if not os.path.exists(fits_filename):
         print ("Warning: File %s does not exist, skipping extraction." % \
               fits_filename)
-        return spectra, source_ids, []
+        return spectra, source_ids, IslandIndex([])
 
     sources = read_sources(src_filename)
     islands = read_islands(isle_filename)
-    hdulist = fits.open(fits_filename)
+    hdulist = fits.open(fits_filename, memmap=True)
     image = hdulist[0].data
     header = hdulist[0].header
     w = WCS(header)
@@ -235,12 +502,23 @@ def extract_spectra(daydirname, field, continuum_ranges):
     beam_min = header['BMIN'] * 60 * 60
     beam_area = math.radians(header['BMAJ']) * math.radians(header['BMIN'])
     print ("Beam was %f x %f arcsec giving area of %f radians^2." % (beam_maj, beam_min, beam_area))
-    ranges = calc_island_ranges(islands, (header['CDELT1'], header['CDELT2']))
+    ranges = IslandIndex(calc_island_ranges(islands, (header['CDELT1'], header['CDELT2'])))
     velocities = w.wcs_pix2world(10,10,index[:],0,0)[2]
-    for src in sources:
-        c = SkyCoord(src['ra'], src['dec'], frame='icrs', unit="deg")
 
-        img_slice = get_integrated_spectrum(image, w, src, velocities, c.galactic.l.value, continuum_ranges)
+    if len(sources) > 0:
+        coords = SkyCoord([src['ra'] for src in sources], [src['dec'] for src in sources], frame='icrs', unit="deg")
+        x_coords, y_coords = get_source_pixels(w, sources)
+        cutouts, in_image = extract_cutouts(image, x_coords, y_coords, radius)
+        masks = get_component_masks(w, sources, x_coords, y_coords, radius) & in_image
+        integrated = get_integrated_spectra(cutouts, masks, velocities, coords.galactic.l.value, continuum_ranges)
+        del cutouts
+
+    for i in range(len(sources)):
+        src = sources[i]
+        c = coords[i]
+        img_slice = integrated[i]
+        print("Found {} pixels out of {} inside the component {} at {} {}".format(
+            np.count_nonzero(masks[i]), masks[i].size, src['id'], c.galactic.l.degree, c.galactic.b.degree))
 
         l_edge, r_edge = find_edges(img_slice, num_edge_chan)
         print("Using data range %d - %d out of %d channels." % (
@@ -268,89 +546,144 @@ def extract_spectra(daydirname, field, continuum_ranges):
     return spectra, source_ids, ranges
 
 
-def get_weighting_array(data, velocities, longitude, continuum_ranges):
+def get_source_pixels(w, sources):
     """
-    Calculate the mean of the continuum values. This is based on precalculated regions where there is no gas expected.
-    :param data: A cubelet to be analysed, should be a 3D of flux values.
-    :param planes: A umpy array of plane, and velocity values.
-    :param longitude: The galactic longitude of the target object
-    :param continuum_ranges: The predefined continuum blocks by longitude range
-    :return: A 2D array of weighting values for the
+    Find the pixel nearest to the centre of each component using a single
+    WCS conversion.
+
+    :param w: The image's world coordinate system definition
+    :param sources: The list of components in the image
+    :return: Arrays of the x and y pixel coordinates (0 based) of each component
     """
-    continuum_start_vel, continuum_end_vel = magmo.lookup_continuum_range(
-        continuum_ranges, int(longitude))
+    ra = np.array([src['ra'] for src in sources])
+    dec = np.array([src['dec'] for src in sources])
+    zeros = np.zeros(len(sources))
+    pix = w.wcs_world2pix(ra, dec, zeros, zeros, 1)
+    x_coords = np.round(pix[0]).astype(int) - 1
+    y_coords = np.round(pix[1]).astype(int) - 1
+    for i in range(len(sources)):
+        print("Translated %.4f, %.4f to %d, %d" % (
+            ra[i], dec[i], x_coords[i], y_coords[i]))
+    return x_coords, y_coords
+
+
+def extract_cutouts(image, x_coords, y_coords, radius):
+    """
+    Gather a cutout of the cube around each component in one indexing
+    operation. Only the cutout pixels are read, so the image may be a memory
+    mapped cube. Any part of a cutout which falls outside the image is set to
+    zero.
+
+    :param image: The image's data array, indexed by stokes, channel, y then x
+    :param x_coords: The x pixel coordinates (0 based) of the centre of each cutout
+    :param y_coords: The y pixel coordinates (0 based) of the centre of each cutout
+    :param radius: The number of pixels either side of the centre to include in each cutout
+    :return: An array of the cutouts indexed by component, channel, y then x, and a
+        boolean array, indexed by component, y then x, which is True for pixels inside the image.
+    """
+    offsets = np.arange(-radius, radius + 1)
+    y_idx = y_coords[:, np.newaxis] + offsets
+    x_idx = x_coords[:, np.newaxis] + offsets
+    y_valid = (y_idx >= 0) & (y_idx < image.shape[2])
+    x_valid = (x_idx >= 0) & (x_idx < image.shape[3])
+    y_idx = np.clip(y_idx, 0, image.shape[2] - 1)
+    x_idx = np.clip(x_idx, 0, image.shape[3] - 1)
+
+    plane = image[0]
+    cutouts = plane[:, y_idx[:, :, np.newaxis], x_idx[:, np.newaxis, :]].transpose(1, 0, 2, 3)
+    in_image = y_valid[:, :, np.newaxis] & x_valid[:, np.newaxis, :]
+    cutouts *= in_image[:, np.newaxis, :, :]
+    return cutouts, in_image
+
+
+def get_component_masks(w, sources, x_coords, y_coords, radius):
+    """
+    Identify which pixels of each cutout fall within the component's ellipse.
+    All of the pixel positions are converted to sky coordinates in a single WCS
+    call and tested against the ellipses together.
 
-    print(
-        "Looking for velocity range %d to %d in data of %d to %d at longitude %.3f" %
-        (continuum_start_vel, continuum_end_vel,
-         np.min(velocities) / 1000.0,
-         np.max(velocities) / 1000.0, longitude))
+    :param w: The image's world coordinate system definition
+    :param sources: The list of components in the image
+    :param x_coords: The x pixel coordinates (0 based) of the centre of each cutout
+    :param y_coords: The y pixel coordinates (0 based) of the centre of each cutout
+    :param radius: The number of pixels either side of the centre included in each cutout
+    :return: A boolean array, indexed by component, y then x, which is True for pixels inside the component.
+    """
+    offsets = np.arange(-radius, radius + 1)
+    y_pix = np.broadcast_to((y_coords[:, np.newaxis] + offsets)[:, :, np.newaxis],
+                            (len(sources), offsets.size, offsets.size))
+    x_pix = np.broadcast_to((x_coords[:, np.newaxis] + offsets)[:, np.newaxis, :], y_pix.shape)
+    zeros = np.zeros(y_pix.shape)
+    eq_pos = w.wcs_pix2world(x_pix + 1, y_pix + 1, zeros, zeros, 1)
+
+    def column(name):
+        return np.array([src[name] for src in sources])[:, np.newaxis, np.newaxis]
+
+    dist = calc_ellipse_distance(column('ra'), column('dec'), eq_pos[0], eq_pos[1], column('a'), column('b'),
+                                 np.radians(column('pa')))
+    return dist <= 1.0
 
-    continuum_range = np.where(
-        continuum_start_vel*1000 < velocities)
-    if len(continuum_range) ==0:
-        return np.zeros(data.shape[1:2])
 
-    bin_start = continuum_range[0][0]
-    continuum_range = np.where(velocities < continuum_end_vel*1000)
-    bin_end = continuum_range[0][-1]
+def get_weighting_arrays(cutouts, velocities, longitudes, continuum_ranges):
+    """
+    Calculate the weighting of each pixel of each cutout based on the mean of
+    its continuum values. This is based on precalculated regions where there is
+    no gas expected.
 
-    print("Using bins %d to %d (velocity range %d to %d) out of %d" % (
-        bin_start, bin_end, continuum_start_vel, continuum_end_vel, len(velocities)))
-    print (data.shape)
-    continuum_sample = data[bin_start:bin_end, :, :]
-    # print ("...gave sample of", continuum_sample)
-    mean_cont = np.mean(continuum_sample, axis=0)
+    :param cutouts: The cubelets to be analysed, indexed by component, channel, y then x.
+    :param velocities: A numpy array of the velocity of each channel.
+    :param longitudes: The galactic longitude of each component
+    :param continuum_ranges: The predefined continuum blocks by longitude range
+    :return: An array of weighting values, indexed by component, y then x.
+    """
+    num_src = cutouts.shape[0]
+    bin_start = np.zeros(num_src, dtype=int)
+    bin_end = np.zeros(num_src, dtype=int)
+    for i in range(num_src):
+        continuum_start_vel, continuum_end_vel = magmo.lookup_continuum_range(
+            continuum_ranges, int(longitudes[i]))
+        print(
+            "Looking for velocity range %d to %d in data of %d to %d at longitude %.3f" %
+            (continuum_start_vel, continuum_end_vel,
+             np.min(velocities) / 1000.0,
+             np.max(velocities) / 1000.0, longitudes[i]))
+        bin_start[i] = np.where(continuum_start_vel*1000 < velocities)[0][0]
+        bin_end[i] = np.where(velocities < continuum_end_vel*1000)[0][-1]
+        print("Using bins %d to %d (velocity range %d to %d) out of %d" % (
+            bin_start[i], bin_end[i], continuum_start_vel, continuum_end_vel, len(velocities)))
+
+    # Mean of each pixel over its continuum channels, from a running sum along the channel axis
+    cumulative = np.zeros((num_src, cutouts.shape[1] + 1) + cutouts.shape[2:])
+    np.cumsum(cutouts, axis=1, out=cumulative[:, 1:])
+    src_idx = np.arange(num_src)
+    num_bins = (bin_end - bin_start)[:, np.newaxis, np.newaxis]
+    mean_cont = (cumulative[src_idx, bin_end] - cumulative[src_idx, bin_start]) / num_bins
     mean_sq = mean_cont ** 2
-    sum_sq = np.sum(mean_sq)
-    weighting = mean_sq / sum_sq
-    print ("Got weighting of {} from {} and {}".format(weighting, mean_sq, sum_sq))
+    sum_sq = np.sum(mean_sq, axis=(1, 2))
+    weighting = mean_sq / sum_sq[:, np.newaxis, np.newaxis]
     return weighting
 
 
-def get_integrated_spectrum(image, w, src, velocities, longitude, continuum_ranges):
+def get_integrated_spectra(cutouts, masks, velocities, longitudes, continuum_ranges):
     """
-    Calculate the integrated spectrum of the component.
-    :param image: The image's data array
-    :param w: The image's world coordinate system definition
-    :param src: The details of the component being processed
-    :return: An array of average flux/pixel across the component at each velocity step
-    """
-    pix = w.wcs_world2pix(src['ra'], src['dec'], 0, 0, 1)
-    x_coord = int(round(pix[0])) - 1  # 266
-    y_coord = int(round(pix[1])) - 1  # 197
-    print("Translated %.4f, %.4f to %d, %d" % (
-        src['ra'], src['dec'], x_coord, y_coord))
-    radius = 2
-    y_min = y_coord - radius
-    y_max = y_coord + radius
-    x_min = x_coord - radius
-    x_max = x_coord + radius
-    data = np.copy(image[0, :, y_min:y_max+1, x_min:x_max+1])
-
-    origin = SkyCoord(src['ra'], src['dec'], frame='icrs', unit="deg")
-    pa_rad = math.radians(src['pa'])
-    total_pixels = (y_max-y_min +1) * (x_max-x_min +1)
-    outside_pixels = 0
-    for i in range(x_min, x_max+1):
-        for j in range(y_min, y_max+1):
-            eq_pos = w.wcs_pix2world(i+1, j+1, 0, 0, 1)
-            point = SkyCoord(eq_pos[0], eq_pos[1], frame='icrs', unit="deg")
-            if not point_in_ellipse(origin, point, src['a'], src['b'], pa_rad):
-                data[:, i-x_min, j-y_min] = 0
-                outside_pixels += 1
-    print("Found {} pixels out of {} inside the component {} at {} {}".format(total_pixels - outside_pixels, total_pixels,
-                                                                       src['id'],
-                                                                       point.galactic.l.degree,
-                                                                       point.galactic.b.degree))
-    weighting = get_weighting_array(data, velocities, longitude, continuum_ranges)
-    integrated = np.sum(data * weighting, axis=(1, 2))
-    inside_pixels = total_pixels - outside_pixels
-    if inside_pixels <= 0:
-        print ("Error: No data for component!")
-    else:
-        integrated /= inside_pixels
+    Calculate the integrated spectrum of each component.
 
+    :param cutouts: The cubelets around each component, indexed by component, channel, y then x.
+    :param masks: Boolean arrays, indexed by component, y then x, of the pixels inside each component.
+    :param velocities: A numpy array of the velocity of each channel.
+    :param longitudes: The galactic longitude of each component
+    :param continuum_ranges: The predefined continuum blocks by longitude range
+    :return: An array of average flux/pixel across each component at each velocity step,
+        indexed by component then channel.
+    """
+    data = cutouts * masks[:, np.newaxis, :, :]
+    weighting = get_weighting_arrays(data, velocities, longitudes, continuum_ranges)
+    integrated = np.sum(data * weighting[:, np.newaxis, :, :], axis=(2, 3))
+    inside_pixels = np.sum(masks, axis=(1, 2))
+    for i in np.where(inside_pixels <= 0)[0]:
+        print ("Error: No data for component %d!" % i)
+    has_data = inside_pixels > 0
+    integrated[has_data] /= inside_pixels[has_data, np.newaxis]
     return integrated
 
 
@@ -429,6 +762,107 @@ def name_spectrum(loc):
     return 'MAGMOHI G{:0=7.3f}{:=+06.3f}'.format(glong, glat)
 
 
+class SpectrumPlot(object):
+    """
+    A figure for previews of spectra which is created once and then reused for
+    each spectrum. Only the data of the spectrum line, the noise band, the
+    continuum markers and the title are changed for each plot, which is much
+    quicker than building a new figure for every source.
+    """
+
+    def __init__(self, ylabel, ref_level=None):
+        self.fig = plt.figure()
+        self.ax = self.fig.add_subplot(111)
+        self.line, = self.ax.plot([], [])
+        self.band = None
+        self.ref_level = ref_level
+        if ref_level is not None:
+            self.ax.axhline(ref_level, color='r')
+        self.con_start = self.ax.axvline(0, color='g', linestyle='dashed')
+        self.con_end = self.ax.axvline(0, color='g', linestyle='dashed')
+
+        self.ax.set_xlabel(r'Velocity relative to LSR (km/s)')
+        self.ax.set_ylabel(ylabel)
+        self.ax.grid(True)
+
+    def plot(self, filename, velocity, values, band_min, band_max, title, con_start_vel, con_end_vel):
+        """
+        Draw a spectrum on the figure and write it out to a file.
+
+        :param filename: The file the plot should be written to.
+        :param velocity: The velocity data in m/s
+        :param values: The value of the spectrum at each velocity step
+        :param band_min: The lower edge of the noise band, or None if there is no band
+        :param band_max: The upper edge of the noise band
+        :param title: The title for the plot
+        :param con_start_vel: The minimum velocity that the continuum was measured at.
+        :param con_end_vel: The maximum velocity that the continuum was measured at.
+        :return: None
+        """
+        x = velocity / 1000
+        self.line.set_data(x, values)
+        y_values = [values]
+
+        if self.band is not None:
+            self.band.remove()
+            self.band = None
+        if band_min is not None:
+            self.band = self.ax.fill_between(x, band_min, band_max, facecolor='lightgray', color='lightgray')
+            y_values.extend([band_min, band_max])
+        if self.ref_level is not None:
+            y_values.append([self.ref_level])
+
+        self.con_start.set_xdata([con_start_vel, con_start_vel])
+        self.con_end.set_xdata([con_end_vel, con_end_vel])
+        self.ax.set_title(title)
+
+        # The artists are changed in place, so the limits are set explicitly rather than autoscaled
+        set_padded_limits(self.ax.set_xlim, [x, [con_start_vel, con_end_vel]])
+        set_padded_limits(self.ax.set_ylim, y_values)
+        self.fig.savefig(filename)
+
+
+_spectrum_plots = {}
+
+
+def get_spectrum_plot(kind):
+    """
+    Retrieve the reusable figure for a kind of spectrum preview, creating it
+    the first time it is used by this process.
+
+    :param kind: The kind of preview, either absorption or emission.
+    :return: The SpectrumPlot for the kind of preview.
+    """
+    plot = _spectrum_plots.get(kind)
+    if plot is None:
+        if kind == 'absorption':
+            plot = SpectrumPlot(r'$e^{(-\tau)}$', ref_level=1)
+        else:
+            plot = SpectrumPlot(r'$T_B$ (K)')
+        _spectrum_plots[kind] = plot
+    return plot
+
+
+def set_padded_limits(set_limits, values, margin=0.05):
+    """
+    Set the limits of an axis to cover a set of values, with a margin either side.
+
+    :param set_limits: The function to set the limits, e.g. ax.set_xlim
+    :param values: A list of arrays of the values to be covered.
+    :param margin: The fraction of the range of the data to leave either side.
+    :return: None
+    """
+    low = min(np.nanmin(vals) for vals in values)
+    high = max(np.nanmax(vals) for vals in values)
+    if not (np.isfinite(low) and np.isfinite(high)):
+        return
+    if high == low:
+        low -= 1
+        high += 1
+    padding = (high - low) * margin
+    set_limits(low - padding, high + padding)
+
+
 def plot_spectrum(x, y, filename, title, con_start_vel, con_end_vel, sigma_tau):
     """
     Output a plot of opacity vs LSR velocity to a specified file.
@@ -441,25 +875,13 @@ def plot_spectrum(x, y, filename, title, con_start_vel, con_end_vel, sigma_tau):
     :param con_start_vel: The minimum velocity that the continuum was measured at.
     :param con_end_vel: The maximum velocity that the continuum was measured at.
     """
-    fig = plt.figure()
-    plt.plot(x/1000, y)
-
+    tau_min = None
+    tau_max = None
     if len(sigma_tau) > 0:
         tau_max = 1 + sigma_tau
         tau_min = 1 - sigma_tau
-        plt.fill_between(x/1000, tau_min, tau_max, facecolor='lightgray', color='lightgray')
-
-    plt.axhline(1, color='r')
-    plt.axvline(con_start_vel, color='g', linestyle='dashed')
-    plt.axvline(con_end_vel, color='g', linestyle='dashed')
-
-    plt.xlabel(r'Velocity relative to LSR (km/s)')
-    plt.ylabel(r'$e^{(-\tau)}$')
-    plt.title(title)
-    plt.grid(True)
-    plt.savefig(filename)
-    #plt.show()
-    plt.close()
+
+    get_spectrum_plot('absorption').plot(filename, x, y, tau_min, tau_max, title, con_start_vel, con_end_vel)
     return
 
 
@@ -482,26 +904,83 @@ def plot_emission_spectrum(velocity, em_mean, em_std, filename, title, con_start
             os.remove(filename)
         return
 
-    fig = plt.figure()
-    plt.plot(velocity/1000, em_mean)
-
     em_max = em_mean + em_std
     em_min = em_mean - em_std
-    plt.fill_between(velocity/1000, em_min, em_max, facecolor='lightgray', color='lightgray')
-
-    plt.axvline(con_start_vel, color='g', linestyle='dashed')
-    plt.axvline(con_end_vel, color='g', linestyle='dashed')
-
-    plt.xlabel(r'Velocity relative to LSR (km/s)')
-    plt.ylabel(r'$T_B$ (K)')
-    plt.title(title)
-    plt.grid(True)
-    plt.savefig(filename)
-    #plt.show()
-    plt.close()
+    get_spectrum_plot('emission').plot(filename, velocity, em_mean, em_min, em_max, title, con_start_vel,
+                                       con_end_vel)
     return
 
 
+def plot_previews(dir_prefix, name_prefix, spectrum_name, velocity, opacity, sigma_tau, em_mean, em_std,
+                  min_con_vel, max_con_vel):
+    """
+    Plot the absorption and emission previews of a spectrum.
+
+    :param dir_prefix: The folder the previews are written to, including a trailing /
+    :param name_prefix: The prefix of the preview file names, made up of the field and source id.
+    :param spectrum_name: The name of the spectrum, used in the titles.
+    :return: None
+    """
+    plot_spectrum(velocity, opacity, dir_prefix + name_prefix + "_plot.png",
+                  "Spectra for source {}".format(spectrum_name), min_con_vel, max_con_vel, sigma_tau)
+    plot_emission_spectrum(velocity, em_mean, em_std, dir_prefix + name_prefix + "_emission.png",
+                           "Emission around {0}".format(spectrum_name), min_con_vel, max_con_vel)
+
+
+def render_stored_previews(day_dir_name, rows, continuum_ranges):
+    """
+    Plot the previews of a set of spectra from a day's spectrum store.
+
+    :param day_dir_name: The name of the day's directory.
+    :param rows: The positions of the spectra in the day's index.
+    :param continuum_ranges: The predefined continuum blocks by longitude range
+    :return: The number of spectra plotted.
+    """
+    store = spectra_store.open_day_store(day_dir_name)
+    for row in rows:
+        columns = store.spectrum(row)
+        longitude = float(store.index['longitude'][row])
+        latitude = float(store.index['latitude'][row])
+        min_con_vel, max_con_vel = magmo.lookup_continuum_range(continuum_ranges, int(longitude))
+        name_prefix = spectra_store.as_str(store.index['field'][row]) + '_src' + spectra_store.as_str(
+            store.index['source'][row])
+        spectrum_name = name_spectrum(SkyCoord(longitude, latitude, frame='galactic', unit="deg"))
+        em_mean = columns['em_mean'] if store.index['has_emission'][row] else []
+        plot_previews(day_dir_name + "/", name_prefix, spectrum_name, columns['velocity'], columns['opacity'],
+                      columns['sigma_tau'], em_mean, columns['em_std'], min_con_vel, max_con_vel)
+    return len(rows)
+
+
+def render_day_previews(day_dir_name, continuum_ranges, workers=1):
+    """
+    Plot the previews of all of the spectra in a day's spectrum store. This
+    allows the previews to be produced after an analysis run where preview
+    rendering was skipped. The spectra are split into one block per worker so
+    that each worker reuses its figures for all of its spectra.
+
+    :param day_dir_name: The name of the day's directory.
+    :param continuum_ranges: The predefined continuum blocks by longitude range
+    :param workers: The number of processes to use to plot the previews.
+    :return: The number of spectra plotted.
+    """
+    num_spectra = len(spectra_store.open_day_store(day_dir_name))
+    workers = max(1, min(workers, num_spectra))
+    tasks = [(render_stored_previews, day_dir_name, [int(row) for row in rows], continuum_ranges)
+             for rows in np.array_split(np.arange(num_spectra), workers)]
+    pool = None
+    if workers > 1:
+        print ("Plotting previews of %d spectra using %d workers" % (num_spectra, workers))
+        pool = multiprocessing.Pool(processes=workers)
+    try:
+        num_plotted = sum(map_fields(pool, tasks))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print ("Plotted previews of %d spectra" % num_plotted)
+    return num_plotted
+
+
 def output_spectra(spectrum, opacity, filename, longitude, latitude, em_mean, em_std, temp_bright, beam_area,
                    sigma_tau):
     """
@@ -513,23 +992,9 @@ def output_spectra(spectrum, opacity, filename, longitude, latitude, em_mean, em
     :param longitude: The galactic longitude of the target object
     :param latitude: The galactic latitude of the target object
     """
-    table = Table(meta={'name': filename, 'id': 'opacity'})
-    table.add_column(Column(name='plane', data=spectrum.plane))
-    table.add_column(Column(name='velocity', data=spectrum.velocity, unit='m/s'))
-    table.add_column(Column(name='opacity', data=opacity))
-    table.add_column(Column(name='flux', data=spectrum.flux, unit='Jy', description='Flux per beam'))
-    table.add_column(Column(name='temp_brightness', data=temp_bright, unit='K'))
-    table.add_column(Column(name='sigma_tau', data=sigma_tau, description='Noise in the absorption profile'))
-    if len(em_mean) > 0:
-        # The emission may not be available, so don't include it if not
-        table.add_column(Column(name='em_mean', data=em_mean, unit='K'))
-        table.add_column(Column(name='em_std', data=em_std, unit='K'))
-
-    votable = from_table(table)
-    votable.infos.append(Info('longitude', 'longitude', longitude.value))
-    votable.infos.append(Info('latitude', 'latitude', latitude.value))
-    votable.infos.append(Info('beam_area', 'beam_area', beam_area))
-    writeto(votable, filename)
+    columns = {'plane': spectrum.plane, 'velocity': spectrum.velocity, 'opacity': opacity, 'flux': spectrum.flux,
+               'temp_brightness': temp_bright, 'sigma_tau': sigma_tau, 'em_mean': em_mean, 'em_std': em_std}
+    spectra_store.write_opacity_votable(filename, columns, longitude.value, latitude.value, beam_area)
 
 
 def output_emission_spectra(filename, longitude, latitude, velocity, em_mean,
@@ -559,83 +1024,107 @@ def output_emission_spectra(filename, longitude, latitude, velocity, em_mean,
     writeto(votable, filename)
 
 
-def point_in_ellipse(origin, point, a, b, pa_rad):
+def calc_ellipse_distance(origin_ra, origin_dec, ra, dec, a, b, pa_rad):
+    """
+    Calculate how far points are from the centre of an ellipse, relative to
+    the size of the ellipse in the direction of each point. Points with a
+    distance of 1 or less are inside the ellipse. The positions may be scalars
+    or numpy arrays, as may the ellipse parameters so long as they broadcast
+    against the positions.
+
+    :param origin_ra: The right ascension of the centre of the ellipse in decimal degrees
+    :param origin_dec: The declination of the centre of the ellipse in decimal degrees
+    :param ra: The right ascension of the points in decimal degrees
+    :param dec: The declination of the points in decimal degrees
+    :param a: semi-major axis length in arcsec of the ellipse
+    :param b: semi-minor axis length in arcsec of the ellipse
+    :param pa_rad: The position angle of the ellipse in radians
+    :return: The relative distance of each point from the centre of the ellipse.
+    """
     # Convert point to be in plane of the ellipse
-    p_ra_dist = point.icrs.ra.degree - origin.icrs.ra.degree
-    p_dec_dist = point.icrs.dec.degree - origin.icrs.dec.degree
-    x = p_ra_dist * math.cos(pa_rad) + p_dec_dist * math.sin(pa_rad)
-    y = - p_ra_dist * math.sin(pa_rad) + p_dec_dist * math.cos(pa_rad)
+    p_ra_dist = np.asarray(ra) - origin_ra
+    p_dec_dist = np.asarray(dec) - origin_dec
+    x = p_ra_dist * np.cos(pa_rad) + p_dec_dist * np.sin(pa_rad)
+    y = - p_ra_dist * np.sin(pa_rad) + p_dec_dist * np.cos(pa_rad)
 
     a_deg = a / 3600
-    b_deg = a / 3600
+    b_deg = b / 3600
 
     # Calc distance from origin relative to a/b
-    dist = math.sqrt((x / a_deg) ** 2 + (y / b_deg) ** 2)
-    print("Point %s is %f from ellipse %f, %f, %f at %s." % (point, dist, a, b, math.degrees(pa_rad), origin))
-    return dist <= 1.0
-
-
-def point_in_island(point, islands):
-    ra = point.icrs.ra.degree
-    dec = point.icrs.dec.degree
-    for island in islands:
-        if island.min_ra <= ra <= island.max_ra and island.min_dec <= dec <= island.max_dec:
-            print("Point %s in island %d at %f, %f" % (point, island.isle_id, island.min_ra, island.min_dec))
-            return True
-    print("Point %f, %f not in any of %d islands" % (ra, dec, len(islands)))
-    return False
+    return np.sqrt((x / a_deg) ** 2 + (y / b_deg) ** 2)
 
 
-def calc_offset_points(longitude, latitude, beam_size, a, b, pa, islands, num_points=6, max_dist=0.04):
+def calc_offset_points(longitudes, latitudes, beam_size, a, b, pa, source_islands, num_points=6, max_dist=0.04):
+    """
+    Find the points around each source at which the emission will be sampled. For each of num_points evenly
+    spaced directions the nearest point, in steps of half a beam, which is outside both the component and any
+    island is used. All candidate points for all sources are tested together.
+
+    :param longitudes: The galactic longitude of each source in decimal degrees
+    :param latitudes: The galactic latitude of each source in decimal degrees
+    :param beam_size: The size of the beam in decimal degrees
+    :param a: The semi-major axis length in arcsec of each component ellipse
+    :param b: The semi-minor axis length in arcsec of each component ellipse
+    :param pa: The position angle in degrees of each component ellipse
+    :param source_islands: The IslandIndex for the field of each source
+    :param num_points: The number of directions to look for a point in
+    :param max_dist: The maximum distance in degrees from the source for a point
+    :return: Arrays of the longitude and latitude of each point, indexed by source then direction, and a boolean
+             array which is False where no point could be found within max_dist.
+    """
+    num_src = len(longitudes)
     spacing = 2.0 * math.pi / float(num_points)
-    origin = SkyCoord(longitude, latitude, frame='galactic', unit="deg")
-    pa_rad = math.radians(pa)
-    points = []
-    for i in range(0, num_points):
-        angle = spacing * i
-        mult = 0.5
-        inside_component = True
-        while inside_component:
-            if mult*beam_size > max_dist:
-                coord = None
-                break;
-            g_l = longitude + math.sin(angle)*beam_size*mult
-            g_b = latitude + math.cos(angle)*beam_size*mult
-            coord = SkyCoord(g_l, g_b, frame='galactic', unit="deg")
-
-            inside_component = point_in_ellipse(origin, coord, a, b, pa_rad) or point_in_island(coord, islands)
-            mult += 0.5
-        if coord is None:
-            print("Point could not be found for angle %f within max dist of %f (mult %f)" % (
-                math.degrees(angle), max_dist, mult))
-        else:
-            print ("Point at angle %f is %s with mult %f" % (math.degrees(angle), str(coord), mult-0.5))
-            points.append(coord)
-
-    return points
-
-
-def get_emission_spectra(centre, velocities, file_list, filename_prefix, a, b, pa, islands):
+    angles = spacing * np.arange(num_points)
+    mults = 0.5 * np.arange(1, int(max_dist / (0.5 * beam_size)) + 1)
+    offsets = beam_size * mults[np.newaxis, np.newaxis, :]
+
+    # Candidate points are indexed by source, direction then distance
+    g_l = np.asarray(longitudes, dtype=float)[:, np.newaxis, np.newaxis] + \
+        np.sin(angles)[np.newaxis, :, np.newaxis] * offsets
+    g_b = np.asarray(latitudes, dtype=float)[:, np.newaxis, np.newaxis] + \
+        np.cos(angles)[np.newaxis, :, np.newaxis] * offsets
+    points = SkyCoord(g_l.ravel(), g_b.ravel(), frame='galactic', unit="deg").icrs
+    ra = points.ra.degree.reshape(g_l.shape)
+    dec = points.dec.degree.reshape(g_l.shape)
+    origins = SkyCoord(longitudes, latitudes, frame='galactic', unit="deg").icrs
+
+    def per_source(values):
+        return np.asarray(values, dtype=float)[:, np.newaxis, np.newaxis]
+
+    inside = calc_ellipse_distance(per_source(origins.ra.degree), per_source(origins.dec.degree), ra, dec,
+                                   per_source(a), per_source(b), np.radians(per_source(pa))) <= 1.0
+
+    # Each field has its own islands, so check the sources of each field together
+    field_sources = OrderedDict()
+    for i in range(num_src):
+        field_sources.setdefault(id(source_islands[i]), []).append(i)
+    for src_idx in field_sources.values():
+        inside[src_idx] |= source_islands[src_idx[0]].contains(ra[src_idx], dec[src_idx])
+
+    outside = ~inside
+    found = np.any(outside, axis=2)
+    nearest = np.argmax(outside, axis=2)
+    src_idx, angle_idx = np.indices(found.shape)
+    print("Found %d of %d offset points within max dist of %f for %d sources" % (
+        np.count_nonzero(found), found.size, max_dist, num_src))
+    return g_l[src_idx, angle_idx, nearest], g_b[src_idx, angle_idx, nearest], found
+
+
+def get_emission_spectra(centre, velocities, ems, filename_prefix):
     """
-    Extract SGPS emission spectra around a central point.
+    Combine the SGPS emission spectra around a central point, writing them out
+    to a VOTable file.
 
     :param centre: A SkyCoord containing the location of the central point
     :param velocities: The velocities list sothat the emission data can be matched.
-    :param file_list: A list of dictionaries describing the SGPS files.
-    :paeram a: semi-major axis length in arcsec of the component ellipse
-    :paeram b: semi-minor axis length in arcsec of the component ellipse
-    :paeram pa: parallactic angle of the component ellipse
+    :param ems: The list of SGPS emission spectra around the point
+    :param filename_prefix: The prefix of the emission spectrum file name
     :return: An array fo the mean and standard deviation of emission at each velocity.
     """
 
-    #file_list = sgps.get_hi_file_list()
     filename = filename_prefix + '_emission.votable.xml'
-    coords = calc_offset_points(centre.galactic.l.value,
-                                centre.galactic.b.value, 0.03611, a, b, pa, islands)
-    ems = sgps.extract_spectra(coords, file_list)
-    print("Found {} emission points from {} coords for point l={}, b={}".format(len(ems), len(coords),
-                                                                                centre.galactic.l.value,
-                                                                                centre.galactic.b.value))
+    print("Found {} emission points for point l={}, b={}".format(len(ems), centre.galactic.l.value,
+                                                                 centre.galactic.b.value))
     if ems:
         all_em = np.array([ems[i].flux for i in range(len(ems))])
         em_std = np.std(all_em, axis=0)
@@ -655,6 +1144,46 @@ def get_emission_spectra(centre, velocities, file_list, filename_prefix, a, b, p
     return [], []
 
 
+def get_day_emission_spectra(day_dir_name, field_results, file_list, cube_pool=None):
+    """
+    Sample the SGPS emission around every source of the day. The offset points
+    for all sources are calculated together and all of the SGPS spectra are
+    extracted in a single batch. The mean and standard deviation of the
+    emission are added to each source's details as em_mean and em_std.
+
+    :param day_dir_name: The name of the day's directory.
+    :param field_results: The FieldResult for each field of the day
+    :param file_list: A list of dictionaries describing the SGPS files.
+    :param cube_pool: The pool of open SGPS cubes to sample the emission from.
+    :return: None
+    """
+    sources = []
+    source_islands = []
+    for result in field_results:
+        sources.extend(result.sources)
+        source_islands.extend([result.islands] * len(result.sources))
+    if len(sources) == 0:
+        return
+
+    centres = SkyCoord([src['pos'].icrs.ra.degree for src in sources],
+                       [src['pos'].icrs.dec.degree for src in sources], frame='icrs', unit="deg").galactic
+    g_l, g_b, found = calc_offset_points(centres.l.value, centres.b.value, 0.03611,
+                                         [src['a'] for src in sources], [src['b'] for src in sources],
+                                         [src['pa'] for src in sources], source_islands)
+    src_idx = np.where(found)[0]
+    ems = sgps.sample_spectra(g_l[found], g_b[found], file_list, cube_pool=cube_pool)
+
+    source_ems = [[] for i in range(len(sources))]
+    for i in range(len(ems)):
+        if ems[i] is not None:
+            source_ems[src_idx[i]].append(ems[i])
+
+    for i in range(len(sources)):
+        src = sources[i]
+        src['em_mean'], src['em_std'] = get_emission_spectra(src['pos'], src['spectrum'].velocity, source_ems[i],
+                                                             day_dir_name + "/" + src['name_prefix'])
+
+
 def calc_sigma_tau(cont_sd, em_mean, opacity):
     """
     Calculate the noise in the absorption profile at each velocity step. Where emission data is available, this is
@@ -674,8 +1203,195 @@ def calc_sigma_tau(cont_sd, em_mean, opacity):
     return sigma_tau
 
 
-def produce_spectra(day_dir_name, day, field_list, continuum_ranges):
+def prepare_field_spectra(day_dir_name, field, continuum_ranges):
+    """
+    Extract the spectra for each source in a field and convert them to opacity.
+
+    :param day_dir_name: The name of the day's directory.
+    :param field: The name of the field to be processed.
+    :param continuum_ranges: The predefined continuum blocks by longitude range
+    :return: A FieldResult with the details of each usable spectrum in the field.
+    """
+    result = FieldResult(field)
+    spectra, source_ids, islands = extract_spectra(day_dir_name, field, continuum_ranges)
+    result.islands = islands
+
+    for longitude in sorted(spectra.keys()):
+        spectrum = spectra.get(longitude)
+        src_data = source_ids.get(longitude)
+        name_prefix = field + '_src' + src_data['id']
+        mean, cont_sd, min_con_vel, max_con_vel = get_mean_continuum(
+            spectrum,
+            longitude.degree,
+            continuum_ranges)
+        if mean is None:
+            print("WARNING: Skipped spectrum %s with no continuum data" % (name_prefix, mean))
+            result.no_mean += 1
+            continue
+
+        if mean < 0:
+            print(("WARNING: Skipped spectrum %s with negative " +
+                  "mean: %.5f") % (name_prefix, mean))
+            result.neg_mean += 1
+            continue
+
+        spectrum_name = name_spectrum(src_data['pos'])
+        print('Continuum mean of %s (%s) is %.5f Jy, sd %.5f' % (
+            spectrum_name, name_prefix, mean, cont_sd))
+        result.cont_sd.append(cont_sd)
+
+        src_data['longitude'] = longitude
+        src_data['spectrum'] = spectrum
+        src_data['name_prefix'] = name_prefix
+        src_data['spectrum_name'] = spectrum_name
+        src_data['mean'] = mean
+        src_data['cont_sd'] = cont_sd
+        src_data['min_con_vel'] = min_con_vel
+        src_data['max_con_vel'] = max_con_vel
+        src_data['opacity'] = get_opacity(spectrum, mean)
+        src_data['temp_bright'] = get_temp_bright(spectrum, src_data['beam_area'])
+        result.sources.append(src_data)
+    return result
+
+
+def output_field_spectra(day_dir_name, result, write_votables=True, previews=True):
+    """
+    Plot and write out the spectra for each source in a field, once the
+    emission around each source is known.
+
+    :param day_dir_name: The name of the day's directory.
+    :param result: The FieldResult produced by prepare_field_spectra for the field.
+    :param write_votables: Should each spectrum be written to its own VOTable file.
+    :param previews: Should the absorption and emission previews be plotted.
+    :return: The FieldResult with the rows for the spectra index and opacity arrays added.
+    """
+    t = Template('<tr><td colspan=4><b>Field: ${field}</b></td></tr>\n' +
+                 '<tr><td>Image Name</td><td>Details</td>' +
+                 '<td>Absorption</td><td>Emission</td></tr>\n')
+    result.index_rows.append(t.substitute(field=result.field))
+    dir_prefix = day_dir_name + "/"
+
+    for src_data in result.sources:
+        spectrum = src_data['spectrum']
+        opacity = src_data['opacity']
+        name_prefix = src_data['name_prefix']
+        spectrum_name = src_data['spectrum_name']
+        min_con_vel = src_data['min_con_vel']
+        max_con_vel = src_data['max_con_vel']
+        em_mean = src_data['em_mean']
+        em_std = src_data['em_std']
+
+        # print opacity
+        sigma_tau = calc_sigma_tau(src_data['cont_sd'], em_mean, opacity)
+        src_data['sigma_tau'] = sigma_tau
+        img_name = name_prefix + "_plot.png"
+        em_img_name = name_prefix + "_emission.png"
+        if previews:
+            plot_previews(dir_prefix, name_prefix, spectrum_name, spectrum.velocity, opacity, sigma_tau, em_mean,
+                          em_std, min_con_vel, max_con_vel)
+        filename = dir_prefix + name_prefix + '_opacity.votable.xml'
+        latitude = src_data['pos'].galactic.b
+
+        if write_votables:
+            output_spectra(spectrum, opacity, filename, src_data['longitude'], latitude,
+                           em_mean, em_std, src_data['temp_bright'], src_data['beam_area'], sigma_tau)
+        result.opacity.append(opacity)
+
+        t = Template('<tr><td>${img}</td><td>${name}<br/>l:&nbsp;${longitude}<br/>' +
+                     'Peak:&nbsp;${peak_flux}&nbsp;Jy<br/>Mean:&nbsp;${mean}&nbsp;Jy<br/>'
+                     'Cont&nbsp;SD:&nbsp;${cont_sd}</td><td><a href="${img}">' +
+                     '<img src="${img}" width="500px"></a></td><td><a href="${em_img}">' +
+                     '<img src="${em_img}" width="500px"></a></td></tr>\n')
+        result.index_rows.append(t.substitute(img=img_name, em_img=em_img_name, peak_flux=src_data['flux'],
+                                              longitude=src_data['longitude'], mean=src_data['mean'],
+                                              cont_sd=src_data['cont_sd'], name=spectrum_name))
+    return result
+
+
+def _call_with_args(task):
+    """
+    Call a function with a tuple of arguments, used to run functions in worker processes.
+    """
+    return task[0](*task[1:])
+
+
+def map_fields(pool, tasks):
+    """
+    Run a set of field tasks, using the pool if there is one.
+
+    :param pool: The multiprocessing pool, or None to run the tasks in this process
+    :param tasks: A list of tuples of function and arguments
+    :return: The list of task results, in the same order as the tasks.
+    """
+    if pool is None:
+        return [_call_with_args(task) for task in tasks]
+    return pool.map(_call_with_args, tasks, chunksize=1)
+
+
+def write_spectra_store(day_dir_name, field_results):
+    """
+    Write the spectra of all fields of a day to the day's spectrum store.
+
+    :param day_dir_name: The name of the day's directory.
+    :param field_results: The list of FieldResult objects for the day, in field order.
+    :return: None
+    """
+    store_spectra = []
+    for result in field_results:
+        for src_data in result.sources:
+            spectrum = src_data['spectrum']
+            store_spectra.append({'field': result.field, 'source': src_data['id'],
+                                  'longitude': src_data['longitude'].value,
+                                  'latitude': src_data['pos'].galactic.b.value, 'beam_area': src_data['beam_area'],
+                                  'plane': spectrum.plane, 'velocity': spectrum.velocity,
+                                  'opacity': src_data['opacity'], 'flux': spectrum.flux,
+                                  'temp_brightness': src_data['temp_bright'], 'sigma_tau': src_data['sigma_tau'],
+                                  'em_mean': src_data['em_mean'], 'em_std': src_data['em_std']})
+    spectra_store.write_day_store(day_dir_name, store_spectra)
+
+
+def produce_spectra(day_dir_name, day, field_list, continuum_ranges, workers=1, write_votables=True,
+                    previews=True, max_open_cubes=None):
+    """
+    Produce the spectra for each of the fields of a day, along with an html
+    index of the spectra. The spectra of all fields are extracted first, then
+    the emission around all of the sources is sampled in one batch, and finally
+    the spectra are plotted and written out. Fields may be processed in
+    parallel, but the index is always written in field order. All of the
+    spectra of the day are also written to the day's spectrum store.
+
+    :param day_dir_name: The name of the day's directory.
+    :param day: The day number being analysed.
+    :param field_list: The list of fields to be processed.
+    :param continuum_ranges: The predefined continuum blocks by longitude range
+    :param workers: The number of processes to use to process the fields.
+    :param write_votables: Should each spectrum also be written to its own VOTable file.
+    :param previews: Should the previews of the spectra be plotted, they can be plotted later with --previews_only
+    :param max_open_cubes: The number of SGPS cubes to keep open, defaults to 1 when using more than one worker.
+    :return: A list of the opacity arrays produced.
+    """
     file_list = sgps.get_hi_file_list()
+    if max_open_cubes is None:
+        max_open_cubes = 1 if workers > 1 else 4
+    cube_pool = sgps.SgpsCubePool(max_open=max(1, max_open_cubes))
+    pool = None
+    if workers > 1 and len(field_list) > 1:
+        print ("Processing %d fields using %d workers" % (len(field_list), workers))
+        pool = multiprocessing.Pool(processes=min(workers, len(field_list)))
+    try:
+        field_results = map_fields(pool, [(prepare_field_spectra, day_dir_name, field, continuum_ranges)
+                                          for field in field_list])
+        get_day_emission_spectra(day_dir_name, field_results, file_list, cube_pool)
+        cube_pool.close()
+        field_results = map_fields(pool, [(output_field_spectra, day_dir_name, result, write_votables, previews)
+                                          for result in field_results])
+    finally:
+        cube_pool.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    write_spectra_store(day_dir_name, field_results)
+
     with open(day_dir_name + '/spectra.html', 'w') as spectra_idx:
         t = Template(
             '<html>\n<head><title>D$day Spectra</title></head>\n'
@@ -686,83 +1402,22 @@ def produce_spectra(day_dir_name, day, field_list, continuum_ranges):
         no_mean = 0
         all_cont_sd = []
         all_opacity = []
-        for field in field_list:
-            spectra, source_ids, islands = extract_spectra(day_dir_name, field, continuum_ranges)
-            t = Template('<tr><td colspan=4><b>Field: ${field}</b></td></tr>\n' +
-                         '<tr><td>Image Name</td><td>Details</td>' +
-                         '<td>Absorption</td><td>Emission</td></tr>\n')
-            spectra_idx.write(t.substitute(field=field))
-
-            idx = 0
-            for longitude in sorted(spectra.keys()):
-                spectrum = spectra.get(longitude)
-                src_data = source_ids.get(longitude)
-                name_prefix = field + '_src' + src_data['id']
-                idx += 1
-                mean, cont_sd, min_con_vel, max_con_vel = get_mean_continuum(
-                    spectrum,
-                    longitude.degree,
-                    continuum_ranges)
-                if mean is None:
-                    print("WARNING: Skipped spectrum %s with no continuum data" % (name_prefix, mean))
-                    no_mean += 1
-                    continue
-
-                if mean < 0:
-                    print(("WARNING: Skipped spectrum %s with negative " +
-                          "mean: %.5f") % (name_prefix, mean))
-                    neg_mean += 1
-                    continue
-
-                spectrum_name = name_spectrum(src_data['pos'])
-                print('Continuum mean of %s (%s) is %.5f Jy, sd %.5f' % (
-                    spectrum_name, name_prefix, mean, cont_sd))
-                all_cont_sd.append(cont_sd)
-                opacity = get_opacity(spectrum, mean)
-                temp_bright = get_temp_bright(spectrum, src_data['beam_area'])
-                dir_prefix = day_dir_name + "/"
-
-                em_mean, em_std = get_emission_spectra(src_data['pos'],
-                                                       spectrum.velocity,
-                                                       file_list, dir_prefix + name_prefix,
-                                                       src_data['a'], src_data['b'], src_data['pa'], islands)
-                # print opacity
-                sigma_tau = calc_sigma_tau(cont_sd, em_mean, opacity)
-                img_name = name_prefix + "_plot.png"
-                plot_spectrum(spectrum.velocity, opacity, dir_prefix + img_name,
-                              "Spectra for source {}".format(
-                                  spectrum_name), min_con_vel, max_con_vel, sigma_tau)
-                filename = dir_prefix + name_prefix + '_opacity.votable.xml'
-                latitude = src_data['pos'].galactic.b
-
-                em_img_name = name_prefix + "_emission.png"
-                plot_emission_spectrum(spectrum.velocity, em_mean, em_std,
-                                       dir_prefix + name_prefix + "_emission.png",
-                                       "Emission around {0}".format(
-                                           spectrum_name), min_con_vel,
-                                       max_con_vel)
-                output_spectra(spectrum, opacity, filename, longitude, latitude,
-                               em_mean, em_std, temp_bright, src_data['beam_area'], sigma_tau)
-                all_opacity.append(opacity)
-
-                t = Template('<tr><td>${img}</td><td>${name}<br/>l:&nbsp;${longitude}<br/>' +
-                             'Peak:&nbsp;${peak_flux}&nbsp;Jy<br/>Mean:&nbsp;${mean}&nbsp;Jy<br/>'
-                             'Cont&nbsp;SD:&nbsp;${cont_sd}</td><td><a href="${img}">' +
-                             '<img src="${img}" width="500px"></a></td><td><a href="${em_img}">' +
-                             '<img src="${em_img}" width="500px"></a></td></tr>\n')
-                spectra_idx.write(t.substitute(img=img_name, em_img=em_img_name, peak_flux=src_data['flux'],
-                                               longitude=longitude, mean=mean, cont_sd=cont_sd, name=spectrum_name))
-
+        for result in field_results:
+            spectra_idx.writelines(result.index_rows)
+            neg_mean += result.neg_mean
+            no_mean += result.no_mean
+            all_cont_sd.extend(result.cont_sd)
+            all_opacity.extend(result.opacity)
 
         spectra_idx.write('</table></body></html>\n')
 
-        if no_mean > 0:
-            print("Skipped %d spectra with no continuum data." % no_mean)
+    if no_mean > 0:
+        print("Skipped %d spectra with no continuum data." % no_mean)
 
-        print("Skipped %d spectra with negative mean continuum." % neg_mean)
-        print("Produced %d spectra with continuum sd of %.5f." % (
-            len(all_cont_sd), np.mean(all_cont_sd)))
-        return all_opacity
+    print("Skipped %d spectra with negative mean continuum." % neg_mean)
+    print("Produced %d spectra with continuum sd of %.5f." % (
+        len(all_cont_sd), np.mean(all_cont_sd)))
+    return all_opacity
 
 
 def main():
@@ -780,6 +1435,15 @@ def main():
     if not os.path.isdir(day_dir_name):
         print ("Directory %s could not be found." % day_dir_name)
         return 1
+    magmo.set_command_log(day_dir_name + '/commands.jsonl')
+
+    if args.previews_only:
+        if not spectra_store.has_day_store(day_dir_name):
+            print ("No spectrum store found for %s." % day_dir_name)
+            return 1
+        render_day_previews(day_dir_name, magmo.get_continuum_ranges(), workers=args.workers)
+        print ('Plotted previews in %.02f s' % (time.time() - start))
+        return 0
 
     print ("#### Started source finding on MAGMO day %s at %s ####" % \
           (day, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))))
@@ -790,12 +1454,14 @@ def main():
 
     # For each file, find the sources
     if not args.extract_only:
-        for field in field_list:
-            error_list.extend(find_sources(day_dir_name, field))
+        error_list.extend(find_all_sources(day_dir_name, field_list, args.cores, force=args.force_sources,
+                                           aegean_options=args.aegean_options, bane_options=args.bane_options))
 
     # For each file, extract spectra
     continuum_ranges = magmo.get_continuum_ranges()
-    produce_spectra(day_dir_name, day, field_list, continuum_ranges)
+    produce_spectra(day_dir_name, day, field_list, continuum_ranges, workers=args.workers,
+                    write_votables=not args.no_votables, previews=not args.no_previews,
+                    max_open_cubes=args.max_open_cubes)
 
     # Report
     end = time.time()
@@ -15,7 +15,10 @@ import argparse
 import csv
 import datetime
 import glob
+import hashlib
+import multiprocessing
 import os
+import pickle
 import re
 import time
 
@@ -24,12 +27,26 @@ from astropy.io import fits, votable
 from astropy.io.votable import parse, from_table, writeto
 from astropy.table import Table, Column
 import astropy.units as u
+from matplotlib.collections import LineCollection
+from matplotlib.colors import Normalize
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy import ma
 from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
 import magmo
+import spectra_store
+
+SPECTRA_CACHE_FILE = 'magmo-spectra-cache.pkl'
+SPECTRA_CACHE_VERSION = 2
+STORE_FINGERPRINT_FILES = ('index.npy', 'velocity.npy', 'opacity.npy')
+CACHED_METRICS = ('opacity_range', 'max_s_max_n', 'continuum_sd', 'rating', 'ra', 'dec', 'name')
+GASS_LV_FILE = 'gass-lv.fits'
+GASS_CONTOUR_CACHE_FILE = 'magmo-gass-contours.pkl'
+GASS_CONTOUR_CACHE_VERSION = 1
 
 
 class Field(object):
@@ -93,92 +110,472 @@ def parseargs():
     #                    default='magmo-spectra.vot')
     # parser.add_argument("--plot_only", help="Produce plots for the result of a previous decomposition", default=False,
     #                    action='store_true')
+    parser.add_argument("--workers", help="The number of processes to use to read the spectra", type=int,
+                        default=1)
+    parser.add_argument("--no_cache", help="Read all spectra without using or updating the spectra cache",
+                        default=False, action='store_true')
+    parser.add_argument("--lv_reduction", help="How to combine overlapping samples in the longitude-velocity image",
+                        choices=['last', 'mean', 'min', 'max'], default='last')
 
     args = parser.parse_args()
     return args
 
 
-def read_spectra():
+def read_spectra(workers=1, use_cache=True):
     """
-    Read in the spectra produced in earlier pipeline stages.
-
+    Read in the spectra produced in earlier pipeline stages. The spectra of
+    days with a spectrum store are read from the store, otherwise the spectra
+    are read from the per source VOTable files. The spectra are always
+    returned in file name order.
+
+    VOTable files which are unchanged since the previous run are not parsed
+    again, instead their contents and quality measures are taken from the
+    spectra cache. Spectra in a spectrum store are always read from the
+    memory mapped store, but their quality measures are also cached while the
+    store is unchanged.
+
+    :param workers: The number of processes to use to parse the VOTable files.
+    :param use_cache: Should the spectra cache be used and updated.
     :return: An array of Spectrum objects
     """
     spectra = []
+    spectrum_sources = []
+    continuum_ranges = magmo.get_continuum_ranges()
 
-    vo_files = glob.glob('day*/*_opacity.votable.xml')
-    print("Reading {} spectrum files.".format(len(vo_files)))
-    for filename in sorted(vo_files):
-        print ('Reading', filename)
-        votable = parse(filename, pedantic=False)
-        results = next(resource for resource in votable.resources if
-                       resource.type == "results")
-        if results is not None:
-            gal_long = None
-            gal_lat = None
-            for info in votable.infos:
-                if info.name == 'longitude':
-                    gal_long = float(info.value)
-                    if gal_long > 180:
-                        gal_long -= 360
-                if info.name == 'latitude':
-                    gal_lat = float(info.value)
-                if info.name == 'beam_area':
-                    beam_area = float(info.value)
-            if gal_long is None:
-                print("No longitude provided for %s, skipping" % filename)
-                continue
-            results_array = results.tables[0].array
-
-            velocities = np.zeros(len(results_array))
-            opacities = np.zeros(len(results_array))
-            fluxes = np.zeros(len(results_array))
-            em_temps = np.zeros(len(results_array))
-            em_std = np.zeros(len(results_array))
-            i = 0
-            for row in results_array:
-                opacity = row['opacity']
-                velocities[i] = row['velocity'] / 1000.0
-                opacities[i] = opacity
-                fluxes[i] = row['flux']
-                if 'em_mean' in results_array.dtype.names:
-                    em_temps[i] = row['em_mean']
-                if 'em_std' in results_array.dtype.names:
-                    em_std[i] = row['em_std']
-                i += 1
-            field = filename.split('_')
-            parts = field[0].split('/')
-            spectrum = Spectrum(str(parts[0][3:]), parts[1], field[1][3:],
-                                gal_long, gal_lat, velocities, opacities,
-                                fluxes)
-            min_opacity = np.min(spectrum.opacities)
-            max_opacity = np.max(spectrum.opacities)
-
-            continuum_ranges = magmo.get_continuum_ranges()
-
-            opacity_range = max_opacity - min_opacity
-            max_s_max_n = (1 - min_opacity) / (max_opacity - 1)
-            continuum_sd = calc_continuum_sd(spectrum, continuum_ranges)
-            rating = calc_rating(opacity_range, max_s_max_n, continuum_sd, em_std)
-
-            loc = SkyCoord(gal_long, gal_lat, frame='galactic', unit="deg")
-            spectrum.loc = loc
-            spectrum.ra = loc.icrs.ra.degree
-            spectrum.dec = loc.icrs.dec.degree
-            spectrum.name = name_spectrum(loc)
-
-            spectrum.opacity_range = opacity_range
-            spectrum.max_s_max_n = max_s_max_n
-            spectrum.continuum_sd = continuum_sd
-            spectrum.rating = rating
-            spectrum.beam_area = beam_area
-            spectrum.em_temps = em_temps
-            spectrum.em_std = em_std
-            spectra.append(spectrum)
-
+    stored_days = set()
+    for day_dir_name in glob.glob('day*'):
+        if spectra_store.has_day_store(day_dir_name):
+            stored_days.add(day_dir_name)
+            store = spectra_store.open_day_store(day_dir_name)
+            for row in range(len(store)):
+                spectrum_sources.append((store.get_votable_filename(row), store, row))
+    for filename in glob.glob('day*/*_opacity.votable.xml'):
+        if filename.split('/')[0] not in stored_days:
+            spectrum_sources.append((filename, None, None))
+
+    print("Reading {} spectra, {} days from spectrum stores.".format(len(spectrum_sources), len(stored_days)))
+    spectrum_sources.sort(key=lambda spectrum_source: spectrum_source[0])
+    votable_files = [filename for filename, store, row in spectrum_sources if store is None]
+    if use_cache:
+        cache = read_spectra_cache(continuum_ranges)
+        cache_entries, changed_files, cache_changed = check_spectra_cache(votable_files, cache['entries'])
+        store_metrics, stores_changed = check_store_caches(stored_days, cache['stores'])
+        cache_changed = cache_changed or stores_changed
+    else:
+        # Without the cache there is no need to fingerprint the files
+        cache_entries = dict((filename, {}) for filename in votable_files)
+        changed_files = votable_files
+        store_metrics = dict((day_dir_name, {}) for day_dir_name in stored_days)
+        cache_changed = False
+    votable_payloads = read_votable_payloads(changed_files, workers)
+    for filename in changed_files:
+        cache_entries[filename]['payload'] = votable_payloads[filename]
+
+    unrated = []
+    unrated_entries = []
+    cached = []
+    cached_entries = []
+    for filename, store, row in spectrum_sources:
+        if store is not None:
+            spectrum = read_stored_spectrum(filename, store, row)
+            entry = store_metrics[store.day_dir_name].setdefault(filename, {})
+        else:
+            entry = cache_entries[filename]
+            spectrum = build_votable_spectrum(filename, entry['payload'])
+        if spectrum is None:
+            continue
+        spectra.append(spectrum)
+        if entry is not None and 'rating' in entry:
+            cached.append(spectrum)
+            cached_entries.append(entry)
+        else:
+            unrated.append(spectrum)
+            unrated_entries.append(entry)
+    print("Using cached quality measures for %d of %d spectra" % (len(cached), len(spectra)))
+
+    rate_spectra(unrated, continuum_ranges)
+    apply_cached_metrics(cached, cached_entries)
+    if use_cache:
+        for spectrum, entry in zip(unrated, unrated_entries):
+            entry.update((key, getattr(spectrum, key)) for key in CACHED_METRICS)
+        if cache_changed or len(unrated) > 0:
+            write_spectra_cache(cache_entries, build_store_cache(stored_days, cache['stores'], store_metrics),
+                                continuum_ranges)
     return spectra
 
 
+def get_file_fingerprint(filename, cached_entry=None):
+    """
+    Identify the version of a file by its modification time, size and a hash
+    of its content. The hash is only calculated when the time or size differs
+    from the cached entry for the file.
+
+    :param filename: The name of the file.
+    :param cached_entry: The cache entry for the file from a previous run, if any.
+    :return: A dictionary with the mtime, size and hash of the file.
+    """
+    stat = os.stat(filename)
+    fingerprint = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    if cached_entry is not None and cached_entry['mtime'] == stat.st_mtime and cached_entry['size'] == stat.st_size:
+        fingerprint['hash'] = cached_entry['hash']
+    else:
+        with open(filename, 'rb') as in_file:
+            fingerprint['hash'] = hashlib.sha1(in_file.read()).hexdigest()
+    return fingerprint
+
+
+def check_spectra_cache(filenames, old_entries):
+    """
+    Compare a list of spectrum files with the cache from the previous run.
+    Entries for files which no longer exist are dropped.
+
+    :param filenames: The list of VOTable files to be read.
+    :param old_entries: The cache entries from the previous run, keyed by file name.
+    :return: The cache entries for the files, the list of files which are new or have changed, and a flag which is
+             True if the cache needs to be written out again.
+    """
+    entries = {}
+    changed_files = []
+    touched = 0
+    for filename in filenames:
+        cached_entry = old_entries.get(filename)
+        fingerprint = get_file_fingerprint(filename, cached_entry)
+        if cached_entry is not None and cached_entry['hash'] == fingerprint['hash']:
+            if cached_entry['mtime'] != fingerprint['mtime'] or cached_entry['size'] != fingerprint['size']:
+                touched += 1
+            cached_entry.update(fingerprint)
+            entries[filename] = cached_entry
+        else:
+            entries[filename] = fingerprint
+            changed_files.append(filename)
+
+    evicted = len(set(old_entries.keys()) - set(entries.keys()))
+    print("%d of %d spectrum files unchanged, %d removed since the last run" % (
+        len(filenames) - len(changed_files), len(filenames), evicted))
+    return entries, changed_files, len(changed_files) > 0 or evicted > 0 or touched > 0
+
+
+def check_store_caches(day_dir_names, old_stores):
+    """
+    Compare the spectrum stores of each day with the cache from the previous
+    run. The cached quality measures of a day are kept only if its store is
+    unchanged.
+
+    :param day_dir_names: The names of the days with a spectrum store.
+    :param old_stores: The cached details of each day's store from the previous run, keyed by day directory name.
+    :return: The cached quality measures for each day, keyed by day directory name, and a flag which is True if the
+             cache needs to be written out again.
+    """
+    metrics = {}
+    changed = len(set(old_stores.keys()) - set(day_dir_names)) > 0
+    for day_dir_name in day_dir_names:
+        old_store = old_stores.get(day_dir_name)
+        fingerprint = get_store_fingerprint(day_dir_name, old_store['fingerprint'] if old_store else None)
+        if old_store is not None and all(old_store['fingerprint'][name]['hash'] == fingerprint[name]['hash']
+                                         for name in STORE_FINGERPRINT_FILES):
+            metrics[day_dir_name] = old_store['metrics']
+            changed = changed or old_store['fingerprint'] != fingerprint
+            old_store['fingerprint'] = fingerprint
+        else:
+            metrics[day_dir_name] = {}
+            old_stores[day_dir_name] = {'fingerprint': fingerprint, 'metrics': {}}
+            changed = True
+    return metrics, changed
+
+
+def get_store_fingerprint(day_dir_name, cached_fingerprint=None):
+    """
+    Identify the version of a day's spectrum store by the fingerprints of the files the quality measures depend on.
+
+    :param day_dir_name: The name of the day's directory.
+    :param cached_fingerprint: The store's fingerprint from the previous run, if any.
+    :return: A dictionary of the fingerprint of each file, keyed by file name.
+    """
+    folder = spectra_store.get_store_folder(day_dir_name)
+    return dict((name, get_file_fingerprint(os.path.join(folder, name),
+                                            cached_fingerprint.get(name) if cached_fingerprint else None))
+                for name in STORE_FINGERPRINT_FILES)
+
+
+def build_store_cache(day_dir_names, stores, store_metrics):
+    """
+    Build the store section of the spectra cache.
+
+    :param day_dir_names: The names of the days with a spectrum store.
+    :param stores: The details of each day's store, including its fingerprint, keyed by day directory name.
+    :param store_metrics: The quality measures of each day's spectra, keyed by day directory name.
+    :return: The details of each current store, keyed by day directory name.
+    """
+    return dict((day_dir_name, {'fingerprint': stores[day_dir_name]['fingerprint'],
+                                'metrics': store_metrics[day_dir_name]}) for day_dir_name in day_dir_names)
+
+
+def read_spectra_cache(continuum_ranges):
+    """
+    Read in the spectra cache from the previous run. The cache is discarded if
+    it was produced with a different version or different continuum ranges.
+
+    :param continuum_ranges: The defined continuum ranges
+    :return: The cache, with the VOTable entries keyed by file name and the store details keyed by day directory name.
+    """
+    empty_cache = {'entries': {}, 'stores': {}}
+    if not os.path.exists(SPECTRA_CACHE_FILE):
+        return empty_cache
+    try:
+        with open(SPECTRA_CACHE_FILE, 'rb') as cache_file:
+            cache = pickle.load(cache_file)
+    except Exception as ex:
+        print("Unable to read %s, ignoring it: %s" % (SPECTRA_CACHE_FILE, ex))
+        return empty_cache
+    if cache.get('version') != SPECTRA_CACHE_VERSION or cache.get('continuum_ranges') != continuum_ranges:
+        print("Spectra cache is out of date, ignoring it")
+        return empty_cache
+    return cache
+
+
+def write_spectra_cache(entries, stores, continuum_ranges):
+    """
+    Write out the spectra cache for use by the next run.
+
+    :param entries: The cache entries for the VOTable files, keyed by file name.
+    :param stores: The cached details of each spectrum store, keyed by day directory name.
+    :param continuum_ranges: The defined continuum ranges
+    :return: None
+    """
+    cache = {'version': SPECTRA_CACHE_VERSION, 'continuum_ranges': continuum_ranges, 'entries': entries,
+             'stores': stores}
+    temp_filename = SPECTRA_CACHE_FILE + '.tmp'
+    with open(temp_filename, 'wb') as cache_file:
+        pickle.dump(cache, cache_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_filename, SPECTRA_CACHE_FILE)
+
+
+def apply_cached_metrics(spectra, entries):
+    """
+    Set the quality measures and position of each spectrum from the values
+    held in the spectra cache.
+
+    :param spectra: The list of Spectrum objects.
+    :param entries: The cache entry for each spectrum.
+    :return: None
+    """
+    if len(spectra) == 0:
+        return
+    locs = SkyCoord([spectrum.longitude for spectrum in spectra], [spectrum.latitude for spectrum in spectra],
+                    frame='galactic', unit="deg")
+    for i in range(len(spectra)):
+        spectra[i].loc = locs[i]
+        for key in CACHED_METRICS:
+            setattr(spectra[i], key, entries[i][key])
+
+
+def read_stored_spectrum(filename, store, row):
+    """
+    Read in a spectrum from a day's spectrum store.
+
+    :param filename: The name of the VOTable file that the spectrum would have been written to.
+    :param store: The DayStore holding the spectrum.
+    :param row: The position of the spectrum in the store.
+    :return: The Spectrum object
+    """
+    details = store.index[row]
+    gal_long = float(details['longitude'])
+    if gal_long > 180:
+        gal_long -= 360
+    columns = store.spectrum(row)
+    return build_spectrum(filename, gal_long, float(details['latitude']), float(details['beam_area']),
+                          columns['velocity'] / 1000.0, columns['opacity'], columns['flux'], columns['em_mean'],
+                          columns['em_std'])
+
+
+def read_votable_payloads(filenames, workers=1):
+    """
+    Parse a list of spectrum VOTable files, spreading the work across a pool
+    of processes if more than one worker is requested. Progress is reported
+    as the files are read.
+
+    :param filenames: The list of VOTable files to be read.
+    :param workers: The number of processes to use.
+    :return: A dictionary of the payload of each file, keyed by file name.
+    """
+    payloads = {}
+    if len(filenames) == 0:
+        return payloads
+
+    start = time.time()
+    pool = None
+    if workers > 1 and len(filenames) > 1:
+        print("Parsing %d spectrum files using %d workers" % (len(filenames), workers))
+        pool = multiprocessing.Pool(processes=min(workers, len(filenames)))
+        results = pool.imap(read_votable_payload, filenames, chunksize=16)
+    else:
+        results = (read_votable_payload(filename) for filename in filenames)
+    try:
+        for i, payload in enumerate(results):
+            payloads[filenames[i]] = payload
+            if (i + 1) % 1000 == 0 or i + 1 == len(filenames):
+                elapsed = max(time.time() - start, 1e-6)
+                print("Read %d of %d spectrum files, %.1f files/s" % (i + 1, len(filenames), (i + 1) / elapsed))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return payloads
+
+
+def build_votable_spectrum(filename, payload):
+    """
+    Create a Spectrum object from the payload read from a VOTable file.
+
+    :param filename: The name of the VOTable file.
+    :param payload: The payload produced by read_votable_payload for the file.
+    :return: The Spectrum object, or None if the spectrum could not be read.
+    """
+    if payload is None:
+        return None
+    gal_long, gal_lat, beam_area, columns = payload
+    return build_spectrum(filename, gal_long, gal_lat, beam_area, columns[0], columns[1], columns[2], columns[3],
+                          columns[4])
+
+
+def read_votable_payload(filename):
+    """
+    Read in a spectrum from its VOTable file. This is run in the worker
+    processes, so the spectrum is returned as plain values and a single array
+    which are cheap to send back.
+
+    :param filename: The name of the VOTable file.
+    :return: A tuple of longitude, latitude, beam area and a 2D array of the
+             velocity, opacity, flux, em_mean and em_std columns, or None if the
+             spectrum could not be read.
+    """
+    votable = parse(filename, pedantic=False)
+    results = next(resource for resource in votable.resources if
+                   resource.type == "results")
+    if results is None:
+        return None
+    gal_long = None
+    gal_lat = None
+    for info in votable.infos:
+        if info.name == 'longitude':
+            gal_long = float(info.value)
+            if gal_long > 180:
+                gal_long -= 360
+        if info.name == 'latitude':
+            gal_lat = float(info.value)
+        if info.name == 'beam_area':
+            beam_area = float(info.value)
+    if gal_long is None:
+        print("No longitude provided for %s, skipping" % filename)
+        return None
+    results_array = results.tables[0].array
+
+    columns = np.vstack((read_votable_column(results_array, 'velocity') / 1000.0,
+                         read_votable_column(results_array, 'opacity'),
+                         read_votable_column(results_array, 'flux'),
+                         read_votable_column(results_array, 'em_mean'),
+                         read_votable_column(results_array, 'em_std')))
+    return gal_long, gal_lat, beam_area, columns
+
+
+def read_votable_column(results_array, name):
+    """
+    Extract a column from a VOTable's results as a float array. Masked values
+    are replaced by 0, as is the whole column if it is not present.
+
+    :param results_array: The array of results from the VOTable.
+    :param name: The name of the column.
+    :return: A numpy array of the column's values.
+    """
+    if name not in results_array.dtype.names:
+        return np.zeros(len(results_array))
+    return np.ma.filled(results_array[name], 0).astype(float)
+
+
+def build_spectrum(filename, gal_long, gal_lat, beam_area, velocities, opacities, fluxes, em_temps, em_std):
+    """
+    Create a Spectrum object from the arrays of a spectrum. The quality
+    measures of the spectrum are set later by rate_spectra.
+
+    :param filename: The name of the spectrum's VOTable file, which identifies the day, field and source.
+    :param gal_long: The galactic longitude of the source, in the range -180 to 180 degrees.
+    :param gal_lat: The galactic latitude of the source in degrees.
+    :param beam_area: The area of the beam in radians^2
+    :param velocities: The velocity of each channel in km/s
+    :param opacities: The opacity in each channel
+    :param fluxes: The flux in each channel
+    :param em_temps: The mean emission brightness temperature in each channel
+    :param em_std: The standard deviation of the emission in each channel
+    :return: The Spectrum object
+    """
+    field = filename.split('_')
+    parts = field[0].split('/')
+    spectrum = Spectrum(str(parts[0][3:]), parts[1], field[1][3:],
+                        gal_long, gal_lat, velocities, opacities,
+                        fluxes)
+    spectrum.beam_area = beam_area
+    spectrum.em_temps = em_temps
+    spectrum.em_std = em_std
+    return spectrum
+
+
+def pad_spectra(arrays):
+    """
+    Combine a list of arrays of varying length into a 2D array, padding the
+    end of the shorter arrays with NaN.
+
+    :param arrays: The list of 1D arrays
+    :return: A 2D array with a row for each of the arrays.
+    """
+    max_len = max(len(array) for array in arrays)
+    padded = np.full((len(arrays), max_len), np.nan)
+    for i in range(len(arrays)):
+        padded[i, :len(arrays[i])] = arrays[i]
+    return padded
+
+
+def rate_spectra(spectra, continuum_ranges):
+    """
+    Calculate the quality measures and rating of each spectrum, along with
+    its position. All spectra are processed together as a 2D array.
+
+    :param spectra: The list of Spectrum objects to be rated.
+    :param continuum_ranges: The defined continuum ranges
+    :return: None
+    """
+    if len(spectra) == 0:
+        return
+
+    velocities = pad_spectra([spectrum.velocity for spectrum in spectra])
+    opacities = pad_spectra([spectrum.opacities for spectrum in spectra])
+    longitudes = np.array([spectrum.longitude for spectrum in spectra])
+    latitudes = np.array([spectrum.latitude for spectrum in spectra])
+
+    min_opacity = np.nanmin(opacities, axis=1)
+    max_opacity = np.nanmax(opacities, axis=1)
+    opacity_range = max_opacity - min_opacity
+    with np.errstate(divide='ignore', invalid='ignore'):
+        max_s_max_n = (1 - min_opacity) / (max_opacity - 1)
+    continuum_sd = calc_continuum_sd(velocities, opacities, longitudes, continuum_ranges)
+    ratings = calc_rating(opacity_range, max_s_max_n, continuum_sd)
+
+    locs = SkyCoord(longitudes, latitudes, frame='galactic', unit="deg")
+    ras = locs.icrs.ra.degree
+    decs = locs.icrs.dec.degree
+
+    for i in range(len(spectra)):
+        spectrum = spectra[i]
+        spectrum.loc = locs[i]
+        spectrum.ra = ras[i]
+        spectrum.dec = decs[i]
+        spectrum.name = name_spectrum(spectrum.loc)
+
+        spectrum.opacity_range = opacity_range[i]
+        spectrum.max_s_max_n = max_s_max_n[i]
+        spectrum.continuum_sd = continuum_sd[i]
+        spectrum.rating = str(ratings[i])
+
+
 def name_spectrum(loc):
     precision = 1000
     glong = (loc.galactic.l.degree * precision // 1) / precision
@@ -225,39 +622,69 @@ def read_field_stats():
     return fields
 
 
-def extract_lv(spectra, min_rating='C'):
-    x = []
-    y = []
-    c = []
-    bad_spectra = 0
-    duplicate_spectra = 0
-    prev_field = ''
-    num_fields = 0
-    used_fields = []
+class LVSamples(object):
+    """
+    The longitude, velocity and opacity of every channel of a set of spectra.
+    The channels of each spectrum are held end to end in preallocated arrays,
+    so that subsets of the spectra can be selected with a mask rather than by
+    rebuilding the arrays.
+    """
 
-    for spectrum in spectra:
-        opacities = spectrum.opacities
-        if spectrum.rating > min_rating:
-            bad_spectra += 1
-            spectrum.low_sn = True
-            continue
-        if spectrum.duplicate:
-            duplicate_spectra += 1
-            continue
-        y = np.concatenate((y, spectrum.velocity))
-        c = np.concatenate((c, opacities))
-        x = np.concatenate((x, np.full(len(opacities), spectrum.longitude)))
-        field_id = spectrum.get_field_id()
+    def __init__(self, spectra):
+        lengths = np.array([len(spectrum.opacities) for spectrum in spectra], dtype=int)
+        total = int(np.sum(lengths))
+        self.x = np.empty(total)
+        self.y = np.empty(total)
+        self.c = np.empty(total)
+        self.spectrum_idx = np.repeat(np.arange(len(spectra)), lengths)
+        self.ratings = np.array([spectrum.rating for spectrum in spectra])
+        self.field_ids = [spectrum.get_field_id() for spectrum in spectra]
+
+        pos = 0
+        for i in range(len(spectra)):
+            spectrum = spectra[i]
+            end = pos + lengths[i]
+            self.x[pos:end] = spectrum.longitude
+            self.y[pos:end] = spectrum.velocity
+            self.c[pos:end] = spectrum.opacities
+            pos = end
+
+
+def extract_lv(spectra, min_rating='C', samples=None):
+    """
+    Select the longitude, velocity and opacity of each channel of the spectra
+    which are good enough to be included in the longitude-velocity diagrams.
+    Spectra rated below the minimum are flagged as low_sn.
+
+    :param spectra: The list of spectra.
+    :param min_rating: The lowest rating of the spectra to be included.
+    :param samples: The LVSamples for the spectra, so that repeated calls can share the one set of arrays.
+    :return: The x (longitude), y (velocity) and c (opacity) arrays, and the list of ids of the fields used.
+    """
+    if samples is None:
+        samples = LVSamples(spectra)
+    good = samples.ratings <= min_rating
+    duplicate = np.array([bool(spectrum.duplicate) for spectrum in spectra], dtype=bool)
+    used = good & ~duplicate
+    for i in np.where(~good)[0]:
+        spectra[i].low_sn = True
+
+    used_fields = []
+    prev_field = ''
+    for i in np.where(used)[0]:
+        field_id = samples.field_ids[i]
         if field_id != prev_field:
             prev_field = field_id
             used_fields.append(field_id)
-            num_fields += 1
 
+    bad_spectra = int(np.sum(~good))
+    duplicate_spectra = int(np.sum(good & duplicate))
     print("In %d fields read %d spectra of which %d had reasonable S/N and %d were duplicates, leaving %d to plot. " % (
-        num_fields, len(spectra), len(spectra) - bad_spectra, duplicate_spectra,
+        len(used_fields), len(spectra), len(spectra) - bad_spectra, duplicate_spectra,
         len(spectra) - bad_spectra - duplicate_spectra))
 
-    return x, y, c, used_fields
+    sample_mask = used[samples.spectrum_idx]
+    return samples.x[sample_mask], samples.y[sample_mask], samples.c[sample_mask], used_fields
 
 
 def plot_lv(x, y, c, filename, continuum_ranges, zoom):
@@ -362,7 +789,203 @@ def get_lv_subset(data, header, l_min, l_max, v_min, v_max):
     return data[v_start:v_end, l_start:l_end]
 
 
-def plot_lv_image(x, y, c, filename):
+class LVGrid(object):
+    """
+    The extents and resolution of a longitude-velocity raster. Longitude
+    decreases across each row, as is conventional for galactic plots, and
+    velocity decreases down the raster. The default resolution matches that
+    of the GASS III longitude-velocity slice.
+    """
+
+    def __init__(self, l_min=-120, l_max=30, l_step=0.08, v_min=-300, v_max=300, v_step=0.8245):
+        self.l_min = l_min
+        self.l_max = l_max
+        self.l_step = l_step
+        self.v_min = v_min
+        self.v_max = v_max
+        self.v_step = v_step
+        self.l_size = int((l_max - l_min) / l_step)
+        self.v_size = int((v_max - v_min) / v_step)
+
+    def get_key(self):
+        """
+        Get a string which uniquely identifies the extents and resolution of the grid.
+        """
+        return "l%g_%g_%g-v%g_%g_%g" % (self.l_min, self.l_max, self.l_step, self.v_min, self.v_max, self.v_step)
+
+
+def build_lv_raster(x, y, c, grid, reduction='last', strip_width=7):
+    """
+    Rasterise a set of longitude-velocity samples onto a grid. Each sample is
+    drawn as a horizontal strip of pixels, centred on the pixel containing the
+    sample. Where more than one sample covers a pixel the values are combined
+    using the reduction. Samples outside of the grid are ignored.
+
+    :param x: The longitude of each sample in degrees.
+    :param y: The velocity of each sample in km/s.
+    :param c: The value of each sample.
+    :param grid: The LVGrid defining the raster.
+    :param reduction: How to combine overlapping samples, one of last (the
+        last sample in the list is kept), mean, min or max.
+    :param strip_width: The width in pixels of the strip drawn for each sample.
+    :return: A masked array of shape (v_size, l_size) with pixels not covered by any sample masked. The masked pixels
+             have a value of 1 (no absorption).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    c = np.asarray(c, dtype=float)
+    keep = np.isfinite(x) & np.isfinite(y) & np.isfinite(c)
+    x, y, c = x[keep], y[keep], c[keep]
+
+    cols = grid.l_size - 1 - np.floor((x - grid.l_min) / grid.l_step).astype(int)
+    rows = grid.v_size - 1 - np.floor((y - grid.v_min) / grid.v_step).astype(int)
+
+    # Expand each sample into its strip, keeping the samples in their original order
+    offsets = np.arange(strip_width) - strip_width // 2
+    cols = (cols[:, np.newaxis] + offsets).ravel()
+    rows = np.repeat(rows, strip_width)
+    vals = np.repeat(c, strip_width)
+    in_grid = (cols >= 0) & (cols < grid.l_size) & (rows >= 0) & (rows < grid.v_size)
+    pixels = rows[in_grid] * grid.l_size + cols[in_grid]
+    vals = vals[in_grid]
+
+    size = grid.v_size * grid.l_size
+    counts = np.bincount(pixels, minlength=size)
+    data = np.ones(size)
+    if reduction == 'last':
+        # The first occurrence in the reversed list is the last sample for each pixel
+        covered, first = np.unique(pixels[::-1], return_index=True)
+        data[covered] = vals[::-1][first]
+    elif reduction == 'mean':
+        sums = np.bincount(pixels, weights=vals, minlength=size)
+        covered = counts > 0
+        data[covered] = sums[covered] / counts[covered]
+    elif reduction in ('min', 'max'):
+        ufunc = np.minimum if reduction == 'min' else np.maximum
+        reduced = np.full(size, np.inf if reduction == 'min' else -np.inf)
+        ufunc.at(reduced, pixels, vals)
+        covered = counts > 0
+        data[covered] = reduced[covered]
+    else:
+        raise ValueError("Unknown reduction " + reduction)
+
+    return ma.array(data.reshape(grid.v_size, grid.l_size), mask=(counts == 0).reshape(grid.v_size, grid.l_size))
+
+
+def write_lv_fits(raster, grid, filename):
+    """
+    Write out a longitude-velocity raster as a FITS image. The velocity axis is
+    in m/s, matching the GASS III slice, and increases up the image. Pixels with
+    no data are written as NaN.
+
+    :param raster: The masked array produced by build_lv_raster.
+    :param grid: The LVGrid used to build the raster.
+    :param filename: The name of the FITS file to be written.
+    :return: None
+    """
+    header = fits.Header()
+    header['CTYPE1'] = 'GLON'
+    header['CUNIT1'] = 'deg'
+    header['CRPIX1'] = 1
+    header['CRVAL1'] = grid.l_min + (grid.l_size - 0.5) * grid.l_step
+    header['CDELT1'] = -grid.l_step
+    header['CTYPE2'] = 'VELO-LSR'
+    header['CUNIT2'] = 'm/s'
+    header['CRPIX2'] = 1
+    header['CRVAL2'] = (grid.v_min + 0.5 * grid.v_step) * 1000
+    header['CDELT2'] = grid.v_step * 1000
+    header['SPECSYS'] = 'LSRK'
+    header['BUNIT'] = ''
+    header['OBJECT'] = 'MAGMO HI absorption (e^-tau)'
+    hdu = fits.PrimaryHDU(np.flipud(raster.filled(np.nan)), header=header)
+    hdu.writeto(filename, overwrite=True)
+    print("Wrote", grid.l_size, "x", grid.v_size, "longitude-velocity image to", filename)
+
+
+def calc_gass_contours(grid):
+    """
+    Contour the GASS III emission over the extent of a longitude-velocity grid.
+
+    :param grid: The LVGrid the contours will be plotted on.
+    :return: A dictionary of the shape of the GASS subset, the contour levels and the list of line segments (arrays
+             of x, y vertices) for each level.
+    """
+    gass_lv = fits.open(GASS_LV_FILE)
+    gass_subset = get_lv_subset(gass_lv[0].data, gass_lv[0].header, grid.l_min,
+                                grid.l_max, grid.v_min * 1000,
+                                grid.v_max * 1000)
+    fig = plt.figure()
+    contours = fig.gca().contour(np.log10(np.flipud(gass_subset)), 1)
+    layer = {'shape': gass_subset.shape, 'levels': [float(level) for level in contours.levels],
+             'segments': [[np.array(segment) for segment in segments] for segments in contours.allsegs]}
+    plt.close(fig)
+    gass_lv.close()
+    return layer
+
+
+def get_gass_contours(grid):
+    """
+    Retrieve the contours of the GASS III emission for a longitude-velocity
+    grid. The contours for each grid are kept in a sidecar file, keyed by the
+    grid's extents and resolution, and are only recalculated if the GASS slice
+    has changed.
+
+    :param grid: The LVGrid the contours will be plotted on.
+    :return: The contour layer, as produced by calc_gass_contours
+    """
+    cache = {}
+    if os.path.exists(GASS_CONTOUR_CACHE_FILE):
+        try:
+            with open(GASS_CONTOUR_CACHE_FILE, 'rb') as cache_file:
+                cache = pickle.load(cache_file)
+        except Exception as ex:
+            print("Unable to read %s, ignoring it: %s" % (GASS_CONTOUR_CACHE_FILE, ex))
+    if cache.get('version') != GASS_CONTOUR_CACHE_VERSION:
+        cache = {'version': GASS_CONTOUR_CACHE_VERSION, 'fingerprint': None, 'layers': {}}
+
+    changed = False
+    if os.path.exists(GASS_LV_FILE):
+        fingerprint = get_file_fingerprint(GASS_LV_FILE, cache['fingerprint'])
+        if cache['fingerprint'] is None or cache['fingerprint']['hash'] != fingerprint['hash']:
+            cache['layers'] = {}
+        changed = cache['fingerprint'] != fingerprint
+        cache['fingerprint'] = fingerprint
+
+    key = grid.get_key()
+    layer = cache['layers'].get(key)
+    if layer is None:
+        print("Calculating GASS contours for grid", key)
+        layer = calc_gass_contours(grid)
+        cache['layers'][key] = layer
+        changed = True
+
+    if changed:
+        temp_filename = GASS_CONTOUR_CACHE_FILE + '.tmp'
+        with open(temp_filename, 'wb') as cache_file:
+            pickle.dump(cache, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, GASS_CONTOUR_CACHE_FILE)
+    return layer
+
+
+def plot_gass_contours(ax, layer, cmap_name):
+    """
+    Draw a precalculated contour layer onto a set of axes.
+
+    :param ax: The axes to draw on.
+    :param layer: The contour layer, as produced by calc_gass_contours
+    :param cmap_name: The name of the colour map used to colour the contour levels.
+    :return: None
+    """
+    cmap = plt.get_cmap(cmap_name)
+    levels = layer['levels']
+    norm = Normalize(min(levels), max(levels))
+    for level, segments in zip(levels, layer['segments']):
+        if len(segments) > 0:
+            ax.add_collection(LineCollection(segments, colors=[cmap(norm(level))]))
+    ax.autoscale_view(tight=True)
+
+
+def plot_lv_image(x, y, c, filename, grid=None, reduction='last', fits_filename=None):
     """
     Output a longitude-velocity plot of the provided data with the outline of
     emission from the GASS III dataset plotted over the data.
@@ -371,38 +994,31 @@ def plot_lv_image(x, y, c, filename):
     :param y: The velocity value of each data point.
     :param c: The optical depth value of each data point.
     :param filename: The file name of the plot.
+    :param grid: The LVGrid to plot the data on, defaults to l -120 to 30 and v -300 to 300 km/s.
+    :param reduction: How to combine overlapping data points, see build_lv_raster.
+    :param fits_filename: The name of a FITS file to write the raster to, if any.
     :return: None
     """
-    # Image dimensions
-    l_max = 30
-    l_min = -120
-    l_dpd = 1 / 0.08
-    l_size = int((l_max - l_min) * l_dpd)
-    v_max = 300
-    v_min = -300
-    v_dpkms = 1 / 0.8245
-    v_size = int((v_max - v_min) * v_dpkms)
-
-    val = np.clip(c, -0.005, 1.05)
+    if grid is None:
+        grid = LVGrid()
+    l_min = grid.l_min
+    l_max = grid.l_max
+    v_min = grid.v_min
+    v_max = grid.v_max
+
+    raster = build_lv_raster(x, y, c, grid, reduction=reduction)
+    if fits_filename:
+        write_lv_fits(raster, grid, fits_filename)
+    data = ma.clip(raster, -0.005, 1.05)
 
     plt.rcParams['xtick.direction'] = 'out'
     plt.rcParams['ytick.direction'] = 'out'
 
-    dots_per_degree = l_dpd  # 4*3
-    data = ma.array(np.ones((v_size, l_size)), mask=True)
-    # print(data)
-    xmax = data.shape[1]
-    ymax = data.shape[0]
-    for i in range(0, len(x)):
-        x_idx = xmax - int((x[i] - l_min) * dots_per_degree)
-        y_idx = ymax - int((y[i] - v_min) * v_dpkms)
-        data[y_idx, x_idx - 3:x_idx + 4] = val[i]
-
     fig_size = plt.rcParams["figure.figsize"]
     fig_size[1] = 4.5
     plt.rcParams["figure.figsize"] = fig_size
 
-    smoothed_data = ndimage.gaussian_filter(data, sigma=2, order=0)
+    smoothed_data = ndimage.gaussian_filter(data.filled(1), sigma=2, order=0)
 
     ax = plt.subplot(111)
     img = ax.imshow(smoothed_data, cmap=plt.cm.gist_heat_r)
@@ -417,22 +1033,19 @@ def plot_lv_image(x, y, c, filename):
     #cb = plt.colorbar(img, ax=ax)
     cb.set_label(r'$e^{(-\tau)}$')
 
-    gass_lv = fits.open('gass-lv.fits')
-    gass_subset = get_lv_subset(gass_lv[0].data, gass_lv[0].header, l_min,
-                                l_max, v_min * 1000,
-                                v_max * 1000)
-
     # Add an outline of the emission from GASS III
-    plt.contour(np.log10(np.flipud(gass_subset)), 1, cmap='Pastel2')
+    gass_layer = get_gass_contours(grid)
+    plot_gass_contours(ax, gass_layer, 'Pastel2')
+    gass_shape = gass_layer['shape']
 
     # Set the axis ticks and scales
-    x_step = int(20 * (gass_subset.shape[1] / (l_max - l_min)))
-    ax.set_xticks([i for i in range(gass_subset.shape[1], 0, -x_step)])
-    ax.set_xticklabels([i for i in range(l_min, l_max + 1, 20)])
+    x_step = int(20 * (gass_shape[1] / (l_max - l_min)))
+    ax.set_xticks([i for i in range(gass_shape[1], 0, -x_step)])
+    ax.set_xticklabels([i for i in range(int(l_min), int(l_max) + 1, 20)])
 
-    y_step = int(100 * (gass_subset.shape[0] / (v_max - v_min)))
-    ax.set_yticks([i for i in range(0, gass_subset.shape[0], y_step)])
-    ax.set_yticklabels([i for i in range(v_max, v_min - 1, -100)])
+    y_step = int(100 * (gass_shape[0] / (v_max - v_min)))
+    ax.set_yticks([i for i in range(0, gass_shape[0], y_step)])
+    ax.set_yticklabels([i for i in range(int(v_max), int(v_min) - 1, -100)])
 
     plt.grid(color='antiquewhite')
 
@@ -440,40 +1053,73 @@ def plot_lv_image(x, y, c, filename):
     plt.close()
 
 
-def calc_continuum_sd(spectrum, continuum_ranges):
+def lookup_continuum_ranges(continuum_ranges, longitudes):
+    """
+    Lookup the velocity range that should be used for measuring the continuum
+    levels at each of a set of longitudes. This is an array version of
+    magmo.lookup_continuum_range.
+
+    :param continuum_ranges: The list of continuum ranges.
+    :param longitudes: The array of integer longitudes to be checked.
+    :return: Arrays of the min and max continuum velocities.
+    """
+    continuum_start_vel = np.full(len(longitudes), -210)
+    continuum_end_vel = np.full(len(longitudes), -150)
+    for row in continuum_ranges:
+        in_range = (row['min_long'] <= longitudes) & (longitudes <= row['max_long'])
+        continuum_start_vel[in_range] = row['min_con_vel']
+        continuum_end_vel[in_range] = row['max_con_vel']
+    return continuum_start_vel, continuum_end_vel
+
+
+def calc_continuum_sd(velocities, opacities, longitudes, continuum_ranges):
     """
     Calulate the standard deviaition of opacity in the velocity range
-    designated as continuum for the spectrum's longitude. This gives a measure
+    designated as continuum for each spectrum's longitude. This gives a measure
     of the noise in wat should be an otherwise continuum only part of the
     spectrum.
 
-    :param spectrum: The spectrum object being analysed.
+    :param velocities: The NaN padded 2D array of the velocities of each spectrum
+    :param opacities: The NaN padded 2D array of the opacities of each spectrum
+    :param longitudes: The longitude of each spectrum
     :param continuum_ranges: The defined contionuum ranges
-    :return: The opacity standard deviation.
+    :return: An array of the opacity standard deviation of each spectrum.
     """
+    continuum_start_vel, continuum_end_vel = lookup_continuum_ranges(
+        continuum_ranges, np.trunc(longitudes).astype(int))
+    with np.errstate(invalid='ignore'):
+        after_start = continuum_start_vel[:, np.newaxis] < velocities
+        before_end = velocities < continuum_end_vel[:, np.newaxis]
+    num_chan = velocities.shape[1]
+    bin_start = np.argmax(after_start, axis=1)
+    bin_end = num_chan - 1 - np.argmax(before_end[:, ::-1], axis=1)
+
+    channels = np.arange(num_chan)
+    in_range = (channels >= bin_start[:, np.newaxis]) & (channels < bin_end[:, np.newaxis])
+    counts = np.sum(in_range, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.sum(np.where(in_range, opacities, 0), axis=1) / counts
+        variance = np.sum(np.where(in_range, opacities - means[:, np.newaxis], 0) ** 2, axis=1) / counts
+    return np.sqrt(variance)
+
+
+def calc_rating(opacity_range, max_s_max_n, continuum_sd):
+    """
+    Rate the quality of each spectrum from A (best) down based on the
+    range of opacity, the ratio of max signal to max noise and the noise in the
+    continuum.
+
+    :param opacity_range: The array of opacity ranges of the spectra
+    :param max_s_max_n: The array of max signal to max noise ratios of the spectra
+    :param continuum_sd: The array of continuum standard deviations of the spectra
+    :return: An array of the rating codes of the spectra
+    """
+    rating_codes = np.array(list('ABCDEF'))
+    rating = np.zeros(len(opacity_range), dtype=int)
 
-    continuum_start_vel, continuum_end_vel = magmo.lookup_continuum_range(
-        continuum_ranges, int(spectrum.longitude))
-    continuum_range = np.where(
-        continuum_start_vel < spectrum.velocity)
-    bin_start = continuum_range[0][0]
-    continuum_range = np.where(
-        spectrum.velocity < continuum_end_vel)
-    bin_end = continuum_range[0][-1]
-    sd_cont = np.std(spectrum.opacities[bin_start:bin_end])
-    return sd_cont
-
-
-def calc_rating(opacity_range, max_s_max_n, continuum_sd, em_std):
-    rating_codes = 'ABCDEF'
-    rating = 0
-
-    if opacity_range > 1.5:
-        rating += 1
-    if max_s_max_n < 3:
-        rating += 1
-    if continuum_sd*3 > 1:
-        rating += 1
+    rating += opacity_range > 1.5
+    rating += max_s_max_n < 3
+    rating += continuum_sd*3 > 1
 
     return rating_codes[rating]
 
@@ -487,21 +1133,23 @@ def is_resolved(day, field_name, island_id, source_id, beam_area, islands):
     :param island_id: The id of the source island
     :param source_id: The component id within the island
     :param beam_area: The area of the beam in steradians
+    :param islands: The map of islands keyed by day, field and island id, as produced by output_source_catalogue
     :return: True if the source is resolved, False otherwise.
     """
-    for isle in islands:
-        #print (isle['Day'], day, isle['Field'], field_name, isle['island'], island_id)
-        if isle['Day'] == day and isle['Field'] == field_name and isle['island'] == int(island_id):
-            #src_area = math.radians(src['a']/3600.0) * math.radians(src['b']/3600.0)
-            print ("island %s %s %s is %f as compared to beam of %f" % (day, field_name, island_id,  isle['area'], isle['beam_area']))
-            return isle['area'] > isle['beam_area']
+    isle = islands.get(get_island_key(day, field_name, island_id))
+    if isle is None:
+        return False
+    #src_area = math.radians(src['a']/3600.0) * math.radians(src['b']/3600.0)
+    print ("island %s %s %s is %f as compared to beam of %f" % (day, field_name, island_id,  isle['area'], isle['beam_area']))
+    return isle['area'] > isle['beam_area']
 
 
-def output_spectra_catalogue(spectra, isle_day_map):
+def output_spectra_catalogue(spectra, island_map):
     """
     Output the list of spectrum stats to a VOTable file magmo-spectra.vot
 
     :param spectra: The list of Spectrum objects
+    :param island_map: The map of islands keyed by day, field and island id
     :return: None
     """
     rows = len(spectra)
@@ -556,7 +1204,7 @@ def output_spectra_catalogue(spectra, isle_day_map):
         rating[i] = spectrum.rating
         src_parts = spectrum.src_id.split('-')
         resolved[i] = is_resolved(spectrum.day, spectrum.field_name, src_parts[0], src_parts[1], spectrum.beam_area,
-                                  isle_day_map[spectrum.day] if spectrum.day in isle_day_map else None)
+                                  island_map)
 
         duplicate[i] = spectrum.duplicate
         used[i] = not spectrum.low_sn
@@ -696,6 +1344,10 @@ def read_sources(filename, sources):
     return sources
 
 
+def get_island_key(day, field_name, island_id):
+    return str(day), str(field_name), int(island_id)
+
+
 def output_source_catalogue():
     vo_files = glob.glob('day*/*_src_comp.vot')
     sources = None
@@ -717,16 +1369,12 @@ def output_source_catalogue():
     vot = votable.from_table(islands)
     vot.to_xml("magmo-islands.vot")
 
-    # Create a map by day of the islands
-    isle_day_map = {}
+    # Create a map of the islands by day, field and island id
+    island_map = {}
     for isle in islands:
-        day = isle['Day']
-        if day not in isle_day_map:
-            isle_day_map[day] = []
-        day_list = isle_day_map[day]
-        day_list.append(isle)
+        island_map[get_island_key(isle['Day'], isle['Field'], isle['island'])] = isle
 
-    return isle_day_map
+    return island_map
 
 
 def output_single_phase_catalogue(spectra):
@@ -834,46 +1482,70 @@ def plot_spectra(spectra):
         plt.close()
 
 
+def find_duplicate_clusters(longitudes, latitudes, radius):
+    """
+    Group positions which are within a radius of each other into clusters. A
+    position is in the same cluster as any position within the radius of it,
+    so clusters may be chains of close positions.
+
+    :param longitudes: The galactic longitude of each position in degrees.
+    :param latitudes: The galactic latitude of each position in degrees.
+    :param radius: The matching radius as an angle Quantity.
+    :return: An array of the cluster number of each position, and the number of clusters.
+    """
+    l_rad = np.radians(longitudes)
+    b_rad = np.radians(latitudes)
+    vectors = np.column_stack((np.cos(b_rad) * np.cos(l_rad), np.cos(b_rad) * np.sin(l_rad), np.sin(b_rad)))
+    # Match on the chord length between unit vectors which is equivalent to the angular radius
+    chord = 2 * np.sin(radius.to(u.rad).value / 2)
+    pairs = np.array(sorted(cKDTree(vectors).query_pairs(chord)), dtype=int).reshape(-1, 2)
+    links = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(vectors), len(vectors)))
+    num_clusters, labels = connected_components(links, directed=False)
+    return labels, num_clusters
+
+
 def filter_duplicate_sources(spectra, field_map):
+    """
+    Flag the spectra which duplicate other spectra. All spectra from
+    duplicate fields are flagged. The remaining spectra are grouped into
+    clusters of spectra within 4 arcsec of each other and all but the best
+    spectrum of each cluster, by rating and then continuum noise, are flagged.
+
+    :param spectra: The list of Spectrum objects.
+    :param field_map: The Field objects keyed by field id, with duplicate fields flagged.
+    :return: None
+    """
     duplicate_radius = 4 * u.arcsec
     print ('## Identifying duplicate sources (reobserved fields or within {} arcsec'.format(duplicate_radius))
 
-    spectra_array = np.array(spectra)
-    l = []
-    b = []
-    duplicate_spectra = 0
-    for spectrum in spectra_array:
-        l.append(spectrum.loc.galactic.l.degree)
-        b.append(spectrum.loc.galactic.b.degree)
-        # Flag spectra from duplicate fields
-        spectrum.duplicate = False
-        if field_map[spectrum.get_field_id()].duplicate:
-            duplicate_spectra += 1
-            spectrum.duplicate = True
-    num_spectra_dupe_fields = duplicate_spectra
-
-    magmo_coords = SkyCoord(l, b, frame='galactic', unit="deg")
-
-    idx_match1, idx_match2, dist_2d, dist_3d = magmo_coords.search_around_sky(magmo_coords, duplicate_radius)
-    for i in range(len(idx_match1)):
-        match1 = spectra_array[idx_match1[i]]
-        match2 = spectra_array[idx_match2[i]]
-        if not match1.duplicate and not match2.duplicate and match1 != match2:
-            #print("{} is only {:.2f} arcsec from {} Rating {} v {} ContSD {:.3f} v {:.3f}".format(match1.name,
-            #                                                                                  dist_2d[i].to(u.arcsec),
-            #                                                                          match2.name, match1.rating,
-            #                                                                          match2.rating,
-            #                                                                          match1.continuum_sd,
-            #                                                                          match2.continuum_sd))
-            if match1.rating > match2.rating or match1.continuum_sd > match2.continuum_sd:
-                match1.duplicate = True
-                print("Flagging {} rating {} as duplicate. Dist {:.2f}".format(match1.name, match1.rating,
-                                                                           dist_2d[i].to(u.arcsec)))
-            else:
-                match2.duplicate = True
-                print("Flagging {} rating {} as duplicate. Dist {:.2f}".format(match2.name, match2.rating,
-                                                                           dist_2d[i].to(u.arcsec)))
-            duplicate_spectra += 1
+    dupe_field = np.array([bool(field_map[spectrum.get_field_id()].duplicate) for spectrum in spectra], dtype=bool)
+    for i in range(len(spectra)):
+        spectra[i].duplicate = bool(dupe_field[i])
+    num_spectra_dupe_fields = int(np.sum(dupe_field))
+
+    candidates = np.where(~dupe_field)[0]
+    longitudes = np.array([spectra[i].longitude for i in candidates], dtype=float)
+    latitudes = np.array([spectra[i].latitude for i in candidates], dtype=float)
+    ratings = np.array([spectra[i].rating for i in candidates])
+    continuum_sd = np.array([spectra[i].continuum_sd for i in candidates], dtype=float)
+    labels, num_clusters = find_duplicate_clusters(longitudes, latitudes, duplicate_radius)
+
+    # Sort by cluster, then rating and continuum noise, so the best spectrum leads each cluster
+    rating_rank = np.unique(ratings, return_inverse=True)[1] if len(ratings) > 0 else np.zeros(0, dtype=int)
+    order = np.lexsort((np.arange(len(candidates)), continuum_sd, rating_rank, labels))
+    leads_cluster = np.ones(len(order), dtype=bool)
+    leads_cluster[1:] = labels[order][1:] != labels[order][:-1]
+    best = np.zeros(num_clusters, dtype=int)
+    best[labels[order][leads_cluster]] = order[leads_cluster]
+
+    duplicate_spectra = num_spectra_dupe_fields
+    for idx in order[~leads_cluster]:
+        spectrum = spectra[candidates[idx]]
+        kept = spectra[candidates[best[labels[idx]]]]
+        spectrum.duplicate = True
+        duplicate_spectra += 1
+        print("Flagging {} rating {} as duplicate of {}. Dist {:.2f}".format(
+            spectrum.name, spectrum.rating, kept.name, spectrum.loc.separation(kept.loc).to(u.arcsec)))
     print(
         "Flagged {} spectra out of {} as duplicates. {} based on field, {} based on distance".format(duplicate_spectra,
                                                                                                      len(spectra),
@@ -898,17 +1570,18 @@ def main():
     field_map = flag_duplicate_fields(fields)
 
     # Output source catalogue
-    isle_day_map = output_source_catalogue()
+    island_map = output_source_catalogue()
 
     # Process Spectra
-    spectra = read_spectra()
+    spectra = read_spectra(args.workers, use_cache=not args.no_cache)
     filter_duplicate_sources(spectra, field_map)
-    x, y, c, used_fields = extract_lv(spectra)
+    lv_samples = LVSamples(spectra)
+    x, y, c, used_fields = extract_lv(spectra, samples=lv_samples)
     continuum_ranges = magmo.get_continuum_ranges()
     plot_lv(x, y, c, 'magmo-lv.pdf', continuum_ranges, False)
     plot_lv(x, y, c, 'magmo-lv-zoom.pdf', continuum_ranges, True)
-    plot_lv_image(x, y, c, 'magmo-lv-zoom-im.pdf')
-    output_spectra_catalogue(spectra, isle_day_map)
+    plot_lv_image(x, y, c, 'magmo-lv-zoom-im.pdf', reduction=args.lv_reduction, fits_filename='magmo-lv.fits')
+    output_spectra_catalogue(spectra, island_map)
 
 
     # calculate single phase spin temp for A-C
@@ -917,9 +1590,10 @@ def main():
     plot_spectra(spectra)
 
     # Output only the really good spectra
-    x, y, c, temp = extract_lv(spectra, min_rating='B')
+    x, y, c, temp = extract_lv(spectra, min_rating='B', samples=lv_samples)
     plot_lv(x, y, c, 'magmo-lv_AB.pdf', continuum_ranges, False)
-    plot_lv_image(x, y, c, 'magmo-lv-zoom-im_AB.pdf')
+    plot_lv_image(x, y, c, 'magmo-lv-zoom-im_AB.pdf', reduction=args.lv_reduction,
+                  fits_filename='magmo-lv_AB.fits')
 
     # Process Fields
     output_field_catalogue(fields, used_fields)
@@ -37,6 +37,7 @@ for band in ['1420', '1757']:
         os.chdir('..')
 
 # Delete the analysis files
+os.system("rm process.done")
 os.system("rm *.vot")
 os.system("rm *.xml")
 os.system("rm *.png")
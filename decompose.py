@@ -14,15 +14,21 @@ from astropy.io import fits, votable
 from astropy.io.votable import parse, from_table, writeto
 from astropy.table import Table, Column
 from matplotlib import gridspec
-from string import Template
 
 import argparse
 import datetime
 import gausspy.gp as gp
 import magmo
+import multiprocessing
 import numpy as np
 import pickle
+import spectra_store
 import time
+import matplotlib
+# Use a non-interactive backend when run as a script, so the plots can be rendered in worker
+# processes. This must be selected before pyplot is imported.
+if __name__ == '__main__':
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import aplpy
 
@@ -56,6 +62,11 @@ def parseargs():
                         type=float, default=5)
     parser.add_argument("--snr_thresh", help="The signal to noise ratio threshold",
                         type=float, default=5)
+    parser.add_argument("--plot_formats", help="A comma separated list of the file formats for the plot of each "
+                                               "spectrum's fit, e.g. png. Use '' to skip the plots.",
+                        default='pdf,png')
+    parser.add_argument("--workers", help="The number of processes to use to plot the spectra", type=int,
+                        default=1)
 
     args = parser.parse_args()
     return args
@@ -69,14 +80,6 @@ def read_spectra(filename):
     return results_array
 
 
-def read_opacity(filename):
-    votable = parse(filename, pedantic=False)
-    results = next(resource for resource in votable.resources if
-                   resource.type == "results")
-    results_array = results.tables[0].array
-    return results_array
-
-
 def filter_spectra(spectra, min_long, max_long, min_quality):
     filtered = spectra[spectra['Longitude'] >= min_long]
     filtered = filtered[filtered['Longitude'] <= max_long]
@@ -85,11 +88,6 @@ def filter_spectra(spectra, min_long, max_long, min_quality):
     return filtered
 
 
-def get_opacity_filename(day, field, source):
-    t = Template('day${day}/${field}_src${source}_opacity.votable.xml')
-    return t.substitute(day=day, field=field, source=source)
-
-
 def convert_from_ratio(absorption):
     """
     Convert an array of absorption values (I/I_0) to opacity values (tau).
@@ -118,9 +116,7 @@ def prepare_spectra(spectra, data_filename):
     # Convert to GaussPy format
     i = 0
     for spectrum in spectra:
-        filename = get_opacity_filename(spectrum['Day'], spectrum['Field'], spectrum['Source'])
-        #print("Reading", filename)
-        opacity = read_opacity(filename)
+        opacity = spectra_store.read_spectrum(spectrum['Day'], spectrum['Field'], spectrum['Source'])
         #if spectrum['Day'] == 43 and spectrum['Rating'] == 'A' and spectrum['Field'] == '019.612-0.120': # and spectrum['Source'] == '25-0':
         #    print("Skipping ", spectrum['Rating'], spectrum['Day'], spectrum['Longitude'], spectrum['Field'], spectrum['Source'])
         #    continue
@@ -131,7 +127,7 @@ def prepare_spectra(spectra, data_filename):
         # print (i, spectrum['Rating'], spectrum['Day'], longitude, spectrum['Field'], spectrum['Source'])
         rms = spectrum['Continuum_SD']
 
-        errors = np.ones(opacity.shape[0]) * rms
+        errors = np.ones(len(opacity['opacity'])) * rms
         location = np.array(spectrum['Longitude'], spectrum['Latitude'])
         tau = convert_from_ratio(opacity['opacity'])
         #print (tau)
@@ -267,19 +263,59 @@ def output_component_catalogue(spectra, data, data_decomposed):
         # , ".", num_no_comps, "spectra (of", len(spectra), ") had no components found")
 
 
-def calc_residual(velo, opacity, fit_amps, fit_fwhms, fit_means):
-    g_sum = np.zeros(len(velo))
-    # Plot individual components
-    if len(fit_amps) > 0.:
-        for j in range(len(fit_amps)):
-            amp, fwhm, mean = fit_amps[j], fit_fwhms[j], fit_means[j]
-            yy = amp * np.exp(-4. * np.log(2) * (velo - mean) ** 2 / fwhm ** 2)
-            g_sum += yy
-    residual = opacity - g_sum
-    return residual
+def calc_components(velo, fit_amps, fit_fwhms, fit_means):
+    """
+    Evaluate each of the fitted Gaussian components of a spectrum.
+
+    :param velo: The velocity of each channel of the spectrum
+    :param fit_amps: The amplitude of each component
+    :param fit_fwhms: The full width at half maximum of each component
+    :param fit_means: The mean velocity of each component
+    :return: A 2D array of the value of each component (rows) at each velocity (columns)
+    """
+    amps = np.asarray(fit_amps, dtype=float).reshape(-1, 1)
+    fwhms = np.asarray(fit_fwhms, dtype=float).reshape(-1, 1)
+    means = np.asarray(fit_means, dtype=float).reshape(-1, 1)
+    return amps * np.exp(-4. * np.log(2) * (np.asarray(velo) - means) ** 2 / fwhms ** 2)
+
+
+def calc_fit(velo, opacity, fit_amps, fit_fwhms, fit_means):
+    """
+    Calculate the model and residual of a decomposed spectrum.
+
+    :param velo: The velocity of each channel of the spectrum
+    :param opacity: The optical depth (tau) of each channel of the spectrum
+    :param fit_amps: The amplitude of each component
+    :param fit_fwhms: The full width at half maximum of each component
+    :param fit_means: The mean velocity of each component
+    :return: A dictionary of the components, the model (sum of the components), the residual (opacity - model) and
+             the rms of the residual.
+    """
+    components = calc_components(velo, fit_amps, fit_fwhms, fit_means)
+    model = np.sum(components, axis=0)
+    residual = opacity - model
+    return {'components': components, 'model': model, 'residual': residual,
+            'residual_rms': np.sqrt(np.mean(np.square(residual)))}
+
+
+def calc_fits(data, data_decomposed):
+    """
+    Calculate the model and residual of each decomposed spectrum, so that they
+    can be shared by the catalogues and plots.
+
+    :param data: The GaussPy input data
+    :param data_decomposed: The GaussPy decomposition result
+    :return: A list of the calc_fit result for each decomposed spectrum
+    """
+    fit_results = []
+    for i in range(len(data_decomposed['fwhms_fit'])):
+        fit_results.append(calc_fit(data['x_values'][i], data['data_list'][i],
+                                    data_decomposed['amplitudes_fit'][i], data_decomposed['fwhms_fit'][i],
+                                    data_decomposed['means_fit'][i]))
+    return fit_results
 
 
-def output_decomposition_catalogue(folder, spectra, data, data_decomposed):
+def output_decomposition_catalogue(folder, spectra, data, data_decomposed, fit_results):
     names = []
     days = []
     field_names = []
@@ -302,16 +338,8 @@ def output_decomposition_catalogue(folder, spectra, data, data_decomposed):
         latitudes.append(spectrum['Latitude'])
         ratings.append(spectrum['Rating'])
         cont_sd.append(spectrum['Continuum_SD'])
-
-        fit_fwhms = data_decomposed['fwhms_fit'][i]
-        fit_means = data_decomposed['means_fit'][i]
-        fit_amps = data_decomposed['amplitudes_fit'][i]
-        num_comps.append(len(fit_fwhms))
-
-        velo = data['x_values'][i]
-        # opacity = convert_to_ratio(data['data_list'][i])
-        residual = calc_residual(velo, data['data_list'][i], fit_amps, fit_fwhms, fit_means)
-        residual_rms.append(np.sqrt(np.mean(np.square(residual))))
+        num_comps.append(len(data_decomposed['fwhms_fit'][i]))
+        residual_rms.append(fit_results[i]['residual_rms'])
 
     temp_table = Table(
         [names, days, field_names, sources, longitudes, latitudes, residual_rms, ratings, num_comps, cont_sd],
@@ -324,32 +352,35 @@ def output_decomposition_catalogue(folder, spectra, data, data_decomposed):
     writeto(votable, filename)
 
 
-def plot_single_spectrum(ax, velo, opacity, fit_amps, fit_fwhms, fit_means, name):
-    g_sum = np.zeros(len(velo))
+def plot_single_spectrum(ax, velo, opacity, fit, name):
+    """
+    Plot an absorption spectrum along with its fitted components.
+
+    :param ax: The axes to plot on
+    :param velo: The velocity of each channel of the spectrum
+    :param opacity: The absorption (e^-tau) of each channel of the spectrum
+    :param fit: The calc_fit result for the spectrum
+    :param name: The title for the plot
+    :return: The residual of the fit in absorption units.
+    """
     ax.plot(velo, opacity, color='grey')
     # Plot individual components
-    if len(fit_amps) > 0.:
-        for j in range(len(fit_amps)):
-            amp, fwhm, mean = fit_amps[j], fit_fwhms[j], fit_means[j]
-            yy = amp * np.exp(-4. * np.log(2) * (velo - mean) ** 2 / fwhm ** 2)
-            g_sum += yy
-            yy = convert_to_ratio(yy)
-            ax.plot(velo, yy, '--', lw=0.5, color='purple')
-    g_sum = convert_to_ratio(g_sum)
+    for yy in fit['components']:
+        ax.plot(velo, convert_to_ratio(yy), '--', lw=0.5, color='purple')
+    g_sum = convert_to_ratio(fit['model'])
     ax.plot(velo, g_sum, '-', lw=1.0, color='blue')
-    plt.title(name)
+    ax.set_title(name)
     residual = opacity - g_sum
     return residual
 
 
-def plot_spectrum(velo, opacity, fit_amps, fit_fwhms, fit_means, name, filename, formats):
+def plot_spectrum(velo, opacity, fit, name, filename, formats):
     fig = plt.figure(figsize=(8, 6))
     gs = gridspec.GridSpec(2, 1, height_ratios=[3, 1])
     ax = fig.add_subplot(gs[0])
 
     y = convert_from_ratio(opacity)
-    residual = plot_single_spectrum(ax, velo, y, fit_amps, fit_fwhms, fit_means, name)
-    residual_rms = np.sqrt(np.mean(np.square(residual)))
+    residual = plot_single_spectrum(ax, velo, y, fit, name)
     ax.set_ylabel('$e^{-\\tau}$')
 
     # Residual plot
@@ -357,28 +388,48 @@ def plot_spectrum(velo, opacity, fit_amps, fit_fwhms, fit_means, name, filename,
     ax.plot(velo, residual, 'or', markerfacecolor='None', markersize=2, markeredgecolor='blue')
     ax.grid()
 
-    plt.xlabel('LSR Velocity (km/s) n=%d rms=%.4f' % (len(fit_amps), residual_rms))
+    ax.set_xlabel('LSR Velocity (km/s) n=%d rms=%.4f' % (len(fit['components']), fit['residual_rms']))
 
     for fmt in formats:
-        plt.savefig(filename + "." + fmt, bbox_inches="tight")
-    plt.close()
-    return residual_rms
+        fig.savefig(filename + "." + fmt, bbox_inches="tight")
+    plt.close(fig)
+
+
+def _plot_spectrum_task(task):
+    """
+    Plot a single spectrum, used to plot the spectra in worker processes.
+    """
+    plot_spectrum(*task)
+
 
+def plot_spectra(spectra, data, fit_results, alpha1, alpha2, folder='.', formats=('pdf', 'png'), workers=1):
+    """
+    Plot each decomposed spectrum with its fitted components and residuals.
+
+    :param spectra: The spectra catalogue
+    :param data: The GaussPy input data
+    :param fit_results: The calc_fit result for each decomposed spectrum
+    :param alpha1: The first GaussPy smoothing parameter, used for reporting
+    :param alpha2: The second GaussPy smoothing parameter, used for reporting
+    :param folder: The folder of the decomposition run
+    :param formats: The file formats to write each plot in, no plots are produced if this is empty
+    :param workers: The number of processes to use to produce the plots
+    :return: None
+    """
+    residuals = np.array([fit['residual_rms'] for fit in fit_results])
+    print("Residual RMS mean {:0.4} median {:0.4} sd {:0.4} for alphas {},{}".format(np.mean(residuals), np.median(residuals),
+                                                                           np.std(residuals), alpha1, alpha2))
+    if len(formats) == 0 or len(fit_results) == 0:
+        return
 
-def plot_spectra(spectra, data, data_decomposed, alpha1, alpha2, folder='.'):
     plot_folder = folder + "/plots"
     magmo.ensure_dir_exists(plot_folder)
-    residuals = np.zeros(len(data_decomposed['fwhms_fit']))
     for rating in 'ABCDEF':
         magmo.ensure_dir_exists(plot_folder + "/" + rating)
 
-    for i in range(len(data_decomposed['fwhms_fit'])):
+    tasks = []
+    for i in range(len(fit_results)):
         spectrum = spectra[data['spectrum_idx'][i]]
-        velo = data['x_values'][i]
-        opacity = data['data_list'][i]
-        fit_fwhms = data_decomposed['fwhms_fit'][i]
-        fit_means = data_decomposed['means_fit'][i]
-        fit_amps = data_decomposed['amplitudes_fit'][i]
         rating = spectrum['Rating']
         field_name = spectrum['Field']
         day = str(spectrum['Day'])
@@ -386,9 +437,20 @@ def plot_spectra(spectra, data, data_decomposed, alpha1, alpha2, folder='.'):
         name = spectrum['Name'] + " (" + rating + ")"
         filename = plot_folder + "/" + rating + "/"
         filename += field_name + "_" + day + "_src" + src_id + "_fit"
-        residuals[i] = plot_spectrum(velo, opacity, fit_amps, fit_fwhms, fit_means, name, filename, ('pdf', 'png'))
-    print("Residual RMS mean {:0.4} median {:0.4} sd {:0.4} for alphas {},{}".format(np.mean(residuals), np.median(residuals),
-                                                                           np.std(residuals), alpha1, alpha2))
+        tasks.append((data['x_values'][i], data['data_list'][i], fit_results[i], name, filename, formats))
+
+    start = time.time()
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes=min(workers, len(tasks)))
+        try:
+            pool.map(_plot_spectrum_task, tasks, chunksize=max(1, len(tasks) // (workers * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            _plot_spectrum_task(task)
+    print("Plotted %d spectra in %.02f s" % (len(tasks), time.time() - start))
 
 
 def plot_components(spectra, data_decomposed):
@@ -417,7 +479,8 @@ def get_samples(data, rating_count=[4, 1, 1], ratings='ABC'):
     return indexes
 
 
-def output_decomposition(spectra, out_filename, folder, data_filename, alpha1, alpha2):
+def output_decomposition(spectra, out_filename, folder, data_filename, alpha1, alpha2, formats=('pdf', 'png'),
+                         workers=1):
     # For each spectra:
     # Output plots
     # Output component catalogue
@@ -428,6 +491,7 @@ def output_decomposition(spectra, out_filename, folder, data_filename, alpha1, a
     data = pickle.load(open(data_filename))
     data_decomposed = pickle.load(open(out_filename))
 
+    fit_results = calc_fits(data, data_decomposed)
     index_values = get_samples(data)
     print (index_values, len(data_decomposed['fwhms_fit']), len(spectra))
 
@@ -440,17 +504,14 @@ def output_decomposition(spectra, out_filename, folder, data_filename, alpha1, a
         #y = 1 - data['data_list'][index]
         #y = convert_to_ratio(data['data_list'][index])
         y = convert_from_ratio(data['data_list'][index])
-        fit_fwhms = data_decomposed['fwhms_fit'][index]
-        fit_means = data_decomposed['means_fit'][index]
-        fit_amps = data_decomposed['amplitudes_fit'][index]
 
         spectrum = spectra[data['spectrum_idx'][index]]
         rating = spectrum['Rating']
 
         name = spectrum['Name'] + " (" + rating + ")"
 
-        residual = plot_single_spectrum(ax, x, y, fit_amps, fit_fwhms, fit_means, name)
-        residual_rms = np.sqrt(np.mean(np.square(residual)))
+        residual = plot_single_spectrum(ax, x, y, fit_results[index], name)
+        residual_rms = fit_results[index]['residual_rms']
         print (name, "has residual RMS of", residual_rms)
 
         if i % 3 == 0:
@@ -473,8 +534,8 @@ def output_decomposition(spectra, out_filename, folder, data_filename, alpha1, a
     plt.close()
 
     output_component_catalogue(spectra, data, data_decomposed)
-    output_decomposition_catalogue(folder, spectra, data, data_decomposed)
-    plot_spectra(spectra, data, data_decomposed, alpha1, alpha2, folder=folder)
+    output_decomposition_catalogue(folder, spectra, data, data_decomposed, fit_results)
+    plot_spectra(spectra, data, fit_results, alpha1, alpha2, folder=folder, formats=formats, workers=workers)
 
 
 def main():
@@ -489,6 +550,8 @@ def main():
     spectra = read_spectra(args.input)
     spectra = filter_spectra(spectra, args.long_min, args.long_max, args.quality)
 
+    formats = [fmt for fmt in args.plot_formats.split(',') if fmt]
+
     alpha1_range = (3, 4.36)
     alpha2_range = (7, 9.37)
 
@@ -505,7 +568,8 @@ def main():
             decompose(spectra, folder+"/"+args.output, a1, a2, args.snr_thresh, data_filename)
 
         # Read in result
-        output_decomposition(spectra, folder+"/"+args.output, folder, data_filename, a1, a2)
+        output_decomposition(spectra, folder+"/"+args.output, folder, data_filename, a1, a2, formats=formats,
+                             workers=args.workers)
 
     # Report
     end = time.time()
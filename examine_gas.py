@@ -28,6 +28,8 @@ from scipy import interpolate
 import scipy.stats as stats
 import seaborn as sns
 
+import spectra_store
+
 
 class Gas(object):
     def __init__(self, day, field, src):
@@ -366,12 +368,6 @@ def find_best_matches(magmo_coords, other_coords, max_dist, magmo_table):
     return matches
 
 
-def get_opacity_filename(day, field, src_id):
-    name_prefix = field + '_src' + src_id
-    filename = 'day' + str(day) + '/' + name_prefix + '_opacity.votable.xml'
-    return filename
-
-
 def get_brown_filename(lat, lon):
     sep = '+' if lon >= 0 else ''
     filename = '../brown_data/{:.3f}{}{:.3f}.dat'.format(lat, sep, lon)
@@ -508,8 +504,7 @@ def compare_brown_2014(magmo_coords, magmo_table):
                 continue
 
             brown_data = ascii.read(brown_filename)
-            spectrum = read_votable_results(
-                get_opacity_filename(match_row['Day'], match_row['Field'], match_row['Source']))
+            spectrum = spectra_store.read_spectrum(match_row['Day'], match_row['Field'], match_row['Source'])
             resampled_spec = resample(spectrum['opacity'], spectrum['velocity'], brown_data['col1'] * 1000)
 
             cont_sd = match_row['Continuum_SD']
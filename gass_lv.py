@@ -0,0 +1,287 @@
+#!/usr/bin/env python -u
+
+# Build a longitude-velocity image from the GASS III galactic projection cubes.
+#
+# The GASS cubes each cover a block of velocities for the whole Galactic
+# plane. The LV image is built by streaming through the velocity planes of
+# each cube in turn, reading only the rows of the requested latitude or
+# latitude band, and writing the result straight into a preallocated memory
+# mapped FITS image. Where a band of latitudes is requested the rows are
+# averaged, ignoring any blank pixels.
+
+# Date 16 Oct 2026
+
+from __future__ import print_function, division
+
+import argparse
+import glob
+import os
+import time
+
+from astropy.io import fits
+import numpy as np
+
+_GASS_FOLDER = '/Volumes/Data-Dempsey/GASSIII/CAR_CUBES'
+_COPIED_KEYWORDS = ('RESTFREQ', 'TELESCOP', 'SPECSYS', 'OBJECT', 'OBSERVER', 'BUNIT')
+
+
+def parseargs():
+    """
+    Parse the command line arguments
+    :return: An args map with the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Build a longitude-velocity image at a latitude, or averaged over a band of latitudes, from the "
+                    "GASS III cubes.")
+    parser.add_argument("-f", "--folder", help="The folder containing the GASS III CAR cubes",
+                        default=_GASS_FOLDER)
+    parser.add_argument("--lat", help="The galactic latitude of the slice in degrees", type=float, default=0)
+    parser.add_argument("--lat_min", help="The lowest latitude of a band to be averaged, overrides --lat",
+                        type=float)
+    parser.add_argument("--lat_max", help="The highest latitude of a band to be averaged, overrides --lat",
+                        type=float)
+    parser.add_argument("-o", "--output", help="The name of the LV image file to be produced",
+                        default='gass-lv.fits')
+    parser.add_argument("--chunk_size", help="The number of velocity planes to read at a time", type=int,
+                        default=32)
+
+    args = parser.parse_args()
+    return args
+
+
+def read_cube_header(filename):
+    """
+    Read the description of a GASS cube from its FITS header.
+
+    :param filename: The path to the GASS cube.
+    :return: A dictionary of the cube's file name, header and velocity axis.
+    """
+    header = fits.getheader(filename)
+    entry = {'file_name': filename, 'header': header, 'naxis3': int(header['NAXIS3']),
+             'v_delta': float(header['CDELT3'])}
+    entry['v_start'] = float(header['CRVAL3']) + (1 - float(header['CRPIX3'])) * entry['v_delta']
+    return entry
+
+
+def order_cubes(cubes):
+    """
+    Sort the cubes by velocity and work out which planes of each cube are
+    used. Where the velocity ranges of neighbouring cubes overlap, the
+    overlapping planes are taken from the lower velocity cube.
+
+    :param cubes: The list of cube descriptions from read_cube_header
+    :return: The sorted list of cube descriptions, each with a first_plane key for the first plane to be used.
+    """
+    ordered = sorted(cubes, key=lambda cube: cube['v_start'])
+    v_delta = ordered[0]['v_delta']
+    prev_end = None
+    for cube in ordered:
+        if abs(cube['v_delta'] - v_delta) > abs(v_delta) * 1e-6:
+            raise ValueError("Cube %s has a different velocity step to the other cubes" % cube['file_name'])
+        first_plane = 0
+        if prev_end is not None:
+            first_plane = int(round((prev_end - cube['v_start']) / v_delta)) + 1
+            if first_plane < 0:
+                raise ValueError("There is a gap in velocity before cube %s" % cube['file_name'])
+        cube['first_plane'] = first_plane
+        prev_end = cube['v_start'] + (cube['naxis3'] - 1) * v_delta
+    return ordered
+
+
+def get_lat_rows(header, lat_min, lat_max):
+    """
+    Find the rows of a cube which cover a latitude band. If the band is a
+    single latitude the nearest row is used.
+
+    :param header: The FITS header of the cube
+    :param lat_min: The lowest latitude of the band in degrees
+    :param lat_max: The highest latitude of the band in degrees
+    :return: The first row and the row after the last row of the band.
+    """
+    refpix = float(header['CRPIX2'])
+    refval = float(header['CRVAL2'])
+    delta = float(header['CDELT2'])
+    # Convert to 0 based pixel positions
+    pix_min = refpix - 1 + (lat_min - refval) / delta
+    pix_max = refpix - 1 + (lat_max - refval) / delta
+    pix_min, pix_max = min(pix_min, pix_max), max(pix_min, pix_max)
+    if lat_min == lat_max:
+        row_start = int(round(pix_min))
+        row_end = row_start + 1
+    else:
+        row_start = int(np.ceil(pix_min - 1e-6))
+        row_end = int(np.floor(pix_max + 1e-6)) + 1
+    if row_start < 0 or row_end > int(header['NAXIS2']) or row_end <= row_start:
+        raise ValueError("Latitudes %g to %g are not covered by the cubes" % (lat_min, lat_max))
+    return row_start, row_end
+
+
+def build_lv_header(cubes, lat_min, lat_max, row_start, row_end):
+    """
+    Build the header of the LV image. The longitude axis is taken from the
+    cubes, which have a plate carree projection with a reference latitude of
+    0, so longitude is linear along each row. The velocity axis starts at the
+    first plane of the lowest velocity cube.
+
+    :param cubes: The ordered list of cube descriptions
+    :param lat_min: The lowest latitude of the band in degrees
+    :param lat_max: The highest latitude of the band in degrees
+    :param row_start: The first row of the cubes included in the image
+    :param row_end: The row after the last row of the cubes included in the image
+    :return: The FITS header for the image
+    """
+    cube_header = cubes[0]['header']
+    num_planes = sum([cube['naxis3'] - cube['first_plane'] for cube in cubes])
+    hdu = fits.PrimaryHDU(data=np.zeros((1, 1), dtype=np.float32))
+    header = hdu.header
+    header['NAXIS1'] = int(cube_header['NAXIS1'])
+    header['NAXIS2'] = num_planes
+
+    header['CTYPE1'] = 'GLON'
+    header['CRPIX1'] = cube_header['CRPIX1']
+    header['CRVAL1'] = cube_header['CRVAL1']
+    header['CDELT1'] = cube_header['CDELT1']
+    header['CUNIT1'] = 'deg'
+    header['CTYPE2'] = cube_header['CTYPE3']
+    header['CRPIX2'] = 1
+    header['CRVAL2'] = cubes[0]['v_start']
+    header['CDELT2'] = cubes[0]['v_delta']
+    header['CUNIT2'] = cube_header.get('CUNIT3', 'm/s')
+    for keyword in _COPIED_KEYWORDS:
+        if keyword in cube_header:
+            header[keyword] = cube_header[keyword]
+
+    header['GLAT_MIN'] = (lat_min, 'Lowest latitude of the slice (deg)')
+    header['GLAT_MAX'] = (lat_max, 'Highest latitude of the slice (deg)')
+    header['LAT_ROWS'] = (row_end - row_start, 'Number of cube rows averaged')
+    return header
+
+
+def create_memmapped_image(filename, header):
+    """
+    Create a FITS image of the size described by the header, without building
+    the data in memory, and open it for writing.
+
+    :param filename: The name of the file to be created.
+    :param header: The header of the image, including the NAXIS keywords.
+    :return: The opened HDUList, the image data is a memory mapped array.
+    """
+    header.tofile(filename, overwrite=True)
+    data_size = header['NAXIS1'] * header['NAXIS2'] * abs(header['BITPIX']) // 8
+    padded_size = ((data_size + 2879) // 2880) * 2880
+    with open(filename, 'rb+') as fits_file:
+        fits_file.seek(len(header.tostring()) + padded_size - 1)
+        fits_file.write(b'\0')
+    return fits.open(filename, mode='update', memmap=True)
+
+
+def read_band_mean(data, first, last, row_start, row_end, bscale, bzero):
+    """
+    Read a block of planes from a cube and average the rows of the latitude band.
+
+    :param data: The unscaled, memory mapped data of the cube
+    :param first: The first plane to be read
+    :param last: The plane after the last plane to be read
+    :param row_start: The first row of the band
+    :param row_end: The row after the last row of the band
+    :param bscale: The scale of the cube's stored values
+    :param bzero: The offset of the cube's stored values
+    :return: A 2D array of the mean value at each plane (rows) and longitude (columns)
+    """
+    block = data[first:last, row_start:row_end, :].astype(np.float64) * bscale + bzero
+    if row_end - row_start == 1:
+        return block[:, 0, :]
+    valid = np.isfinite(block)
+    counts = np.sum(valid, axis=1)
+    totals = np.sum(np.where(valid, block, 0), axis=1)
+    means = np.full(totals.shape, np.nan)
+    np.divide(totals, counts, out=means, where=counts > 0)
+    return means
+
+
+def build_lv_image(cubes, lat_min, lat_max, output, chunk_size=32):
+    """
+    Build the LV image, streaming through the planes of each cube.
+
+    :param cubes: The list of cube descriptions from read_cube_header
+    :param lat_min: The lowest latitude of the band in degrees
+    :param lat_max: The highest latitude of the band in degrees
+    :param output: The name of the LV image file to be produced
+    :param chunk_size: The number of planes to read at a time
+    :return: The shape of the image produced.
+    """
+    cubes = order_cubes(cubes)
+    row_start, row_end = get_lat_rows(cubes[0]['header'], lat_min, lat_max)
+    header = build_lv_header(cubes, lat_min, lat_max, row_start, row_end)
+    for cube in cubes[1:]:
+        for keyword in ('NAXIS1', 'CRPIX1', 'CRVAL1', 'CDELT1', 'NAXIS2', 'CRPIX2', 'CRVAL2', 'CDELT2'):
+            if cube['header'][keyword] != cubes[0]['header'][keyword]:
+                raise ValueError("Cube %s has a different %s to %s" % (cube['file_name'], keyword,
+                                                                      cubes[0]['file_name']))
+
+    print("Building %d x %d LV image from rows %d to %d of %d cubes" % (
+        header['NAXIS1'], header['NAXIS2'], row_start, row_end - 1, len(cubes)))
+    temp_filename = output + '.tmp'
+    out_hdulist = create_memmapped_image(temp_filename, header)
+    try:
+        lv_data = out_hdulist[0].data
+        out_plane = 0
+        for cube in cubes:
+            start = time.time()
+            hdulist = fits.open(cube['file_name'], memmap=True, do_not_scale_image_data=True)
+            try:
+                cube_header = hdulist[0].header
+                data = hdulist[0].data
+                if data.ndim == 4:
+                    data = data[0]
+                bscale = cube_header.get('BSCALE', 1.0)
+                bzero = cube_header.get('BZERO', 0.0)
+                for first in range(cube['first_plane'], cube['naxis3'], chunk_size):
+                    last = min(first + chunk_size, cube['naxis3'])
+                    lv_data[out_plane:out_plane + last - first] = read_band_mean(
+                        data, first, last, row_start, row_end, bscale, bzero)
+                    out_plane += last - first
+                data = None
+            finally:
+                hdulist.close()
+            print("Read planes %d to %d of %s in %.02f s" % (
+                cube['first_plane'], cube['naxis3'] - 1, cube['file_name'], time.time() - start))
+        out_hdulist.flush()
+        shape = lv_data.shape
+        lv_data = None
+    finally:
+        out_hdulist.close()
+    os.rename(temp_filename, output)
+    return shape
+
+
+def main():
+    """
+    Main script for gass_lv
+    :return: The exit code
+    """
+    args = parseargs()
+    start = time.time()
+
+    lat_min = args.lat if args.lat_min is None else args.lat_min
+    lat_max = args.lat if args.lat_max is None else args.lat_max
+    if lat_max < lat_min:
+        print("The latitude band must have lat_min <= lat_max.")
+        return 1
+
+    in_files = sorted(glob.glob(args.folder + "/*.fits"))
+    if len(in_files) == 0:
+        print("No GASS cubes found in %s." % args.folder)
+        return 1
+    cubes = [read_cube_header(filename) for filename in in_files]
+    shape = build_lv_image(cubes, lat_min, lat_max, args.output, chunk_size=args.chunk_size)
+
+    end = time.time()
+    print("Wrote %d x %d LV image for latitudes %g to %g to %s in %.02f s" % (
+        shape[1], shape[0], lat_min, lat_max, args.output, end - start))
+    return 0
+
+
+# Run the script if it is called from the command line
+if __name__ == "__main__":
+    exit(main())
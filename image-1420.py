@@ -1,9 +1,18 @@
 # Quick extra program to proiduce images of the HI 1420 data and provide a side by side comparison with the
 # 1757 MHz continuum data
-
+#
+# The preview images are rendered by a pool of processes, and any preview
+# which is newer than its image is not rendered again.
+
+import matplotlib
+# Use a non-interactive backend when run as a script, so the previews can be rendered in worker
+# processes. This must be selected before pyplot is imported.
+if __name__ == '__main__':
+    matplotlib.use('Agg')
 import aplpy
 import magmo
 import math
+import multiprocessing
 import os
 import process_day
 import sys
@@ -11,87 +20,180 @@ import time
 
 from string import Template
 
-# Read day parameter
-if len(sys.argv) != 2:
-    print("Incorrect number of parameters.")
-    print("Usage: python image_1420.py day")
-    exit(1)
-day = sys.argv[1]
-
-sources = magmo.get_day_obs_data(day)
-if sources is None or len(sources) == 0:
-    print "Day %s is not defined." % (day)
-    exit(1)
-
-dayDirName = "day" + day
-start = time.time()
-print "#### Started imaging MAGMO day %s at %s ####" % \
-      (day, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)))
-
-line_band = {'main': '1420', 'freqs': ['1420', '1421', '1420.5'], 'line': True}
-
-error_list = []
-
-#error_list.extend(process_day.build_images(dayDirName, sources, line_band, day))
-
-img_idx = open(dayDirName + '/images-comp.html', 'w')
-t = Template('<html>\n<head><title>Day $day image previews</title></head>\n'
-             + '<body>\n<h1>Image previews for day $day</h1>\n<table>\n'
-             + '<tr><td>Source</td><td>1757 MHz</td><td>1420 MHz</td><td>1757 Beam</td></tr>')
-img_idx.write(t.substitute(day=day))
-
-os.chdir(dayDirName)
-for src in sources:
-    src_name = src['source']
-    name_prefix = '/magmo-' + src_name + '_'
-    restored_img = "1757/magmo-" + src_name + "_1757_restor"
-    sn = 0.0
-    if os.path.exists(restored_img):
-        rms, max = process_day.get_signal_noise_ratio(restored_img)
-        if rms > 0:
-            sn = max / rms
-        sn /= math.sqrt(1053)
-    max_1420 = max
-    restored_img = "1420/magmo-" + src_name + "_1420_restor"
-    if os.path.exists(restored_img):
-        rms_1420, max_1420 = process_day.get_signal_noise_ratio(restored_img)
-
-    beam_file = "1757/magmo-" + src_name + "_1757_beam"
-    beam_img = beam_file + ".png"
-    if os.path.exists(beam_file):
-        cmd = 'cgdisp region="percentage(15)" in=' + beam_file + ' device=' + beam_img\
-              + '/png type=p'
-        magmo.run_os_cmd(cmd)
-
-    img_idx.write('<tr><td>' + src_name + '<br>S/N: ' + str(sn) + '<br>Max: ' + str(max)
-                  + '<br>RMS: ' + str(rms) + '</td>\n')
-    for freq in ['1757', '1420']:
-        fits_file = freq + name_prefix + freq + '_restor.fits'
-        img = freq + name_prefix + freq + '.png'
-        #print 'File %s exists %s' % (fits_file, os.path.exists(fits_file))
-        if os.path.exists(fits_file):
-            fig = aplpy.FITSFigure(fits_file)
-            fig.set_theme('publication')
-            fig.show_grayscale(0, None, (max_1420 if freq == '1420' else max))
-            # fig.show_grayscale(0, None, 0.1)
-            fig.add_colorbar()
-            fig.add_beam()
-            fig.beam.set_color('red')
-            fig.save(img)
-            fig.close()
 
+def get_latest_mtime(path):
+    """
+    Find the most recent modification time of a file, or of any file within
+    a directory, such as a Miriad image.
+    """
+    latest = os.path.getmtime(path)
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                latest = max(latest, os.path.getmtime(os.path.join(dirpath, filename)))
+    return latest
+
+
+def is_preview_current(image_file, png_file):
+    """
+    Check if a preview has been rendered since the image was last changed.
+
+    :param image_file: The FITS file or Miriad image being previewed
+    :param png_file: The preview file
+    :return: True if the preview is newer than the image, False otherwise
+    """
+    return os.path.exists(png_file) and os.path.getmtime(png_file) >= get_latest_mtime(image_file)
+
+
+def render_image_preview(fits_file, png_file, max_flux):
+    fig = aplpy.FITSFigure(fits_file)
+    fig.set_theme('publication')
+    fig.show_grayscale(0, None, max_flux)
+    # fig.show_grayscale(0, None, 0.1)
+    fig.add_colorbar()
+    fig.add_beam()
+    fig.beam.set_color('red')
+    fig.save(png_file)
+    fig.close()
+
+
+def render_beam_preview(beam_file, png_file):
+    cmd = 'cgdisp region="percentage(15)" in=' + beam_file + ' device=' + png_file \
+          + '/png type=p'
+    magmo.run_os_cmd(cmd)
+
+
+def render_preview(job):
+    """
+    Render a single preview image. This is run in the worker processes.
+
+    :param job: A tuple of the render function followed by its arguments
+    :return: None if the preview was rendered, otherwise an error message
+    """
+    try:
+        job[0](*job[1:])
+    except Exception as e:
+        return "Unable to render %s: %s" % (job[2], e)
+    return None
+
+
+def main():
+    """
+    Main script for image-1420
+    :return: The exit code, 1 if any previews could not be rendered
+    """
+    # Read day parameter
+    if len(sys.argv) not in (2, 3):
+        print("Incorrect number of parameters.")
+        print("Usage: python image_1420.py day [workers]")
+        exit(1)
+    day = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+
+    sources = magmo.get_day_obs_data(day)
+    if sources is None or len(sources) == 0:
+        print "Day %s is not defined." % (day)
+        exit(1)
+
+    dayDirName = "day" + day
+    magmo.set_command_log(dayDirName + '/commands.jsonl')
+    start = time.time()
+    print "#### Started imaging MAGMO day %s at %s ####" % \
+          (day, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)))
+
+    line_band = {'main': '1420', 'freqs': ['1420', '1421', '1420.5'], 'line': True}
+
+    error_list = []
+
+    #error_list.extend(process_day.build_images(dayDirName, sources, line_band, day))
+
+    src_names = [src['source'] for src in sources]
+    stats_1757 = process_day.get_image_stats(dayDirName, '1757', src_names)
+    stats_1420 = process_day.get_image_stats(dayDirName, '1420', src_names)
+
+    os.chdir(dayDirName)
+    rows = []
+    jobs = []
+    num_current = 0
+    max = 0
+    rms = 0
+    for src in sources:
+        src_name = src['source']
+        name_prefix = '/magmo-' + src_name + '_'
+        sn = 0.0
+        if src_name in stats_1757:
+            rms = stats_1757[src_name]['rms']
+            max = stats_1757[src_name]['max']
+            if rms > 0:
+                sn = max / rms
+            sn /= math.sqrt(1053)
+        max_1420 = max
+        if src_name in stats_1420:
+            rms_1420 = stats_1420[src_name]['rms']
+            max_1420 = stats_1420[src_name]['max']
+
+        beam_file = "1757/magmo-" + src_name + "_1757_beam"
+        beam_img = beam_file + ".png"
+        if os.path.exists(beam_file):
+            if is_preview_current(beam_file, beam_img):
+                num_current += 1
+            else:
+                jobs.append((render_beam_preview, beam_file, beam_img))
+
+        imgs = []
+        for freq in ['1757', '1420']:
+            fits_file = freq + name_prefix + freq + '_restor.fits'
+            img = freq + name_prefix + freq + '.png'
+            imgs.append(img)
+            if os.path.exists(fits_file):
+                if is_preview_current(fits_file, img):
+                    num_current += 1
+                else:
+                    jobs.append((render_image_preview, fits_file, img, (max_1420 if freq == '1420' else max)))
+        rows.append((src_name, sn, max, rms, imgs, beam_img))
+
+    print "Rendering %d previews, %d are up to date" % (len(jobs), num_current)
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes=min(workers, len(jobs)))
+        try:
+            results = pool.map(render_preview, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [render_preview(job) for job in jobs]
+    error_list.extend([error for error in results if error is not None])
+
+    img_idx = open('images-comp.html', 'w')
+    t = Template('<html>\n<head><title>Day $day image previews</title></head>\n'
+                 + '<body>\n<h1>Image previews for day $day</h1>\n<table>\n'
+                 + '<tr><td>Source</td><td>1757 MHz</td><td>1420 MHz</td><td>1757 Beam</td></tr>')
+    img_idx.write(t.substitute(day=day))
+    for src_name, sn, max, rms, imgs, beam_img in rows:
+        img_idx.write('<tr><td>' + src_name + '<br>S/N: ' + str(sn) + '<br>Max: ' + str(max)
+                      + '<br>RMS: ' + str(rms) + '</td>\n')
         t = Template('<td><a href="${img}"><img src="${img}" width="500px"></a></td>')
-        img_idx.write(t.substitute(img=img))
-
-    t = Template('<td><a href="${img}"><img src="${img}" width="500px"></a></td>')
-    img_idx.write(t.substitute(img=beam_img))
-    img_idx.write('</tr>\n')
-
-img_idx.write('</table></body></html>\n')
-img_idx.close()
-os.chdir('..')
-
-# Report
-end = time.time()
-print '#### Processing Completed at %s in %.02f s ####' \
-      % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end)), end - start)
+        for img in imgs:
+            img_idx.write(t.substitute(img=img))
+        img_idx.write(t.substitute(img=beam_img))
+        img_idx.write('</tr>\n')
+
+    img_idx.write('</table></body></html>\n')
+    img_idx.close()
+    os.chdir('..')
+
+    # Report
+    end = time.time()
+    print '#### Processing Completed at %s in %.02f s ####' \
+          % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end)), end - start)
+    if len(error_list) > 0:
+        print "%d errors were encountered:" % (len(error_list))
+        for err in error_list:
+            print err
+        return 1
+    return 0
+
+
+# Run the script if it is called from the command line
+if __name__ == "__main__":
+    exit(main())
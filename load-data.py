@@ -78,6 +78,7 @@ print (dayRow)
 # Make day directory
 dayDirName = "day" + day
 magmo.ensure_dir_exists(dayDirName)
+magmo.set_command_log(dayDirName + '/commands.jsonl')
 
 # Load files
 freqList = ["1421", "1757"]
@@ -5,9 +5,20 @@
 # Date 29 Jul 2016
 
 import csv
+import datetime
+import errno
+import json
 import sys
 import os
+import signal
 import subprocess
+import threading
+import time
+
+_command_log = None
+_command_log_lock = threading.Lock()
+_output_lock = threading.Lock()
+_tool_limits = None
 
 
 class CommandFailedError(Exception):
@@ -67,30 +78,261 @@ def get_day_obs_data(day):
     return sources
 
 
-def run_os_cmd(cmd, failOnErr=True):
+def set_command_log(filename):
+    """
+    Set the file that a record of each command run by run_os_cmd will be
+    appended to, as one JSON object per line.
+
+    :param filename: The name of the log file, or None to stop logging commands.
+    :return: None
+    """
+    global _command_log
+    _command_log = os.path.abspath(filename) if filename else None
+
+
+def get_tool_limits():
+    """
+    Read in the timeout and retry limits for each tool from the
+    magmo-tool-limits.csv file. Tools which are not listed have no timeout and
+    are not retried.
+
+    :return: A dictionary of limits, keyed by tool name, each with timeout and retries keys.
+    """
+    global _tool_limits
+    if _tool_limits is None:
+        limits = {}
+        limits_path = get_metadata_file_path('magmo-tool-limits.csv')
+        if os.path.exists(limits_path):
+            with open(limits_path, 'rb') as limits_file:
+                reader = csv.reader(limits_file)
+                next(reader)
+                for row in reader:
+                    limits[row[0]] = {'timeout': float(row[1]) if row[1] else None,
+                                      'retries': int(row[2]) if row[2] else 0}
+        _tool_limits = limits
+    return _tool_limits
+
+
+def _copy_output(pipe, counter):
+    """
+    Echo a command's output to stdout as it is produced, counting the bytes written.
+    """
+    fd = pipe.fileno()
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        counter[0] += len(data)
+        with _output_lock:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+    pipe.close()
+
+
+def _kill_command(pid, timed_out):
+    """
+    Kill a command which has run past its time limit, along with any processes it started.
+    """
+    timed_out.append(True)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        # The command has already finished
+        pass
+
+
+def get_tool_name(cmd):
+    """
+    Identify the tool a command runs, used to look up its limits and to group
+    commands in the command log. For python scripts this is the script name.
+
+    :param cmd: The command to be run
+    :return: The name of the tool, e.g. uvflag or analyse_data.py
+    """
+    parts = cmd.split()
+    if not parts:
+        return ''
+    tool = os.path.basename(parts[0])
+    if tool.startswith('python') and len(parts) > 1 and not parts[1].startswith('-'):
+        tool = os.path.basename(parts[1])
+    return tool
+
+
+def execute_command(cmd, out=None, timeout=None):
+    """
+    Run a shell command, wait for it to complete or time out, and measure the
+    resources it used. The command is run in its own process group so that it
+    and any processes it starts can be killed on a timeout.
+
+    :param cmd: The command to be run
+    :param out: An open file to write the command's output to, or None to echo the output to stdout.
+    :param timeout: The maximum number of seconds the command may run for, or None for no limit.
+    :return: A dictionary with the exit_code, timed_out, wall_time, cpu_user, cpu_sys, max_rss_kb and
+        output_bytes of the command.
+    """
+    start = time.time()
+    counter = [0]
+    copier = None
+    if out is not None:
+        out.flush()
+        out_start = os.fstat(out.fileno()).st_size
+        proc = subprocess.Popen(cmd, shell=True, stdout=out, stderr=subprocess.STDOUT, preexec_fn=os.setsid,
+                                close_fds=True)
+    else:
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                preexec_fn=os.setsid, close_fds=True)
+        copier = threading.Thread(target=_copy_output, args=(proc.stdout, counter))
+        copier.daemon = True
+        copier.start()
+
+    # Only a command with a time limit needs a timer, all others are simply waited on
+    timed_out = []
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, _kill_command, args=(proc.pid, timed_out))
+        timer.daemon = True
+        timer.start()
+    try:
+        while True:
+            try:
+                pid, status, rusage = os.wait4(proc.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+    except KeyboardInterrupt:
+        os.killpg(proc.pid, signal.SIGKILL)
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+    wall_time = time.time() - start
+
+    if os.WIFEXITED(status):
+        exit_code = os.WEXITSTATUS(status)
+    else:
+        exit_code = -os.WTERMSIG(status)
+    proc.returncode = exit_code
+    if copier is not None:
+        copier.join()
+        output_bytes = counter[0]
+    else:
+        output_bytes = os.fstat(out.fileno()).st_size - out_start
+
+    return {'exit_code': exit_code, 'timed_out': len(timed_out) > 0, 'wall_time': round(wall_time, 3),
+            'cpu_user': round(rusage.ru_utime, 3), 'cpu_sys': round(rusage.ru_stime, 3),
+            'max_rss_kb': rusage.ru_maxrss, 'output_bytes': output_bytes}
+
+
+def log_command(record, command_log=None):
+    """
+    Append the record of a command to the command log.
+
+    :param record: The dictionary describing the command run.
+    :param command_log: The log file to use, defaults to the one set by set_command_log
+    :return: None
+    """
+    log_path = command_log or _command_log
+    if not log_path:
+        return
+    line = json.dumps(record, sort_keys=True)
+    with _command_log_lock:
+        try:
+            with open(log_path, 'a') as log_file:
+                log_file.write(line + '\n')
+        except IOError as e:
+            print >> sys.stderr, "Unable to write to command log %s: %s" % (log_path, e)
+
+
+def run_os_cmd(cmd, failOnErr=True, log_file=None, timeout=None, retries=None, command_log=None):
     """
     Run an operating system command ensuring that it finishes successfully.
-    If the comand fails, the program will exit.
+    If the comand fails, the program will exit. The time, resources and
+    result of each attempt are recorded in the command log, if one is set.
+
     :param cmd: The command to be run
+    :param log_file: The file to append the command and its output to, if
+        it should not be written to stdout.
+    :param timeout: The maximum number of seconds the command may run for,
+        defaults to the limit for the tool in magmo-tool-limits.csv
+    :param retries: The number of times to retry a failed command, defaults
+        to the limit for the tool in magmo-tool-limits.csv
+    :param command_log: The command log file to use for this command,
+        defaults to the one set by set_command_log
     :return: None
     """
-    print ">", cmd
-    sys.stdout.flush()
-    try:
-        retcode = subprocess.call(cmd, shell=True)
-        if retcode != 0:
-            message = "Command '"+cmd+"' failed with code " + str(retcode)
-            print >>sys.stderr, message
+    tool = get_tool_name(cmd)
+    limits = get_tool_limits().get(tool, {})
+    if timeout is None:
+        timeout = limits.get('timeout')
+    if retries is None:
+        retries = limits.get('retries', 0)
+
+    for attempt in range(retries + 1):
+        out = None
+        if log_file:
+            out = open(log_file, 'a')
+            print >>out, ">", cmd
+            out.flush()
+        else:
+            with _output_lock:
+                print ">", cmd
+                sys.stdout.flush()
+        started = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        try:
+            record = execute_command(cmd, out, timeout)
+        except OSError as e:
+            message = "Command '" + cmd + "' failed " + str(e)
+            print >> sys.stderr, message
             if failOnErr:
                 raise CommandFailedError(message)
-    except OSError as e:
-        message = "Command '" + cmd + "' failed " + e
-        print >> sys.stderr, message
-        if failOnErr:
+            return None
+        finally:
+            if out:
+                out.close()
+
+        record.update({'cmd': cmd, 'tool': tool, 'attempt': attempt + 1, 'started': started,
+                       'cwd': os.getcwd()})
+        log_command(record, command_log)
+        if record['exit_code'] == 0 and not record['timed_out']:
+            return None
+
+        if record['timed_out']:
+            message = "Command '" + cmd + "' timed out after " + str(timeout) + " s"
+        else:
+            message = "Command '"+cmd+"' failed with code " + str(record['exit_code'])
+        print >>sys.stderr, message
+        if attempt < retries:
+            print >>sys.stderr, "Retrying (%d of %d)" % (attempt + 1, retries)
+        elif failOnErr:
             raise CommandFailedError(message)
     return None
 
 
+def summarise_command_log(filename):
+    """
+    Total up the time spent in each tool from a command log.
+
+    :param filename: The name of the command log file.
+    :return: A list of (tool, count, wall_time, cpu_time, max_rss_kb) tuples,
+        sorted by descending wall time.
+    """
+    totals = {}
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as log_file:
+        for line in log_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            count, wall, cpu, rss = totals.get(record['tool'], (0, 0.0, 0.0, 0))
+            totals[record['tool']] = (count + 1, wall + record['wall_time'],
+                                      cpu + record['cpu_user'] + record['cpu_sys'],
+                                      max(rss, record['max_rss_kb']))
+    summary = [(tool,) + values for tool, values in totals.items()]
+    return sorted(summary, key=lambda row: -row[2])
+
+
 def ensure_dir_exists(dirname):
     """
     Check if a folder exists, and if it doesn't, create it. Fail the
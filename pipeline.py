@@ -0,0 +1,346 @@
+#!/usr/bin/env python -u
+
+# Run the MAGMO processing pipeline for a set of days and then the survey.
+#
+# Each stage of the pipeline declares the files it reads and the files it
+# produces. A stage is only run if its outputs are missing or older than its
+# inputs, so rerunning the pipeline only redoes the work affected by changed
+# data. The per day stages of different days are run concurrently, followed
+# by the survey wide stages once all days have been processed.
+
+# Date 16 Oct 2026
+
+from __future__ import print_function, division
+
+import argparse
+import csv
+import glob
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import magmo
+
+
+class Stage(object):
+    """
+    A step in the pipeline. The inputs and outputs are lists of glob patterns
+    which are only evaluated when the stage is checked, so that they pick up
+    the files produced by earlier stages.
+    """
+
+    def __init__(self, name, command, inputs, outputs, depends=(), log_file=None):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.depends = depends
+        self.log_file = log_file
+
+
+_print_lock = threading.Lock()
+
+
+def log(prefix, message):
+    with _print_lock:
+        print("[%s] %s" % (prefix, message))
+        sys.stdout.flush()
+
+
+def parseargs():
+    """
+    Parse the command line arguments
+    :return: An args map with the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the stages of the MAGMO pipeline which are out of date for a set of days and the survey.")
+    parser.add_argument("days", nargs='*',
+                        help="The days to be processed, either single days or ranges such as 1-43. "
+                             "Defaults to all days.")
+    parser.add_argument("--workers", help="The number of days to process concurrently", type=int, default=1)
+    parser.add_argument("--imaging_workers", help="The number of sources of each day to image concurrently",
+                        type=int, default=1)
+    parser.add_argument("--clean", help="Reset each day with clean-data.py before processing it",
+                        default=False, action='store_true')
+    parser.add_argument("--archive", help="Archive the results of each processed day to prev_runs/ARCHIVE")
+    parser.add_argument("--days_only", help="Don't run the survey wide stages", default=False,
+                        action='store_true')
+    parser.add_argument("--dry_run", help="Only list the stages which are out of date", default=False,
+                        action='store_true')
+
+    args = parser.parse_args()
+    return args
+
+
+def parse_days(day_args):
+    """
+    Expand the list of day arguments into a list of days.
+
+    :param day_args: A list of day numbers and ranges, e.g. ['1-5', '7']
+    :return: The list of day numbers as strings, in order.
+    """
+    days = []
+    for day_arg in day_args:
+        if '-' in day_arg:
+            first, last = day_arg.split('-')
+            days.extend([str(day) for day in range(int(first), int(last) + 1)])
+        else:
+            days.append(str(int(day_arg)))
+    return days
+
+
+def get_all_days():
+    """
+    Read the list of all observed days from the magmo-days-full.csv file.
+    :return: The list of day numbers as strings.
+    """
+    days = []
+    with open(magmo.get_metadata_file_path('magmo-days-full.csv'), 'rb') as magmodays:
+        reader = csv.reader(magmodays)
+        for row in reader:
+            if row and row[0].isdigit():
+                days.append(row[0])
+    return days
+
+
+def get_rpfits_patterns(day):
+    """
+    Get the patterns matching the raw RPFITS files of a day.
+    :param day: The day number
+    :return: A list of glob patterns
+    """
+    day_row = magmo.get_day_file_data(day)
+    if day_row is None:
+        return []
+    return ['rawdata/' + fragment + '*' for fragment in day_row[2:]]
+
+
+def build_day_stages(day, imaging_workers=1):
+    """
+    Define the stages used to process a single day.
+
+    :param day: The day number
+    :param imaging_workers: The number of sources to image concurrently
+    :return: A list of Stage objects
+    """
+    day_dir = 'day' + day
+    load_outputs = [day_dir + '/MAGMO_day' + day + '_1421.uv', day_dir + '/backup']
+    return [
+        Stage('load', 'python load-data.py ' + day,
+              get_rpfits_patterns(day),
+              load_outputs,
+              log_file=day_dir + '/load.log'),
+        # process_day flags, calibrates and copies gains into the split uv data sets as it runs, so it is keyed
+        # on the loaded data and the stamp it writes once it has finished. Days with no strong sources have no
+        # 1420 cubes, so only the continuum images are required.
+        Stage('process', 'python process_day.py ' + day + ' ' + str(imaging_workers),
+              load_outputs + ['magmo-obs.csv', 'magmo-flagging.csv'],
+              [day_dir + '/process.done', day_dir + '/1757/*_restor.fits'],
+              depends=('load',), log_file=day_dir + '/process.log'),
+        Stage('image', 'python image-1420.py ' + day,
+              [day_dir + '/1757/*_restor.fits', day_dir + '/1420/*_restor.fits'],
+              [day_dir + '/images-comp.html'],
+              depends=('process',), log_file=day_dir + '/image.log'),
+        Stage('analyse', 'python analyse_data.py ' + day,
+              [day_dir + '/1757/*_restor.fits', day_dir + '/1420/*_restor.fits', day_dir + '/stats.csv',
+               'magmo-continuum.csv'],
+              # The store and index page are written even when a day has no fields to be searched
+              [day_dir + '/spectra_store/index.npy', day_dir + '/spectra.html'],
+              depends=('process',), log_file=day_dir + '/analyse.log'),
+    ]
+
+
+def build_survey_stages():
+    """
+    Define the stages which combine the results of all days.
+    :return: A list of Stage objects
+    """
+    return [
+        Stage('analyse_spectra', 'python analyse_spectra.py',
+              ['day*/*_src_comp.vot', 'day*/*_opacity.votable.xml', 'day*/spectra_store/index.npy',
+               'day*/stats.csv', 'magmo-continuum.csv'],
+              ['magmo-spectra.vot'], log_file='analyse_spectra.log'),
+        Stage('decompose', 'python decompose.py',
+              ['magmo-spectra.vot'],
+              ['magmo-components.vot', 'run*/magmo-decomp.pickle'],
+              depends=('analyse_spectra',), log_file='decompose.log'),
+        Stage('examine_gas', 'python examine_gas.py',
+              ['magmo-components.vot', 'magmo-spectra.vot'],
+              ['magmo-gas.vot'],
+              depends=('decompose',), log_file='examine_gas.log'),
+    ]
+
+
+def order_stages(stages):
+    """
+    Sort a set of stages so that each stage comes after all of the stages it
+    depends on.
+
+    :param stages: The list of Stage objects
+    :return: The list of stages in the order they should be run.
+    """
+    stage_map = dict((stage.name, stage) for stage in stages)
+    ordered = []
+    visiting = set()
+
+    def visit(stage):
+        if stage in ordered:
+            return
+        if stage.name in visiting:
+            raise ValueError("Stage %s depends on itself" % stage.name)
+        visiting.add(stage.name)
+        for name in stage.depends:
+            visit(stage_map[name])
+        visiting.remove(stage.name)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+def get_latest_mtime(path):
+    """
+    Find the most recent modification time of a file, or of any file within
+    a directory, such as a Miriad data set.
+    """
+    latest = os.path.getmtime(path)
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                latest = max(latest, os.path.getmtime(os.path.join(dirpath, filename)))
+    return latest
+
+
+def is_up_to_date(stage):
+    """
+    Check if the outputs of a stage are all present and newer than all of its inputs.
+
+    :param stage: The stage to be checked.
+    :return: True if the stage does not need to be run, False otherwise.
+    """
+    output_times = []
+    for pattern in stage.outputs:
+        paths = glob.glob(pattern)
+        if len(paths) == 0:
+            return False
+        output_times.extend([get_latest_mtime(path) for path in paths])
+
+    input_times = []
+    for pattern in stage.inputs:
+        input_times.extend([get_latest_mtime(path) for path in glob.glob(pattern)])
+    if len(input_times) == 0:
+        return True
+    return min(output_times) >= max(input_times)
+
+
+def run_stages(prefix, stages, dry_run=False, command_log=None):
+    """
+    Run each of the stages which are out of date, in dependency order. If a
+    stage fails, none of the later stages are run.
+
+    :param prefix: The label used for progress messages.
+    :param stages: The list of stages to be run.
+    :param dry_run: If True, only report which stages are out of date.
+    :param command_log: The file to record the time and resources used by each stage in.
+    :return: A tuple of the names of the stages run and the error, if any
+    """
+    ran = []
+    for stage in order_stages(stages):
+        if is_up_to_date(stage):
+            log(prefix, "%s is up to date" % stage.name)
+            continue
+        if dry_run:
+            log(prefix, "%s is out of date" % stage.name)
+            ran.append(stage.name)
+            continue
+
+        log(prefix, "Running %s" % stage.name)
+        start = time.time()
+        cmd = stage.command
+        if stage.log_file:
+            cmd += ' > ' + stage.log_file + ' 2>&1'
+        try:
+            magmo.run_os_cmd(cmd, command_log=command_log)
+        except magmo.CommandFailedError as ex:
+            log(prefix, "%s failed: %s" % (stage.name, ex))
+            return ran, "%s %s failed" % (prefix, stage.name)
+        ran.append(stage.name)
+        log(prefix, "Completed %s in %.02f s" % (stage.name, time.time() - start))
+    return ran, None
+
+
+def process_day(day, clean=False, archive=None, dry_run=False, imaging_workers=1):
+    """
+    Run the out of date stages for a day.
+
+    :param day: The day number
+    :param clean: Should the day be reset with clean-data.py first
+    :param archive: The name of the folder to archive the day's results to, or None to skip archiving
+    :param dry_run: If True, only report which stages are out of date.
+    :param imaging_workers: The number of sources to image concurrently
+    :return: The error for the day, or None if it was successful.
+    """
+    prefix = 'day' + day
+    try:
+        if clean and not dry_run:
+            log(prefix, "Cleaning")
+            magmo.run_os_cmd('python clean-data.py ' + day)
+        ran, error = run_stages(prefix, build_day_stages(day, imaging_workers), dry_run,
+                                command_log='day' + day + '/commands.jsonl')
+        if archive and ran and error is None and not dry_run:
+            log(prefix, "Archiving to " + archive)
+            magmo.run_os_cmd('./archive.sh ' + day + ' ' + archive)
+    except magmo.CommandFailedError as ex:
+        log(prefix, str(ex))
+        return "%s failed: %s" % (prefix, ex)
+    return error
+
+
+def main():
+    """
+    Main script for pipeline
+    :return: The exit code
+    """
+    args = parseargs()
+    days = parse_days(args.days) if args.days else get_all_days()
+    start = time.time()
+    print("#### Started MAGMO pipeline for %d days at %s ####" %
+          (len(days), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))))
+
+    pool = ThreadPool(processes=max(1, min(args.workers, len(days))))
+    try:
+        results = pool.map(lambda day: process_day(day, args.clean, args.archive, args.dry_run,
+                                                   args.imaging_workers), days, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    error_list = [error for error in results if error is not None]
+
+    if not args.days_only:
+        if len(error_list) == 0:
+            ran, error = run_stages('survey', build_survey_stages(), args.dry_run, command_log='commands.jsonl')
+            if error:
+                error_list.append(error)
+        else:
+            print("Skipping survey stages as some days failed")
+
+    # Report
+    end = time.time()
+    print('#### Pipeline completed at %s ####' %
+          time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end)))
+    print('Processed %d days in %.02f s' % (len(days), end - start))
+    if len(error_list) == 0:
+        print("Hooray! No errors found.")
+    else:
+        print("%d errors were encountered:" % (len(error_list)))
+        for err in error_list:
+            print(err)
+    return 0 if len(error_list) == 0 else 1
+
+
+# Run the script if it is called from the command line
+if __name__ == "__main__":
+    exit(main())
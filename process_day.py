@@ -19,9 +19,11 @@ import sys
 import time
 import numpy as np
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from string import Template
 from astropy.io import ascii
+from astropy.io import fits
 
 sn_min = 1.3
 num_chan = 627
@@ -312,7 +314,88 @@ def plot_image(fits_file, out_file):
     return
 
 
-def build_images(day_dir_name, sources, band, day):
+def copy_calibration(src, band, data_type):
+    """
+    Copy the phase calibrator's gains to a source's data. This is done for all
+    sources before any are imaged, as sources may share a phase calibrator.
+
+    :param src: The source being processed
+    :param band: The map describing the band to be processed
+    :param data_type: A description of the data, used in messages
+    :return: The name of the source's uv data file
+    """
+    src_name = src['source']
+    src_file, freq_suffix = find_freq_file(src_name, band['freqs'])
+    if src_file is None:
+        print "No %s file found for source %s and band %s." % (data_type, src_name, band['main'])
+        exit(1)
+
+    phase_cal_file = src['phase_cal'] + "." + freq_suffix
+    magmo.run_os_cmd('gpcopy vis=' + phase_cal_file + ' out=' + src_file)
+    return src_file
+
+
+def run_source_jobs(job_func, job_args, workers):
+    """
+    Run a job for each source, using a pool of threads to run several at once.
+    The jobs spend their time waiting on Miriad commands, so threads are
+    sufficient to keep several cores busy.
+
+    :param job_func: The function to be run for each source
+    :param job_args: A list of the argument tuples for each call to job_func
+    :param workers: The maximum number of jobs to run at once
+    :return: The list of results of job_func, in the same order as job_args
+    """
+    if workers > 1 and len(job_args) > 1:
+        pool = ThreadPool(processes=min(workers, len(job_args)))
+        try:
+            return pool.map(lambda args: job_func(*args), job_args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [job_func(*args) for args in job_args]
+
+
+def image_continuum_source(freq, src_name, src_file):
+    """
+    Produce a restored continuum image of a source. The output of the Miriad
+    commands is written to a log file for the source.
+
+    :param freq: The frequency of the band being imaged
+    :param src_name: The name of the source
+    :param src_file: The name of the source's uv data file
+    :return: None if the image was produced, otherwise the error message
+    """
+    name_prefix = freq + '/magmo-' + src_name + '_' + freq
+    dirty_file = name_prefix + '_dirty'
+    clean_file = name_prefix + '_clean'
+    beam_file = name_prefix + '_beam'
+    restored_file = name_prefix + '_restor'
+    fits_file = restored_file + '.fits'
+    log_file = name_prefix + '_image.log'
+    open(log_file, 'w').close()
+
+    try:
+        cmd = 'invert robust=0.5 options=systemp,mfs,double stokes=ii vis=' + src_file \
+            + ' slop=1.0 ' \
+            + ' map=' + dirty_file + ' beam=' + beam_file
+        magmo.run_os_cmd(cmd, log_file=log_file)
+        cmd = 'clean niters=2000 speed=+1 map=' + dirty_file \
+              + ' beam=' + beam_file + ' out=' + clean_file
+        magmo.run_os_cmd(cmd, log_file=log_file)
+        cmd = 'restor options=mfs model=' + clean_file + ' beam=' \
+            + beam_file + ' map=' + dirty_file + ' out=' + restored_file
+        magmo.run_os_cmd(cmd, log_file=log_file)
+        cmd = 'fits op=xyout in=' + restored_file + ' out=' + fits_file
+        magmo.run_os_cmd(cmd, log_file=log_file)
+    except magmo.CommandFailedError as e:
+        print "Imaging of %s failed, see %s" % (src_name, log_file)
+        return str(e)
+    print "Imaged %s" % src_name
+    return None
+
+
+def build_images(day_dir_name, sources, band, day, workers=1):
     """
     Generate continuum images of each field.
 
@@ -320,6 +403,7 @@ def build_images(day_dir_name, sources, band, day):
     :param sources: The list of sources, which includes the pahse calibrator details
     :param band: The map describing the continuum band to be processed
     :param day: The day being processed
+    :param workers: The number of sources to image at once
     :return: None
     """
 
@@ -330,51 +414,34 @@ def build_images(day_dir_name, sources, band, day):
     magmo.ensure_dir_exists(freq)
     print "Producing %s MHz continuum images for %d sources" % (freq, len(sources))
 
+    jobs = []
+    for src in sources:
+        try:
+            src_file = copy_calibration(src, band, 'continuum')
+            jobs.append((freq, src['source'], src_file))
+        except magmo.CommandFailedError as e:
+            error_list.append(str(e))
+    results = run_source_jobs(image_continuum_source, jobs, workers)
+
     img_idx = open('images.html', 'w')
     t = Template('<html>\n<head><title>Image previews for day $day</title></head>\n'
                  + '<body>\n<h1>Image previews for day $day at $freq MHz</h1>\n<table>')
     img_idx.write(t.substitute(day=day, freq=freq))
 
-    for src in sources:
-        src_name = src['source']
-        try:
-            src_file, freq_suffix = find_freq_file(src_name, band['freqs'])
-            if src_file is None:
-                print "No continuum file found for source %s and band %s." % (src_name, freq)
-                exit(1)
-
-            phase_cal_file = src['phase_cal'] + "." + freq_suffix
-            magmo.run_os_cmd('gpcopy vis=' + phase_cal_file + ' out=' + src_file)
-
-            name_prefix = freq + '/magmo-' + src_name + '_' + freq
-            dirty_file = name_prefix + '_dirty'
-            clean_file = name_prefix + '_clean'
-            beam_file = name_prefix + '_beam'
-            restored_file = name_prefix + '_restor'
-            fits_file = restored_file + '.fits'
-            png_file = name_prefix + '.png'
-
-            cmd = 'invert robust=0.5 options=systemp,mfs,double stokes=ii vis=' + src_file \
-                + ' slop=1.0 ' \
-                + ' map=' + dirty_file + ' beam=' + beam_file
-            magmo.run_os_cmd(cmd)
-            cmd = 'clean niters=2000 speed=+1 map=' + dirty_file \
-                  + ' beam=' + beam_file + ' out=' + clean_file
-            magmo.run_os_cmd(cmd)
-            cmd = 'restor options=mfs model=' + clean_file + ' beam=' \
-                + beam_file + ' map=' + dirty_file + ' out=' + restored_file
-            magmo.run_os_cmd(cmd)
-            cmd = 'fits op=xyout in=' + restored_file + ' out=' + fits_file
-            magmo.run_os_cmd(cmd)
-
-            plot_image(fits_file, png_file)
-
-            t = Template('<tr><td><br>Source ${src_name}</td></tr>\n<tr>\n'
-                         + '<td><a href="${png_file}"><img src="${png_file}" width="500px"></a></td></tr>')
-            img_idx.write(t.substitute(png_file=png_file, src_name=src_name))
+    for job, error in zip(jobs, results):
+        if error is not None:
+            error_list.append(error)
+            continue
 
-        except magmo.CommandFailedError as e:
-            error_list.append(str(e))
+        src_name = job[1]
+        name_prefix = freq + '/magmo-' + src_name + '_' + freq
+        fits_file = name_prefix + '_restor.fits'
+        png_file = name_prefix + '.png'
+        plot_image(fits_file, png_file)
+
+        t = Template('<tr><td><br>Source ${src_name}</td></tr>\n<tr>\n'
+                     + '<td><a href="${png_file}"><img src="${png_file}" width="500px"></a></td></tr>')
+        img_idx.write(t.substitute(png_file=png_file, src_name=src_name))
 
     img_idx.write('</table></body></html>\n')
     img_idx.close()
@@ -382,27 +449,90 @@ def build_images(day_dir_name, sources, band, day):
     return error_list
 
 
-def get_signal_noise_ratio(miriad_file):
+def calc_image_stats(fits_file, chunk_size=4194304):
     """
-    Retrieve the signal to noise ratio for a miriad image file.
-    :param miriad_file:
+    Calculate the root mean square and maximum of the pixels of an image, as
+    reported by Miriad's imstat. The image is memory mapped and processed in
+    chunks so that large cubes are never fully loaded. Blanked pixels are
+    ignored.
+
+    :param fits_file: The name of the FITS image file.
+    :param chunk_size: The number of pixels to process at a time.
     :return: The root mean square of the data and the maximum flux density
     """
-    result = subprocess.check_output(["imstat", "in="+miriad_file, "options=guaranteespaces"])
-    total_next = False
-    for line in result.splitlines():
-        # print line
-        if total_next:
-            stats = line.strip().split()
-            #print stats
-            #mean = float(stats[1])
-            rms = float(stats[2])
-            max = float(stats[3])
-            return rms, max
-        if re.match('^[ \t]*Total', line):
-            total_next = True
-    print "Unable to find totals in:"
-    print result
+    sum_sq = 0.0
+    count = 0
+    max_value = -np.inf
+    hdulist = fits.open(fits_file, memmap=True)
+    try:
+        pixels = hdulist[0].data.reshape(-1)
+        for start in range(0, pixels.size, chunk_size):
+            chunk = np.asarray(pixels[start:start + chunk_size], dtype=np.float64)
+            chunk = chunk[np.isfinite(chunk)]
+            if chunk.size > 0:
+                sum_sq += np.dot(chunk, chunk)
+                count += chunk.size
+                max_value = max(max_value, chunk.max())
+    finally:
+        hdulist.close()
+    if count == 0:
+        return 0.0, 0.0
+    return math.sqrt(sum_sq / count), float(max_value)
+
+
+def read_stats_cache(stats_file):
+    """
+    Read the image statistics previously saved in a stats.csv file.
+
+    :param stats_file: The name of the stats file.
+    :return: A dictionary of the rms, max, image_mtime and image_size of each source, keyed by source name.
+    """
+    cache = {}
+    if not os.path.exists(stats_file):
+        return cache
+    with open(stats_file, 'rb') as stats:
+        reader = csv.reader(stats)
+        header = next(reader, None)
+        if header is None or 'image_mtime' not in header:
+            return cache
+        for row in reader:
+            values = dict(zip(header, row))
+            cache[values['name']] = {'rms': float(values['rms']), 'max': float(values['max']),
+                                     'image_mtime': float(values['image_mtime']),
+                                     'image_size': int(float(values['image_size']))}
+    return cache
+
+
+def get_image_stats(day_dir_name, freq, src_names):
+    """
+    Retrieve the root mean square and maximum of the restored image of each
+    source in a band. The values for continuum images which are unchanged since
+    they were saved in the day's stats.csv file are reused.
+
+    :param day_dir_name: The name of the day directory
+    :param freq: The primary identifier of the frequency band.
+    :param src_names: The names of the sources.
+    :return: An ordered dictionary of the rms, max, image_mtime and image_size of each source with a restored
+        image, keyed by source name.
+    """
+    cache = read_stats_cache(day_dir_name + '/stats.csv') if freq == '1757' else {}
+    image_stats = OrderedDict()
+    num_calculated = 0
+    for src_name in src_names:
+        fits_file = day_dir_name + "/" + freq + "/magmo-" + src_name + "_" + freq + "_restor.fits"
+        if not os.path.exists(fits_file):
+            continue
+        stat = os.stat(fits_file)
+        cached = cache.get(src_name)
+        if cached is not None and cached['image_mtime'] == stat.st_mtime and cached['image_size'] == stat.st_size:
+            image_stats[src_name] = cached
+            continue
+        rms, max_value = calc_image_stats(fits_file)
+        image_stats[src_name] = {'rms': rms, 'max': max_value, 'image_mtime': stat.st_mtime,
+                                 'image_size': stat.st_size}
+        num_calculated += 1
+    print "Calculated stats for %d of %d %s MHz images" % (num_calculated, len(image_stats), freq)
+    return image_stats
 
 
 def find_strong_sources(day_dir_name, freq, sources, num_chan, min_sn):
@@ -425,12 +555,16 @@ def find_strong_sources(day_dir_name, freq, sources, num_chan, min_sn):
     src_sn = np.zeros(len(sources))
     src_used = []
 
+    src_mtime = []
+    src_size = []
+    image_stats = get_image_stats(day_dir_name, freq, [src['source'] for src in sources])
+
     i = 0
     for src in sources:
         src_name = src['source']
-        restored_img = day_dir_name + "/" + freq + "/magmo-" + src_name + "_" + freq + "_restor"
-        if os.path.exists(restored_img):
-            rms, max = get_signal_noise_ratio(restored_img)
+        if src_name in image_stats:
+            rms = image_stats[src_name]['rms']
+            max = image_stats[src_name]['max']
             sn = 0
             if rms > 0:
                 sn = max / rms
@@ -443,27 +577,74 @@ def find_strong_sources(day_dir_name, freq, sources, num_chan, min_sn):
             src_max[i] = max
             src_sn[i] = sn
             src_used.append("Y" if strong else "N")
+            src_mtime.append(image_stats[src_name]['image_mtime'])
+            src_size.append(image_stats[src_name]['image_size'])
             i += 1
 
     with open(day_dir_name+'/stats.csv', "wb") as stats:
         writer = csv.writer(stats, quoting=csv.QUOTE_NONNUMERIC)
-        writer.writerow(["name", "rms", "max", "sn", "strong"])
+        writer.writerow(["name", "rms", "max", "sn", "strong", "image_mtime", "image_size"])
         for i in range(0, len(src_names)):
             writer.writerow(
-                [src_names[i], src_rms[i], src_max[i], src_sn[i], src_used[i]])
+                [src_names[i], src_rms[i], src_max[i], src_sn[i], src_used[i], src_mtime[i], src_size[i]])
     #table = OrderedDict([('name', src_names), ('rms', src_rms), ('max', src_max), ('s/n', src_sn)])
     #ascii.write(table, day_dir_name+'/stats.dat', format='fixed_width', bookend=False, delimiter=None, quotechar='"')
 
     return strong_sources
 
 
-def build_cubes(day_dir_name, sources, band):
+def image_line_source(freq, src_name, src_file):
+    """
+    Produce a restored HI spectral cube of a source. The output of the Miriad
+    commands is written to a log file for the source.
+
+    :param freq: The frequency of the band being imaged
+    :param src_name: The name of the source
+    :param src_file: The name of the source's uv data file
+    :return: None if the cube was produced, otherwise the error message
+    """
+    name_prefix = freq + '/magmo-' + src_name + '_' + freq + '_'
+    ave_file = name_prefix + 'ave'
+    dirty_file = name_prefix + 'sl_dirty'
+    clean_file = name_prefix + 'sl_clean'
+    beam_file = name_prefix + 'sl_beam'
+    restored_file = name_prefix + 'sl_restor'
+    fits_file = restored_file + '.fits'
+    log_file = name_prefix + 'cube.log'
+    line = 'felocity,627,-250.0,0.8,0.8'
+    #line = 'felocity,1053,-250.0,0.4,0.4'
+    open(log_file, 'w').close()
+
+    try:
+        cmd = 'uvaver line=' + line + ' vis=' + src_file + ' out=' + ave_file
+        magmo.run_os_cmd(cmd, log_file=log_file)
+        cmd = 'invert robust=0.5 cell=5 options=systemp,nopol,mosaic,double stokes=i '\
+            + ' slop=1.0 line='+ line + ' vis=' + ave_file \
+            + ' map=' + dirty_file + ' beam=' + beam_file
+        magmo.run_os_cmd(cmd, log_file=log_file)
+        cmd = 'clean niters=500 mode=steer speed=+1 map=' + dirty_file + ' beam=' \
+            + beam_file + ' out=' + clean_file
+        magmo.run_os_cmd(cmd, log_file=log_file)
+        cmd = 'restor model=' + clean_file + ' beam=' \
+            + beam_file + ' map=' + dirty_file + ' out=' + restored_file
+        magmo.run_os_cmd(cmd, log_file=log_file)
+        cmd = 'fits op=xyout in=' + restored_file + ' out=' + fits_file
+        magmo.run_os_cmd(cmd, log_file=log_file)
+    except magmo.CommandFailedError as e:
+        print "Cube for %s failed, see %s" % (src_name, log_file)
+        return str(e)
+    print "Built cube for %s" % src_name
+    return None
+
+
+def build_cubes(day_dir_name, sources, band, workers=1):
     """
     Generate HI spectral cubes of each field.
 
     :param day_dir_name: The name of the day directory
     :param sources: The list of sources, which includes the pahse calibrator details
     :param band: The definition of the band being processed.
+    :param workers: The number of sources to image at once
     :return: None
     """
 
@@ -474,43 +655,16 @@ def build_cubes(day_dir_name, sources, band):
     magmo.ensure_dir_exists(freq)
     print "Producing %s MHz spectral cubes for %d sources" % (freq, len(sources))
 
+    jobs = []
     for src in sources:
-        src_name = src['source']
         try:
-            src_file, freq_suffix = find_freq_file(src_name, band['freqs'])
-            if src_file is None:
-                print "No spectral line file found for source %s and band %s." % (src_name, freq)
-                exit(1)
-
-            phase_cal_file = src['phase_cal'] + "." + freq_suffix
-            magmo.run_os_cmd('gpcopy vis=' + phase_cal_file + ' out=' + src_file)
-
-            name_prefix = freq + '/magmo-' + src_name + '_' + freq + '_'
-            ave_file = name_prefix + 'ave'
-            dirty_file = name_prefix + 'sl_dirty'
-            clean_file = name_prefix + 'sl_clean'
-            beam_file = name_prefix + 'sl_beam'
-            restored_file = name_prefix + 'sl_restor'
-            fits_file = restored_file + '.fits'
-            line = 'felocity,627,-250.0,0.8,0.8'
-            #line = 'felocity,1053,-250.0,0.4,0.4'
-
-            cmd = 'uvaver line=' + line + ' vis=' + src_file + ' out=' + ave_file
-            magmo.run_os_cmd(cmd)
-            cmd = 'invert robust=0.5 cell=5 options=systemp,nopol,mosaic,double stokes=i '\
-                + ' slop=1.0 line='+ line + ' vis=' + ave_file \
-                + ' map=' + dirty_file + ' beam=' + beam_file
-            magmo.run_os_cmd(cmd)
-            cmd = 'clean niters=500 mode=steer speed=+1 map=' + dirty_file + ' beam=' \
-                + beam_file + ' out=' + clean_file
-            magmo.run_os_cmd(cmd)
-            cmd = 'restor model=' + clean_file + ' beam=' \
-                + beam_file + ' map=' + dirty_file + ' out=' + restored_file
-            magmo.run_os_cmd(cmd)
-            cmd = 'fits op=xyout in=' + restored_file + ' out=' + fits_file
-            magmo.run_os_cmd(cmd)
+            src_file = copy_calibration(src, band, 'spectral line')
+            jobs.append((freq, src['source'], src_file))
         except magmo.CommandFailedError as e:
             error_list.append(str(e))
+    for error in run_source_jobs(image_line_source, jobs, workers):
+        if error is not None:
+            error_list.append(error)
 
     os.chdir('..')
     return error_list
@@ -522,11 +676,12 @@ def main():
     :return: None
     """
     # Read day parameter
-    if len(sys.argv) != 2:
+    if len(sys.argv) not in (2, 3):
         print("Incorrect number of parameters.")
-        print("Usage: python process_day.py day")
+        print("Usage: python process_day.py day [workers]")
         exit(1)
     day = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
     start = time.time()
 
     # metadata needed: flux/bandpass cal, phase cals for each source, extra flagging
@@ -545,6 +700,8 @@ def main():
     if not os.path.isdir(dayDirName):
         print "Directory %s could not be found." % dayDirName
         exit(1)
+    command_log = dayDirName + '/commands.jsonl'
+    magmo.set_command_log(command_log)
 
     # set up map of parent/child map of frequencies
     line_band = {'main': '1420', 'freqs': ['1420', '1421', '1420.5'], 'line': True}
@@ -565,13 +722,13 @@ def main():
     print error_list
 
     # Produce 2 GHz continuum image
-    error_list.extend(build_images(dayDirName, sources, cont_band, day))
+    error_list.extend(build_images(dayDirName, sources, cont_band, day, workers))
 
     # Produce HI image cube
     strong_sources = find_strong_sources(dayDirName, cont_band['main'], sources,
                                          num_chan, sn_min)
     print "### Found the following bright sources in the data ", strong_sources
-    error_list.extend(build_cubes(dayDirName, strong_sources, line_band))
+    error_list.extend(build_cubes(dayDirName, strong_sources, line_band, workers))
 
     # Report
     end = time.time()
@@ -580,6 +737,10 @@ def main():
     print 'Processed %d sources (%d strong enough to produce cubes) in %.02f s' % (len(sources),
                                                                                    len(strong_sources),
                                                                                    end - start)
+    print 'Time recorded for each tool in %s:' % command_log
+    for tool, count, wall_time, cpu_time, max_rss_kb in magmo.summarise_command_log(command_log):
+        print '  %-10s %5d runs %10.1f s wall %10.1f s cpu %8d MB peak' % (tool, count, wall_time, cpu_time,
+                                                                          max_rss_kb // 1024)
     if len(error_list) == 0:
         print "Hooray! No errors found."
     else:
@@ -587,6 +748,11 @@ def main():
         for err in error_list:
             print err
 
+    # Record that the day has been processed, for the pipeline
+    with open(dayDirName + '/process.done', 'w') as stamp:
+        stamp.write('Completed at %s with %d errors\n' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end)), len(error_list)))
+
 # Run the script if it is called from the command line
 if __name__ == "__main__":
     main()
\ No newline at end of file
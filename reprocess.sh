@@ -8,23 +8,10 @@ if [[ -z "$1" ]] ; then
 fi
 
 day=$1
-daydir="day${day}"
 
 date
 echo "Reprocessing day ${day}"
-python clean-data.py ${day}
-
-echo "Processing ... "
-python process_data.py ${day} >& ${daydir}/process.log
-
-echo "Imaging ... "
-python image-1420.py ${day} >& ${daydir}/image.log
-
-echo "Analysing ... "
-python analyse_data.py ${day} >& ${daydir}/analyse.log
-
-echo "Archiving ..."
-./archive.sh ${day} ${2-`date +%Y%m%d`}
+python pipeline.py --clean --days_only --archive ${2-`date +%Y%m%d`} ${day}
 
 echo "Done"
-date
\ No newline at end of file
+date
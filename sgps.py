@@ -9,7 +9,11 @@ from __future__ import print_function, division
 import os
 import logging
 import glob
+import gzip
+import json
+import shutil
 import numpy as np
+from collections import OrderedDict
 
 from astropy.io import fits
 from astropy.wcs import WCS
@@ -17,6 +21,9 @@ from astropy.wcs import WCS
 
 _SGPS_FOLDER = "/priv/myrtle1/gaskap/SGPS/"
 _SGPS_HI_PATTERN = '*hi.fits.gz'
+_SGPS_INDEX_FILE = 'sgps-hi-index.json'
+_SGPS_INDEX_VERSION = 1
+_SGPS_CACHE_FOLDER = 'sgps-cache'
 
 
 class Spectrum(object):
@@ -33,37 +40,273 @@ class Spectrum(object):
         return self.coord
 
 
+class SgpsCube(object):
+    """
+    An open SGPS cube, with its WCS and velocity axis ready for extracting
+    spectra. Compressed cubes are read from their uncompressed copy in the
+    SGPS cache so that the data can be memory mapped and only the pixels
+    sampled are read.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.hdulist = fits.open(get_uncompressed_cube(file_name), memmap=True, do_not_scale_image_data=True)
+        self.data = self.hdulist[0].data
+        header = self.hdulist[0].header
+        self.bscale = header.get('BSCALE', 1.0)
+        self.bzero = header.get('BZERO', 0.0)
+        self.wcs = WCS(header)
+        index = np.arange(header['NAXIS3'])
+        self.velocities = self.wcs.wcs_pix2world(0, 0, index[:], 0, 0)[2]
+
+    def extract(self, longitudes, latitudes):
+        """
+        Extract the spectrum at each of the galactic coordinates using one
+        coordinate conversion and one read of the data.
+        :param longitudes: An array of galactic longitudes in decimal degrees
+        :param latitudes: An array of galactic latitudes in decimal degrees
+        :return: An array of fluxes indexed by position then channel, and a
+                 boolean array which is False for positions outside the cube.
+        """
+        zeros = np.zeros(len(longitudes))
+        pix = self.wcs.wcs_world2pix(longitudes, latitudes, zeros, zeros, 1)
+        x_coords = np.round(pix[0]).astype(int) - 1
+        y_coords = np.round(pix[1]).astype(int) - 1
+        for i in range(len(longitudes)):
+            print("Translated %.4f, %.4f to %d, %d" % (
+                longitudes[i], latitudes[i], x_coords[i], y_coords[i]))
+        valid = (x_coords >= 0) & (x_coords < self.data.shape[3]) & (y_coords >= 0) & (
+            y_coords < self.data.shape[2])
+
+        # Extract slices
+        fluxes = self.data[0][:, y_coords[valid], x_coords[valid]].T
+        if self.bscale != 1.0 or self.bzero != 0.0:
+            fluxes = fluxes * self.bscale + self.bzero
+        return fluxes, valid
+
+    def close(self):
+        self.data = None
+        self.hdulist.close()
+
+
+class SgpsCubePool(object):
+    """
+    A least recently used pool of open SGPS cubes. This avoids reopening a
+    cube for each position which falls within it. The cubes are memory mapped,
+    unless they could not be decompressed to the cache, in which case each
+    open cube is held in memory.
+    """
+
+    def __init__(self, max_open=4):
+        self.max_open = max_open
+        self._cubes = OrderedDict()
+
+    def get_cube(self, file_name):
+        """
+        Retrieve the open cube for a file, opening it if needed.
+        :param file_name: The path of the SGPS cube
+        :return: The SgpsCube for the file.
+        """
+        cube = self._cubes.pop(file_name, None)
+        if cube is None:
+            while len(self._cubes) >= self.max_open:
+                oldest_name, oldest = self._cubes.popitem(last=False)
+                oldest.close()
+            cube = SgpsCube(file_name)
+        self._cubes[file_name] = cube
+        return cube
+
+    def close(self):
+        for cube in self._cubes.values():
+            cube.close()
+        self._cubes.clear()
+
+
+_cube_pool = SgpsCubePool()
+
+
+def get_axis_bounds(refpix, refval, delta, naxis):
+    """
+    Calculate the range of world values covered by a linear axis.
+    :param refpix: The reference pixel (1 based) of the axis
+    :param refval: The world value at the reference pixel
+    :param delta: The change in world value per pixel
+    :param naxis: The number of pixels along the axis
+    :return: The minimum and maximum world values of the axis
+    """
+    first = refval + (1 - refpix) * delta
+    last = refval + (naxis - refpix) * delta
+    return min(first, last), max(first, last)
+
+
+def read_hi_file_header(fits_path):
+    """
+    Read the description of an SGPS cube from its FITS header.
+    :param fits_path: The path to the SGPS cube.
+    :return: A dictionary of the cube's bounds and axis definitions.
+    """
+    entry = {'file_name': fits_path}
+    sgps_fits = fits.open(fits_path, memmap=True)
+    header = sgps_fits[0].header
+    for axis, name in ((1, 'long'), (2, 'lat'), (3, 'vel')):
+        ax = str(axis)
+        entry[name + '_refpix'] = float(header['CRPIX' + ax])
+        entry[name + '_refval'] = float(header['CRVAL' + ax])
+        entry[name + '_delta'] = float(header['CDELT' + ax])
+        entry[name + '_naxis'] = int(header['NAXIS' + ax])
+    del header
+    sgps_fits.close()
+    for name in ('long', 'lat', 'vel'):
+        entry['min_' + name], entry['max_' + name] = get_axis_bounds(
+            entry[name + '_refpix'], entry[name + '_refval'], entry[name + '_delta'], entry[name + '_naxis'])
+    return entry
+
+
+def read_hi_file_index(index_path):
+    """
+    Read the previously saved descriptions of the SGPS cubes.
+    :param index_path: The path to the index file.
+    :return: A dictionary of the cube descriptions keyed by file name. This will
+             be empty if the index is missing or out of date.
+    """
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, 'r') as index_file:
+            index = json.load(index_file)
+    except (IOError, ValueError) as e:
+        logging.warning('Ignoring unreadable SGPS index ' + index_path + ': ' + str(e))
+        return {}
+    if index.get('version') != _SGPS_INDEX_VERSION:
+        return {}
+    return dict((entry['file_name'], entry) for entry in index['files'])
+
+
+def write_hi_file_index(index_path, hi_files):
+    """
+    Save the descriptions of the SGPS cubes so they do not need to be read from
+    the FITS files next time.
+    :param index_path: The path to the index file.
+    :param hi_files: The list of cube descriptions.
+    :return: None
+    """
+    temp_path = index_path + '.tmp'
+    try:
+        with open(temp_path, 'w') as index_file:
+            json.dump({'version': _SGPS_INDEX_VERSION, 'files': hi_files}, index_file, indent=1)
+        os.rename(temp_path, index_path)
+    except (IOError, OSError) as e:
+        logging.warning('Unable to write SGPS index ' + index_path + ': ' + str(e))
+
+
 def get_hi_file_list():
     """
-    Retrieve a list of the HI SGPS data files and their longitude ranges.
-    :return: A list of dictionaries.
+    Retrieve a list of the HI SGPS data files and their longitude ranges. The
+    cube descriptions are kept in an index file and only files which are new,
+    or have changed size or modification time, have their headers read.
+    :return: A list of dictionaries, ordered by minimum longitude.
     """
     hi_files = []
     sgps_path = get_sgps_location()
     if not os.path.exists(sgps_path):
         logging.warning("Unable to find SGPS files at " + sgps_path)
+    index_path = get_sgps_index_location()
+    cached_files = read_hi_file_index(index_path)
+    changed = False
     fits_files = glob.glob1(sgps_path, _SGPS_HI_PATTERN)
     for fits_file in fits_files:
         fits_path = os.path.join(sgps_path, fits_file)
-        sgps_fits = fits.open(fits_path, memmap=True)
-        header = sgps_fits[0].header
-        long_refpix = int(header['CRPIX1'])
-        long_refval = float(header['CRVAL1'])
-        long_delta = float(header['CDELT1'])
-        long_naxis = int(header['NAXIS1'])
-        del header
-        sgps_fits.close()
-        min_long = long_refval - (long_refpix-1) * long_delta
-        max_long = long_refval + long_naxis * long_delta
-        if long_delta < 0:
-            temp = max_long
-            max_long = min_long
-            min_long = temp
-        hi_files.append({'min_long': min_long, 'max_long': max_long,
-                         'file_name': fits_path})
+        stat = os.stat(fits_path)
+        entry = cached_files.get(fits_path)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            entry = read_hi_file_header(fits_path)
+            entry['mtime'] = stat.st_mtime
+            entry['size'] = stat.st_size
+            changed = True
+        hi_files.append(entry)
+    hi_files.sort(key=lambda entry: (entry['min_long'], entry['file_name']))
+
+    if changed or len(cached_files) != len(hi_files):
+        write_hi_file_index(index_path, hi_files)
     return hi_files
 
 
+def get_uncompressed_cube(fits_path):
+    """
+    Find an uncompressed copy of an SGPS cube which can be memory mapped.
+    Compressed cubes are decompressed into the SGPS cache the first time they
+    are used, and again whenever the compressed cube is newer than its copy.
+    :param fits_path: The path to the SGPS cube
+    :return: The path of the uncompressed cube, or the original path if it is
+             not compressed or could not be decompressed.
+    """
+    if not fits_path.endswith('.gz'):
+        return fits_path
+    cache_folder = get_sgps_cache_location()
+    cache_path = os.path.join(cache_folder, os.path.basename(fits_path)[:-3])
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(fits_path):
+        return cache_path
+
+    # Write to a temporary file so that concurrent processes never see a partial copy
+    temp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        if not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+        print("Decompressing %s to %s" % (fits_path, cache_path))
+        with gzip.open(fits_path, 'rb') as in_file:
+            with open(temp_path, 'wb') as out_file:
+                shutil.copyfileobj(in_file, out_file, 16 * 1024 * 1024)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError) as e:
+        logging.warning('Unable to cache an uncompressed copy of ' + fits_path + ', it will be read into memory: '
+                        + str(e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return fits_path
+    return cache_path
+
+
+def get_hi_files_at_coords(longitudes, latitudes, sgps_hi_file_list, edge_size=0.5):
+    """
+    Identify the best SGPS file to retrieve data from for each of a set of
+    Galactic coordinates. For each coordinate the first file where the
+    longitude is at least edge_size away from the edge of the cube is chosen,
+    falling back to any file with data covering that longitude. Negative and
+    positive longitudes for the third and fourth quadrants are automatically
+    handled.
+    :param longitudes: The galactic longitudes in decimal degrees, may be in the
+                       range -180 < l < 360
+    :param latitudes: The galactic latitudes in decimal degrees, or None to
+                      only match on longitude.
+    :param sgps_hi_file_list: A list of dictionaries describing the SGPS files.
+    :param edge_size: The size around the edge to, ideally, avoid.
+    :return: An array of the index in sgps_hi_file_list of the file for each
+             coordinate, with -1 where there is no coverage.
+    """
+    longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))
+    actual_long = np.where(longitudes >= 0, longitudes, longitudes + 360.0)[:, np.newaxis]
+    file_idx = np.full(len(actual_long), -1, dtype=int)
+    if len(sgps_hi_file_list) == 0:
+        return file_idx
+
+    min_long = np.array([entry['min_long'] for entry in sgps_hi_file_list])
+    max_long = np.array([entry['max_long'] for entry in sgps_hi_file_list])
+    in_lat = True
+    if latitudes is not None:
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))[:, np.newaxis]
+        min_lat = np.array([entry.get('min_lat', -90.0) for entry in sgps_hi_file_list])
+        max_lat = np.array([entry.get('max_lat', 90.0) for entry in sgps_hi_file_list])
+        in_lat = (min_lat <= latitudes) & (latitudes <= max_lat)
+
+    # Fallback to no buffer if there are no files with this value away
+    # from the edges
+    for edge in ((edge_size, 0.0) if edge_size > 0.0 else (edge_size,)):
+        covered = (min_long + edge < actual_long) & (actual_long < max_long - edge) & in_lat
+        found = (file_idx < 0) & covered.any(axis=1)
+        file_idx[found] = np.argmax(covered[found], axis=1)
+    return file_idx
+
+
 def get_hi_file_at_long(longitude, sgps_hi_file_list, edge_size=0.5):
     """
     Identify the best SGPS file to retrieve data from at the supplied Galactic
@@ -75,75 +318,58 @@ def get_hi_file_at_long(longitude, sgps_hi_file_list, edge_size=0.5):
                       range -180 < l < 360
     :param sgps_hi_file_list: A list of dictionaries describing the SGPS files.
     :param edge_size: The sie around the edge to, ideally, avoid.
-    :return:
+    :return: The name of the file, or None if there is no coverage.
     """
-    actual_long = longitude if longitude >= 0 else 360.0 + longitude
-    for entry in sgps_hi_file_list:
-        if entry['min_long']+edge_size < actual_long < entry['max_long']-edge_size:
-            return entry['file_name']
+    file_idx = get_hi_files_at_coords([longitude], None, sgps_hi_file_list, edge_size=edge_size)[0]
+    if file_idx < 0:
+        # We don't have coverage for this longitude
+        return None
+    return sgps_hi_file_list[file_idx]['file_name']
 
-    # Fallback to no buffer if there are no files with this value away
-    # from the edges
-    if edge_size > 0.0:
-        return get_hi_file_at_long(actual_long, sgps_hi_file_list, edge_size=0.0)
 
-    # We don't have coverage for this longitude
-    return None
+def sample_spectra(longitudes, latitudes, sgps_hi_file_list, cube_pool=None):
+    """
+    Extract SGPS HI spectra at each of a set of galactic coordinates. The
+    positions are grouped by cube and each cube is read once for all of its
+    positions.
+    :param longitudes: The galactic longitudes of the target locations in decimal degrees
+    :param latitudes: The galactic latitudes of the target locations in decimal degrees
+    :param sgps_hi_file_list: A list of dictionaries describing the SGPS files.
+    :param cube_pool: The pool of open cubes to use, defaults to a shared pool.
+    :return: A list of Spectrum objects, matching the order of the positions,
+             with None for positions without SGPS coverage.
+    """
+    longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))
+    latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))
+    pool = cube_pool if cube_pool is not None else _cube_pool
+    coord_file_idx = get_hi_files_at_coords(longitudes, latitudes, sgps_hi_file_list)
+
+    results = [None] * len(longitudes)
+    for file_idx in np.unique(coord_file_idx[coord_file_idx >= 0]):
+        cube = pool.get_cube(sgps_hi_file_list[file_idx]['file_name'])
+        targets = np.where(coord_file_idx == file_idx)[0]
+        fluxes, valid = cube.extract(longitudes[targets], latitudes[targets])
+        for target, flux in zip(targets[valid], fluxes):
+            results[target] = Spectrum((longitudes[target], latitudes[target]), cube.velocities, flux)
+    return results
 
 
-def extract_spectra(coords, sgps_hi_file_list):
+def extract_spectra(coords, sgps_hi_file_list, cube_pool=None):
     """
     Extract SGPS HI spectra at each of the galactic coordinates
     :param coords: The coordinates of the target locations as SkyCoord objects
     :param sgps_hi_file_list: A list of dictionaries describing the SGPS files.
-    :return: A list of spectra objacts, order may not match the coords
+    :param cube_pool: The pool of open cubes to use, defaults to a shared pool.
+    :return: A list of spectra objects in the order of the coords, omitting any without SGPS coverage
     """
-
-    # get files for the coords
-    files = []
-    file_indexes = []
-    for coord in coords:
-        hi_file = get_hi_file_at_long(coord.galactic.l.value, sgps_hi_file_list)
-        if hi_file:
-            if not (hi_file in files):
-                files.append(hi_file)
-            file_indexes.append(files.index(hi_file))
-
+    longitudes = [coord.galactic.l.value for coord in coords]
+    latitudes = [coord.galactic.b.value for coord in coords]
     results = []
-    file_idx = 0
-    for fits_filename in files:
-        hdulist = fits.open(fits_filename)
-        image = hdulist[0].data
-        header = hdulist[0].header
-        w = WCS(header)
-        index = np.arange(header['NAXIS3'])
-        velocities = w.wcs_pix2world(0, 0, index[:], 0, 0)[2]
-
-        # For each target coord in this file
-        for i in range(0,len(file_indexes)):
-            if file_idx == file_indexes[i]:
-                coord = coords[i]
-                # convert desired coord to pixel coords
-                pix = w.wcs_world2pix(coord.galactic.l, coord.galactic.b, 0, 0, 1)
-                x_coord = int(round(pix[0])) - 1
-                y_coord = int(round(pix[1])) - 1
-                print("Translated %.4f, %.4f to %d, %d" % (
-                    coord.galactic.l.value, coord.galactic.b.value, x_coord, y_coord))
-
-                # Extract slice
-                slice = image[0, :, y_coord, x_coord]
-
-                # Create spectra object
-                spectrum = Spectrum(coord, velocities, slice)
-
-                # Add to result list
-                results.append(spectrum)
-
-        del image
-        del header
-        hdulist.close()
-        file_idx += 1
-
+    spectra = sample_spectra(longitudes, latitudes, sgps_hi_file_list, cube_pool=cube_pool)
+    for coord, spectrum in zip(coords, spectra):
+        if spectrum is not None:
+            spectrum.coord = coord
+            results.append(spectrum)
     return results
 
 
@@ -165,3 +391,28 @@ def get_sgps_location():
         else:
             logging.warning('Invalid SGPS_LOC value ignored: ' + env_loc)
     return _SGPS_FOLDER
+
+
+def get_sgps_index_location():
+    """
+    Retreive the path to the index of SGPS data files. This may be set in an
+    environment variable SGPS_INDEX, otherwise it will be in the current folder.
+    :return: the path to the SGPS index file.
+    """
+    env_loc = os.environ.get('SGPS_INDEX')
+    if env_loc:
+        return env_loc
+    return _SGPS_INDEX_FILE
+
+
+def get_sgps_cache_location():
+    """
+    Retreive the path to the folder holding the uncompressed copies of the
+    SGPS cubes. This may be set in an environment variable SGPS_CACHE,
+    otherwise it will be in the current folder.
+    :return: the path to the SGPS cache folder.
+    """
+    env_loc = os.environ.get('SGPS_CACHE')
+    if env_loc:
+        return env_loc
+    return _SGPS_CACHE_FOLDER
@@ -0,0 +1,319 @@
+#!/usr/bin/env python -u
+
+# Consolidated storage of the MAGMO absorption spectra.
+#
+# The spectra of each day are held in a folder of numpy files, one per column,
+# with each spectrum occupying a contiguous block of rows. The files can be
+# memory mapped, so readers get array views of the spectra without having to
+# parse a VOTable per spectrum. A survey wide index lists the spectra of all
+# of the days. The VOTable files can still be produced from the store for
+# archival.
+
+# Date 16 Oct 2026
+
+from __future__ import print_function, division
+
+import argparse
+import glob
+import os
+import shutil
+
+from astropy.io.votable import parse, from_table, writeto
+from astropy.io.votable.tree import Info
+from astropy.table import Table, Column
+import numpy as np
+
+
+STORE_FOLDER = 'spectra_store'
+SURVEY_INDEX_FILE = 'magmo-spectra-index.npy'
+SPECTRUM_COLUMNS = ('plane', 'velocity', 'opacity', 'flux', 'temp_brightness', 'sigma_tau', 'em_mean', 'em_std')
+INDEX_DTYPE = [('field', 'S32'), ('source', 'S32'), ('longitude', 'f8'), ('latitude', 'f8'),
+               ('beam_area', 'f8'), ('has_emission', '?'), ('start', 'i8'), ('end', 'i8')]
+SURVEY_INDEX_DTYPE = [('day', 'i4')] + INDEX_DTYPE
+
+_open_stores = {}
+
+
+class DayStore(object):
+    """
+    A read only view of the spectra of a day. The index and columns are memory
+    mapped and only loaded as they are accessed.
+    """
+
+    def __init__(self, day_dir_name):
+        self.day_dir_name = day_dir_name
+        self.folder = get_store_folder(day_dir_name)
+        self.index = np.load(os.path.join(self.folder, 'index.npy'), mmap_mode='r')
+        self._columns = {}
+        self._rows = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def column(self, name):
+        """
+        Retrieve a column for all spectra of the day.
+        :param name: The name of the column, one of SPECTRUM_COLUMNS
+        :return: A memory mapped array of the column's values for every spectrum, end to end.
+        """
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.folder, name + '.npy'), mmap_mode='r')
+        return self._columns[name]
+
+    def spectrum(self, row):
+        """
+        Retrieve the columns of a single spectrum.
+        :param row: The position of the spectrum in the day's index
+        :return: A dictionary of array views for each column, keyed by column name.
+        """
+        start = self.index['start'][row]
+        end = self.index['end'][row]
+        return dict((name, self.column(name)[start:end]) for name in SPECTRUM_COLUMNS)
+
+    def find(self, field, source):
+        """
+        Locate a spectrum in the day's index.
+        :param field: The name of the field
+        :param source: The id of the source within the field
+        :return: The row of the spectrum, or None if it is not in the store.
+        """
+        if self._rows is None:
+            self._rows = {}
+            for row in range(len(self.index)):
+                key = (as_str(self.index['field'][row]), as_str(self.index['source'][row]))
+                self._rows[key] = row
+        return self._rows.get((as_str(field), as_str(source)))
+
+    def get_votable_filename(self, row):
+        """
+        Get the name of the VOTable file that the spectrum would be exported to.
+        :param row: The position of the spectrum in the day's index
+        :return: The path of the opacity VOTable file
+        """
+        return get_opacity_filename(self.day_dir_name, as_str(self.index['field'][row]),
+                                    as_str(self.index['source'][row]))
+
+
+def as_str(value):
+    """
+    Convert a byte string from a numpy array to a native string.
+    """
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('ascii')
+    return str(value)
+
+
+def get_store_folder(day_dir_name):
+    return os.path.join(day_dir_name, STORE_FOLDER)
+
+
+def get_opacity_filename(day_dir_name, field, source):
+    return day_dir_name + '/' + field + '_src' + source + '_opacity.votable.xml'
+
+
+def has_day_store(day_dir_name):
+    return os.path.exists(os.path.join(get_store_folder(day_dir_name), 'index.npy'))
+
+
+def open_day_store(day_dir_name):
+    """
+    Open the spectrum store for a day, reusing any store already opened by this process.
+    :param day_dir_name: The name of the day's directory.
+    :return: The DayStore for the day.
+    """
+    store = _open_stores.get(day_dir_name)
+    if store is None:
+        store = DayStore(day_dir_name)
+        _open_stores[day_dir_name] = store
+    return store
+
+
+def write_day_store(day_dir_name, spectra):
+    """
+    Write out the spectra of a day, replacing any previous store for the day.
+
+    :param day_dir_name: The name of the day's directory.
+    :param spectra: A list of dictionaries, one per spectrum, with the keys field, source, longitude, latitude and
+                    beam_area, along with an array for each of the SPECTRUM_COLUMNS. The em_mean and em_std arrays
+                    may be empty where there is no emission data.
+    :return: None
+    """
+    index = np.zeros(len(spectra), dtype=INDEX_DTYPE)
+    start = 0
+    for i in range(len(spectra)):
+        spectrum = spectra[i]
+        length = len(spectrum['opacity'])
+        index[i] = (spectrum['field'], spectrum['source'], spectrum['longitude'], spectrum['latitude'],
+                    spectrum['beam_area'], len(spectrum['em_mean']) > 0, start, start + length)
+        start += length
+
+    folder = get_store_folder(day_dir_name)
+    temp_folder = folder + '.tmp'
+    if os.path.exists(temp_folder):
+        shutil.rmtree(temp_folder)
+    os.makedirs(temp_folder)
+    np.save(os.path.join(temp_folder, 'index.npy'), index)
+    for name in SPECTRUM_COLUMNS:
+        values = np.zeros(start)
+        for i in range(len(spectra)):
+            if len(spectra[i][name]) > 0:
+                values[index['start'][i]:index['end'][i]] = spectra[i][name]
+        np.save(os.path.join(temp_folder, name + '.npy'), values)
+
+    _open_stores.pop(day_dir_name, None)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.rename(temp_folder, folder)
+    print("Wrote %d spectra to %s" % (len(spectra), folder))
+
+
+def write_opacity_votable(filename, columns, longitude, latitude, beam_area):
+    """
+    Write a spectrum (velocity, flux and opacity) to a votable format file.
+
+    :param filename:  The filename to be created
+    :param columns: A dictionary of the spectrum's arrays, keyed by column name
+    :param longitude: The galactic longitude of the target object in decimal degrees
+    :param latitude: The galactic latitude of the target object in decimal degrees
+    :param beam_area: The area of the beam in radians^2
+    :return: None
+    """
+    table = Table(meta={'name': filename, 'id': 'opacity'})
+    table.add_column(Column(name='plane', data=columns['plane']))
+    table.add_column(Column(name='velocity', data=columns['velocity'], unit='m/s'))
+    table.add_column(Column(name='opacity', data=columns['opacity']))
+    table.add_column(Column(name='flux', data=columns['flux'], unit='Jy', description='Flux per beam'))
+    table.add_column(Column(name='temp_brightness', data=columns['temp_brightness'], unit='K'))
+    table.add_column(Column(name='sigma_tau', data=columns['sigma_tau'], description='Noise in the absorption profile'))
+    if len(columns['em_mean']) > 0:
+        # The emission may not be available, so don't include it if not
+        table.add_column(Column(name='em_mean', data=columns['em_mean'], unit='K'))
+        table.add_column(Column(name='em_std', data=columns['em_std'], unit='K'))
+
+    votable = from_table(table)
+    votable.infos.append(Info('longitude', 'longitude', longitude))
+    votable.infos.append(Info('latitude', 'latitude', latitude))
+    votable.infos.append(Info('beam_area', 'beam_area', beam_area))
+    writeto(votable, filename)
+
+
+def export_votables(day_dir_name):
+    """
+    Write out an opacity VOTable file for each spectrum in a day's store.
+
+    :param day_dir_name: The name of the day's directory.
+    :return: The number of files written.
+    """
+    store = open_day_store(day_dir_name)
+    for row in range(len(store)):
+        columns = store.spectrum(row)
+        if not store.index['has_emission'][row]:
+            columns['em_mean'] = []
+            columns['em_std'] = []
+        write_opacity_votable(store.get_votable_filename(row), columns, float(store.index['longitude'][row]),
+                              float(store.index['latitude'][row]), float(store.index['beam_area'][row]))
+    print("Exported %d spectra from %s" % (len(store), store.folder))
+    return len(store)
+
+
+def read_opacity_votable(filename):
+    votable = parse(filename, pedantic=False)
+    results = next(resource for resource in votable.resources if
+                   resource.type == "results")
+    results_array = results.tables[0].array
+    return results_array
+
+
+def read_spectrum(day, field, source):
+    """
+    Read in the columns of a spectrum, using the day's store if there is one and
+    otherwise the spectrum's opacity VOTable file.
+
+    :param day: The day the spectrum was observed
+    :param field: The name of the field
+    :param source: The id of the source within the field
+    :return: The spectrum's arrays, which can be accessed by column name.
+    """
+    day_dir_name = 'day' + str(day)
+    if has_day_store(day_dir_name):
+        store = open_day_store(day_dir_name)
+        row = store.find(field, source)
+        if row is not None:
+            return store.spectrum(row)
+    return read_opacity_votable(get_opacity_filename(day_dir_name, as_str(field), as_str(source)))
+
+
+def build_survey_index(pattern='day*'):
+    """
+    Combine the indexes of each day's store into a survey wide index and write
+    it out to SURVEY_INDEX_FILE.
+
+    :param pattern: The pattern matching the day directories to be included.
+    :return: The survey index array.
+    """
+    day_indexes = []
+    for day_dir_name in sorted(glob.glob(pattern)):
+        if not has_day_store(day_dir_name):
+            continue
+        day_index = open_day_store(day_dir_name).index
+        survey_rows = np.zeros(len(day_index), dtype=SURVEY_INDEX_DTYPE)
+        survey_rows['day'] = int(os.path.basename(day_dir_name)[3:])
+        for name in day_index.dtype.names:
+            survey_rows[name] = day_index[name]
+        day_indexes.append(survey_rows)
+
+    survey_index = np.concatenate(day_indexes) if day_indexes else np.zeros(0, dtype=SURVEY_INDEX_DTYPE)
+    np.save(SURVEY_INDEX_FILE, survey_index)
+    print("Indexed %d spectra from %d days in %s" % (len(survey_index), len(day_indexes), SURVEY_INDEX_FILE))
+    return survey_index
+
+
+def read_survey_index():
+    """
+    Read in the survey wide index of spectra.
+    :return: The memory mapped index array, or None if the index has not been built.
+    """
+    if not os.path.exists(SURVEY_INDEX_FILE):
+        return None
+    return np.load(SURVEY_INDEX_FILE, mmap_mode='r')
+
+
+def parseargs():
+    """
+    Parse the command line arguments
+    :return: An args map with the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Manage the consolidated store of MAGMO spectra.")
+    parser.add_argument("action", choices=['export', 'index'],
+                        help="export: write out the opacity VOTables for a day, "
+                             "index: rebuild the survey wide index of spectra")
+    parser.add_argument("day", nargs='?', help="The day number to be exported.")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """
+    Main script for spectra_store
+    :return: The exit code
+    """
+    args = parseargs()
+    if args.action == 'export':
+        if args.day is None:
+            print("A day must be specified for export.")
+            return 1
+        day_dir_name = "day" + args.day
+        if not has_day_store(day_dir_name):
+            print("No spectrum store found for %s." % day_dir_name)
+            return 1
+        export_votables(day_dir_name)
+    else:
+        build_survey_index()
+    return 0
+
+
+# Run the script if it is called from the command line
+if __name__ == "__main__":
+    exit(main())